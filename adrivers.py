@@ -0,0 +1,86 @@
+"""
+asyncio variants of the blocking driver operations
+
+The wrappers take an already constructed driver and replace its sleeps and
+busy-waits by ``await``, so several devices can be served from one loop (see
+``scheduler.py``). Bus transactions themselves stay synchronous: they take
+tens of microseconds and never wait on the device.
+"""
+
+from aio import sleep_ms, ticks_ms, ticks_diff
+from bqv3 import F_CONV_START
+
+
+class AsyncINA3221:
+    def __init__(self, ina, poll_ms=1):
+        self.ina = ina
+        self.poll_ms = poll_ms
+
+    async def wait_ready(self, timeout_ms=1000):
+        """Waits for the conversion ready flag"""
+        start = ticks_ms()
+        while not self.ina.is_ready:
+            if ticks_diff(ticks_ms(), start) > timeout_ms:
+                raise OSError("INA3221 conversion timeout")
+            await sleep_ms(self.poll_ms)
+
+    async def measure_all(self, result=None):
+        """Waits for a completed conversion, then reads all channels in one pass"""
+        await self.wait_ready()
+        return self.ina.measure_all(result)
+
+
+class AsyncBQ25895:
+    def __init__(self, bq, poll_ms=10):
+        self.bq = bq
+        self.poll_ms = poll_ms
+
+    async def convert(self, timeout_ms=1500):
+        """Starts a one-shot ADC conversion and waits until CONV_START clears.
+        In continuous mode (CONV_RATE=1) the bit is read-only and this waits for
+        the running conversion to finish."""
+        self.bq.set_field(F_CONV_START, 1)
+        self.bq.flush()
+        start = ticks_ms()
+        while self.bq._read_byte(F_CONV_START[0]) & (1 << F_CONV_START[1]):
+            if ticks_diff(ticks_ms(), start) > timeout_ms:
+                raise OSError("BQ25895 ADC conversion timeout")
+            await sleep_ms(self.poll_ms)
+
+    async def charge_current(self) -> int:
+        await self.convert()
+        return self.bq.adc_charge_current()
+
+    async def battery_volt(self) -> int:
+        await self.convert()
+        return self.bq.adc_battery_volt()
+
+
+class AsyncDS18B20:
+    def __init__(self, sensors, poll_ms=10):
+        self.sensors = sensors
+        self.poll_ms = poll_ms
+
+    async def read_temps(self):
+        """Converts on the whole bus and returns ``sensors.temps`` (1/100 degC)"""
+        self.sensors.start()
+        while not self.sensors.ready():
+            await sleep_ms(self.poll_ms)
+        return self.sensors.collect()
+
+
+class AsyncL298N:
+    def __init__(self, motor):
+        self.motor = motor
+
+    async def run_for(self, direction, time_ms):
+        """Queues a timed move after the ones already queued and returns once
+        the motor has stopped. Runs the motion engine itself unless it already
+        runs from a timer or ``motor.drive()``."""
+        motor = self.motor
+        while not motor.move(direction, time_ms):
+            await sleep_ms(motor.period_ms)
+        while not motor.isIdle():
+            if not motor.running:
+                motor.tick()
+            await sleep_ms(motor.period_ms)
@@ -0,0 +1,53 @@
+"""
+asyncio compatibility layer
+
+Gives the same names on MicroPython (``asyncio``/``uasyncio``) and on CPython,
+so the async drivers and the scheduler also run on a PC against the simulated
+devices of the ``sim`` package.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+import time
+
+try:
+    from time import ticks_ms, ticks_us, ticks_diff, ticks_add
+except ImportError:
+    # CPython: emulate the MicroPython wrapping tick counters
+    _TICKS_PERIOD = 1 << 30
+    _TICKS_MAX = _TICKS_PERIOD - 1
+    _TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+    def ticks_ms():
+        return (time.monotonic_ns() // 1000000) & _TICKS_MAX
+
+    def ticks_us():
+        return (time.monotonic_ns() // 1000) & _TICKS_MAX
+
+    def ticks_diff(end, start):
+        return ((end - start + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+    def ticks_add(ticks, delta):
+        return (ticks + delta) & _TICKS_MAX
+
+if hasattr(asyncio, "sleep_ms"):
+    sleep_ms = asyncio.sleep_ms
+else:
+    async def sleep_ms(ms):
+        await asyncio.sleep(ms / 1000)
+
+
+def current_task():
+    """The running asyncio task, or None outside of one"""
+    try:
+        return asyncio.current_task()
+    except (RuntimeError, ValueError, AttributeError):
+        return None
+
+
+def is_awaitable(obj):
+    """True for the result of calling an ``async def`` function"""
+    return obj is not None and hasattr(obj, "send")
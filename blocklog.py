@@ -0,0 +1,251 @@
+"""
+Binary sample log on a raw block range of the SD card
+
+Samples are packed into fixed 16-byte records and written a whole 512-byte
+block at a time with ``writeblocks``, bypassing FAT: no directory or FAT
+sector is rewritten while logging. The range is used as a ring; the oldest
+blocks are overwritten once it is full.
+
+Layout of the range (``start`` is the first block):
+    start         header: magic, version, record size, ring size, a
+                  checkpoint (sequence number and index of a written block)
+                  and the epoch
+    start + 1 ... data blocks, each a 16-byte block header (magic, sequence
+                  number, record count, record size, epoch, CRC32 of the
+                  records) followed by 31 records
+
+Every ``format()`` picks a new epoch. Blocks left in the range by an earlier
+log carry another epoch and are ignored by ``recover()``, even when their
+sequence numbers continue the current chain.
+
+Records are ``"<IBBhii"``: ticks_ms, source, channel and three values whose
+meaning depends on the source:
+    SRC_INA3221   channel 0-2: raw shunt register, raw bus register, 0
+    SRC_BQ25895   channel = charger state: REG0B status byte, Vbat mV, Ichg mA
+    SRC_DS18B20   channel = sensor index: temperature 1/100 degC, 0, 0
+
+Records are collected in one of two block buffers while the other one waits
+for ``service()`` to write it, so ``log()`` never touches the bus and can be
+called from scheduled IRQ work. The header checkpoint is rewritten every
+``checkpoint_every`` blocks; after a power loss ``recover()`` scans forward
+from it to the last block with the expected sequence number.
+
+Example usage:
+    log = blocklog.BlockLog(sd, 1000000, 65536)
+    if not log.recover():
+        log.format()
+    log.log(blocklog.SRC_DS18B20, 0, temps[0])
+    ...
+    log.service()  # from the main loop
+"""
+
+import binascii
+import struct
+import time
+from micropython import const
+
+SRC_INA3221 = const(1)
+SRC_BQ25895 = const(2)
+SRC_DS18B20 = const(3)
+
+RECORD = "<IBBhii"
+REC_SIZE = const(16)
+BLOCK_HEADER = "<4sIBBHI"
+BLOCK_MAGIC = b"BLKd"
+LOG_HEADER = "<4sHHIIIH"
+LOG_MAGIC = b"BLKh"
+VERSION = const(2)
+
+_BLOCK = const(512)
+_HDR_SIZE = const(16)
+_PER_BLOCK = const((512 - 16) // 16)
+_NONE = const(-1)
+
+try:
+    _crc32 = binascii.crc32
+except AttributeError:
+    # port built without crc32: blocks are checked by magic and sequence only
+    def _crc32(data):
+        return 0
+
+
+class BlockLog:
+    def __init__(self, dev, start, count, checkpoint_every=64):
+        """Logs to blocks ``start`` .. ``start + count - 1`` of ``dev``"""
+        assert count >= 2, "need a header and at least one data block"
+        self.dev = dev
+        self.start = start
+        self.blocks = count - 1
+        self.checkpoint_every = checkpoint_every
+        self._buf = (bytearray(_BLOCK), bytearray(_BLOCK))
+        self._mv = (memoryview(self._buf[0]), memoryview(self._buf[1]))
+        self._header = bytearray(_BLOCK)
+        self._fill = 0
+        self._count = 0
+        self._pending = _NONE
+        # sequence number and ring index of the next block to be filled
+        self.seq = 1
+        self.index = 0
+        self.epoch = 0
+        self._written = 0
+        self.records = 0
+        self.overruns = 0
+        self.blocks_written = 0
+
+    # header and recovery
+
+    def _write_header(self, seq, index):
+        struct.pack_into(LOG_HEADER, self._header, 0, LOG_MAGIC, VERSION, REC_SIZE,
+                         self.blocks, seq, index, self.epoch)
+        self.dev.writeblocks(self.start, self._header)
+
+    def format(self):
+        """Starts an empty log, erasing the range first if the device supports
+        it; records not written yet and the counters of ``stats()`` are dropped"""
+        # the epoch follows the one of the log being replaced; on a range
+        # without a log it only has to differ from stale blocks
+        self.dev.readblocks(self.start, self._header)
+        magic, _, _, _, _, _, epoch = struct.unpack_from(LOG_HEADER, self._header, 0)
+        if magic != LOG_MAGIC:
+            epoch = time.ticks_us()
+        self.epoch = (epoch + 1) & 0xFFFF or 1
+        if hasattr(self.dev, "pre_erase"):
+            self.dev.pre_erase(self.start + 1, self.blocks)
+        self._header[:] = bytes(_BLOCK)
+        self.seq = 1
+        self.index = 0
+        self._count = 0
+        self._pending = _NONE
+        self._written = 0
+        self.records = 0
+        self.overruns = 0
+        self.blocks_written = 0
+        self._write_header(0, 0)
+
+    def _read_block(self, index, buf):
+        """Returns the sequence number of a valid data block of this log's
+        epoch, else ``None``"""
+        self.dev.readblocks(self.start + 1 + index, buf)
+        magic, seq, count, rec_size, epoch, crc = struct.unpack_from(BLOCK_HEADER, buf, 0)
+        if magic != BLOCK_MAGIC or rec_size != REC_SIZE or count > _PER_BLOCK or epoch != self.epoch:
+            return None
+        if crc != _crc32(memoryview(buf)[_HDR_SIZE: _HDR_SIZE + count * REC_SIZE]):
+            return None
+        return seq
+
+    def _scan(self, buf):
+        """Returns the highest sequence number in the ring and its index"""
+        best = 0
+        index = 0
+        for i in range(self.blocks):
+            seq = self._read_block(i, buf)
+            if seq is not None and seq > best:
+                best = seq
+                index = i
+        return best, index
+
+    def recover(self):
+        """Finds the last valid block after a restart or power loss, starting at
+        the header checkpoint. Returns False if the range holds no log."""
+        buf = self._buf[0]
+        self.dev.readblocks(self.start, buf)
+        magic, version, rec_size, blocks, seq, index, epoch = struct.unpack_from(LOG_HEADER, buf, 0)
+        if magic != LOG_MAGIC or version != VERSION or rec_size != REC_SIZE or blocks != self.blocks:
+            return False
+        self._header[:] = buf
+        self.epoch = epoch
+        if seq and self._read_block(index, buf) != seq:
+            # the checkpointed block was overwritten: look at every block
+            seq, index = self._scan(buf)
+        if seq == 0:
+            index = self.blocks - 1
+        # follow the chain of consecutive sequence numbers
+        for _ in range(self.blocks):
+            nxt = index + 1 if index + 1 < self.blocks else 0
+            if self._read_block(nxt, buf) != seq + 1:
+                break
+            seq += 1
+            index = nxt
+        self.seq = seq + 1
+        self.index = index + 1 if index + 1 < self.blocks else 0
+        self._count = 0
+        self._pending = _NONE
+        self._written = 0
+        return True
+
+    # logging
+
+    def log(self, source, channel, h=0, a=0, b=0, ts=None):
+        """Appends one record; returns False if both buffers are full (overrun)"""
+        if self._count == _PER_BLOCK and not self._swap():
+            self.overruns += 1
+            return False
+        struct.pack_into(RECORD, self._buf[self._fill], _HDR_SIZE + self._count * REC_SIZE,
+                         time.ticks_ms() if ts is None else ts, source, channel, h, a, b)
+        self._count += 1
+        self.records += 1
+        return True
+
+    def _swap(self):
+        if self._pending != _NONE:
+            return False
+        struct.pack_into(BLOCK_HEADER, self._buf[self._fill], 0, BLOCK_MAGIC, self.seq,
+                         self._count, REC_SIZE, self.epoch, 0)
+        self._pending = self._fill
+        self._fill ^= 1
+        self._count = 0
+        self.seq += 1
+        return True
+
+    def service(self):
+        """Writes the full buffer, if any; call regularly from the main loop.
+        Returns the number of blocks written."""
+        if self._pending == _NONE:
+            return 0
+        buf = self._buf[self._pending]
+        seq, count = struct.unpack_from("<IB", buf, 4)
+        struct.pack_into("<I", buf, 12, _crc32(self._mv[self._pending][_HDR_SIZE: _HDR_SIZE + count * REC_SIZE]))
+        index = self.index
+        self.dev.writeblocks(self.start + 1 + index, buf)
+        self.index = index + 1 if index + 1 < self.blocks else 0
+        self._pending = _NONE
+        self.blocks_written += 1
+        self._written += 1
+        if self._written >= self.checkpoint_every:
+            self._written = 0
+            self._write_header(seq, index)
+        return 1
+
+    def flush(self):
+        """Writes everything logged so far, including a partly filled block, and
+        checkpoints. A partial block still takes a whole block of the ring."""
+        self.service()
+        if self._count:
+            self._swap()
+            self.service()
+        if self._written:
+            self._written = 0
+            prev = self.index - 1 if self.index else self.blocks - 1
+            self._write_header(self.seq - 1, prev)
+
+    # helpers for the drivers in this repository
+
+    def log_ina3221(self, measurement, ts=None):
+        """Logs the raw registers of an ``INA3221Measurement``"""
+        raw = measurement.raw
+        for ch in range(3):
+            self.log(SRC_INA3221, ch, raw[2 * ch], raw[2 * ch + 1], 0, ts)
+
+    def log_charger(self, ctrl, ts=None):
+        """Logs the state and last ADC results of a ``charger.ChargeController``"""
+        self.log(SRC_BQ25895, ctrl.state, ctrl._status[0x0B - 0x02], ctrl.vbat, ctrl.ichg, ts)
+
+    def log_temps(self, sensors, ts=None):
+        """Logs the readings of a ``ds18b20.DS18B20Bus``"""
+        temps = sensors.temps
+        for i in range(len(temps)):
+            self.log(SRC_DS18B20, i, temps[i], 0, 0, ts)
+
+    def stats(self) -> str:
+        return "records={} blocks={} overruns={} seq={}".format(
+            self.records, self.blocks_written, self.overruns, self.seq)
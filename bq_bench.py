@@ -0,0 +1,85 @@
+"""Micro-benchmark of BQ25895 field access
+
+Compares the table-driven ``get_field``/``set_field`` with the previous
+accessors, which built an 8-element list of bits per call. Both work on the
+shadow register copy, so the numbers show CPU time and heap usage only.
+"""
+
+import gc
+import time
+from bqv3 import F_ICHG, F_VREG
+
+
+def legacy_set_bit(bq, reg, values):
+    """Bit-list register update as done before the field table"""
+    reg_val = bq._read_reg(reg)
+    reg_val_old = reg_val
+    values.reverse()
+    for i, value in enumerate(values):
+        if value is not None:
+            mask = 1 << i
+            reg_val = (reg_val | mask) if value else (reg_val & ~mask)
+    if reg_val != reg_val_old:
+        bq._shadow[reg] = reg_val
+        bq._dirty |= 1 << reg
+
+
+def legacy_set_charge_current(bq, m_A):
+    reg_val = int(m_A / 64)
+    legacy_set_bit(bq, 0x04, [
+        None,
+        1 if reg_val & 0b01000000 else 0,
+        1 if reg_val & 0b00100000 else 0,
+        1 if reg_val & 0b00010000 else 0,
+        1 if reg_val & 0b00001000 else 0,
+        1 if reg_val & 0b00000100 else 0,
+        1 if reg_val & 0b00000010 else 0,
+        1 if reg_val & 0b00000001 else 0
+    ])
+
+
+def legacy_get_charge_voltage(bq):
+    reg_val = bq._read_reg(0x06)
+    voltage_bin = (reg_val & 0b11111100) >> 2
+    return (voltage_bin * 16) + 3840
+
+
+def _begin():
+    gc.collect()
+    gc.disable()
+    return gc.mem_alloc(), time.ticks_us()
+
+
+def _report(name, start, count):
+    elapsed = time.ticks_diff(time.ticks_us(), start[1])
+    used = gc.mem_alloc() - start[0]
+    gc.enable()
+    print("{:28s} {:6d} us/call {:6d} bytes/call".format(name, elapsed // count, used // count))
+
+
+def run(bq, count=200):
+    start = _begin()
+    for i in range(count):
+        legacy_set_charge_current(bq, 64 + (i & 63) * 64)
+    _report("legacy set_charge_current", start, count)
+
+    start = _begin()
+    for i in range(count):
+        bq.set_field(F_ICHG, 64 + (i & 63) * 64)
+    _report("set_field(F_ICHG)", start, count)
+
+    start = _begin()
+    for _ in range(count):
+        legacy_get_charge_voltage(bq)
+    _report("legacy get_charge_voltage", start, count)
+
+    start = _begin()
+    for _ in range(count):
+        bq.get_field(F_VREG)
+    _report("get_field(F_VREG)", start, count)
+
+    # drop the benchmark values from the shadow copy
+    bq.reload()
+
+
+# from bqv3 import *;from bq_bench import run;bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12);run(bq)
@@ -1,5 +1,8 @@
-from machine import I2C, Pin
+from machine import Pin
+from micropython import const
 import time
+from irqevent import IRQEvents
+from i2cbus import get_bus, lock
 
 VBUS_TYPE = ['NONE',
              'SDP',
@@ -18,28 +21,78 @@ CHRG_STAT = ['Not Charging',
 PG_STAT = ['Not Power Good',
            'Power Good']
 
-regs = [None for _ in range(21)]
+_NUM_REGS = const(21)
+
+# last register dump seen by handler_all_regs, refreshed by BQ25895.reset()
+regs = bytearray(_NUM_REGS)
+_regs_now = bytearray(_NUM_REGS)
+# Configuration registers REG01-REG0A are only changed by the host, so they are
+# served from the shadow copy. REG00 (IINLIM, set by input detection and ICO)
+# and REG0D (VINDPM in relative mode) are also changed by the chip and, like
+# the status, fault and ADC registers, always read from it.
+_CACHED_REGS = const(0x07FE)
+# Bits that the chip clears by itself once the requested action is done
+# (CONV_START/FORCE_DPDM, WD_RST, FORCE_ICO, PUMPX_UP/PUMPX_DN); they must not
+# be written again by a later flush. AUTO_DPDM_EN (REG02 bit 0) is persistent
+# and kept.
+_SELF_CLEARING = ((0x02, 0b10000010), (0x03, 0b01000000), (0x09, 0b10000011))
+
+# Register fields: (register, shift, width, scale, offset)
+# value = ((reg >> shift) & (2 ** width - 1)) * scale + offset
+F_CONV_START = (const(0x02), const(7), const(1), const(1), const(0))
+F_CONV_RATE = (const(0x02), const(6), const(1), const(1), const(0))
+F_CHG_CONFIG = (const(0x03), const(4), const(1), const(1), const(0))
+F_ICHG = (const(0x04), const(0), const(7), const(64), const(0))          # mA
+F_IPRECHG = (const(0x05), const(4), const(4), const(64), const(64))      # mA
+F_ITERM = (const(0x05), const(0), const(4), const(64), const(64))        # mA
+F_VREG = (const(0x06), const(2), const(6), const(16), const(3840))       # mV
+F_EN_TERM = (const(0x07), const(7), const(1), const(1), const(0))
+F_WATCHDOG = (const(0x07), const(4), const(2), const(1), const(0))
+F_BATFET_DIS = (const(0x09), const(5), const(1), const(1), const(0))
+F_VBUS_STAT = (const(0x0B), const(5), const(3), const(1), const(0))
+F_CHRG_STAT = (const(0x0B), const(3), const(2), const(1), const(0))
+F_PG_STAT = (const(0x0B), const(2), const(1), const(1), const(0))
+F_BATV = (const(0x0E), const(0), const(7), const(20), const(2304))       # mV
+F_VBUSV = (const(0x11), const(0), const(7), const(100), const(2600))     # mV
+F_ICHGR = (const(0x12), const(0), const(7), const(50), const(0))         # mA
+F_REG_RST = (const(0x14), const(7), const(1), const(1), const(0))
 
 
 class BQ25895:
     I2CADDR = 0x6A
 
-    def __init__(self, sda_pin, scl_pin, intr_pin, not_ce_pin, handler=None):
-        self.i2c = I2C(scl=Pin(scl_pin), sda=Pin(sda_pin), freq=400000)
+    def __init__(self, sda_pin, scl_pin, intr_pin, not_ce_pin, handler=None, flag=None, i2c=None):
+        # the bus is shared with the other devices on it, see i2cbus
+        self.i2c = i2c if i2c is not None else get_bus(0, scl=scl_pin, sda=sda_pin)
+        # read-modify-write and flush sequences hold the bus
+        self._lock = lock(self.i2c)
         self.not_ce_pin = Pin(not_ce_pin, mode=Pin.OUT)
         self._user_handler = handler
+        self._shadow = bytearray(_NUM_REGS)
+        self._shadow_mv = memoryview(self._shadow)
+        self._valid = 0
+        self._dirty = 0
         self.reset()
         self.pg_stat_last = self._read_byte(0x0B) & 0b00000100
+        # the INT pin handler only queues the event, _int_handler runs deferred,
+        # through micropython.schedule or the asyncio flag when one is given
+        int_handler = self._int_handler
+        if hasattr(self.i2c, "guard"):
+            # deferred until a transaction sequence in progress has finished
+            int_handler = self.i2c.guard(int_handler)
+        self.irq_events = IRQEvents(int_handler, flag=flag)
         self.pin_intr = Pin(intr_pin, mode=Pin.IN, pull=Pin.PULL_UP)
-        self.pin_intr.irq(trigger=Pin.IRQ_FALLING, handler=self._int_handler)
+        self.pin_intr.irq(trigger=Pin.IRQ_FALLING, handler=self.irq_events.irq, hard=True)
 
-    def _int_handler(self, pin):
+    def _int_handler(self, events):
         reg0b = self._read_byte(0x0B)
 
         if self.pg_stat_last != reg0b & 0b00000100:
             self.pg_stat_last = reg0b & 0b00000100
             if reg0b & 0b00000100 > 1:
                 print("Power reset detected")
+                # the chip may have reloaded its defaults, re-read on next access
+                self._valid &= self._dirty
 
         if self._user_handler is not None:
             self._user_handler(self)
@@ -50,20 +103,73 @@ class BQ25895:
     def _write_byte(self, reg, value) -> None:
         self.i2c.writeto_mem(self.I2CADDR, reg, bytearray([value]))
 
-    def _set_bit(self, reg, values) -> None:
-        assert len(values) == 8, f"Reg has 8 bit (not {len(values)})"
-        if len(values) == 8:
-            reg_val = self._read_byte(reg)
-            reg_val_old = reg_val
-
-            values.reverse()
-            for i, value in enumerate(values):
-                if value is not None:
-                    mask = 1 << i
-                    reg_val = (reg_val | mask) if value else (reg_val & ~mask)
-
-            if reg_val != reg_val_old:
-                self._write_byte(reg, reg_val)
+    def _read_reg(self, reg) -> int:
+        """Register value, served from the shadow copy for configuration registers.
+        Includes changes that are not flushed yet."""
+        bit = 1 << reg
+        if not _CACHED_REGS & bit:
+            return self._read_byte(reg)
+        if not self._valid & bit:
+            self._shadow[reg] = self._read_byte(reg)
+            self._valid |= bit
+        return self._shadow[reg]
+
+    def reload(self) -> None:
+        """Drops pending changes and reads the register file into the shadow copy"""
+        self.dump_registers(self._shadow)
+        self._valid = _CACHED_REGS
+        self._dirty = 0
+
+    def dump_registers(self, buf) -> None:
+        """Reads REG00-REG14 into ``buf`` (21 bytes) with one auto-increment block read"""
+        self.i2c.readfrom_mem_into(self.I2CADDR, 0, buf)
+
+    def flush(self) -> int:
+        """Writes the changed shadow registers to the chip, grouping contiguous
+        registers into one block write. Returns the number of I2C writes."""
+        dirty = self._dirty
+        writes = 0
+        reg = 0
+        with self._lock:
+            while dirty >> reg:
+                if not (dirty >> reg) & 1:
+                    reg += 1
+                    continue
+                start = reg
+                while (dirty >> reg) & 1:
+                    reg += 1
+                self.i2c.writeto_mem(self.I2CADDR, start, self._shadow_mv[start:reg])
+                writes += 1
+        self._dirty = 0
+        for reg, mask in _SELF_CLEARING:
+            self._shadow[reg] &= ~mask
+        return writes
+
+    def _update_reg(self, reg, mask, bits) -> None:
+        """Replaces the ``mask`` bits of a register. Cached registers are changed in
+        the shadow copy, the others are written to the chip immediately."""
+        with self._lock:
+            reg_val = self._read_reg(reg)
+            new_val = (reg_val & ~mask) | bits
+            if new_val != reg_val:
+                if _CACHED_REGS & (1 << reg):
+                    self._shadow[reg] = new_val
+                    self._dirty |= 1 << reg
+                else:
+                    self._write_byte(reg, new_val)
+
+    def get_field(self, field) -> int:
+        """Decoded value of a field from the ``F_*`` table"""
+        reg, shift, width, scale, offset = field
+        return ((self._read_reg(reg) >> shift) & ((1 << width) - 1)) * scale + offset
+
+    def set_field(self, field, value) -> None:
+        """Encodes ``value`` into a field from the ``F_*`` table"""
+        reg, shift, width, scale, offset = field
+        raw = (value - offset) // scale
+        mask = (1 << width) - 1
+        assert 0 <= raw <= mask and (value - offset) % scale == 0, f"Value {value} does not fit field of REG{reg:02X}"
+        self._update_reg(reg, mask << shift, raw << shift)
 
     def get_byte_bin(self, val) -> str:
         bin_value = "{:08b}".format(val)
@@ -74,193 +180,120 @@ class BQ25895:
         return bin_value
 
     def reset(self) -> None:
-        self._set_bit(0x14, [1, None, None, None, None, None, None, None])  # reset chip
+        self.set_field(F_REG_RST, 1)  # reset chip
+        self.reload()
         # ADC Conversion Rate Selection  – Start 1s Continuous Conversion
-        self._set_bit(0x02, [None, 1, None, None, None, None, None, None])
-        self._set_bit(0x07, [None, None, 0, 0, None, None, None, None])  # disable watchdog
+        self.set_field(F_CONV_RATE, 1)
+        self.set_field(F_WATCHDOG, 0)  # disable watchdog
         self.set_charge_enable(False)
         self.set_batfet_mode(False)
         self.set_charge_current(64)
         self.set_charging_termination(False)
         self.set_charge_voltage(4176)
-        # self._set_bit(0x14, [1, None, None, None, None, None, None, None])
-        # self._set_bit(0x02, [None, 1, None, None, None, None, None, None])
-        # self._set_bit(0x07, [None, None, 0, 0, None, None, None, None])
-        # self._set_bit(0x03, [None, 1, None, None, None, None, None, None])
-
-        for i in range(21):
-            regs[i] = self._read_byte(i)
+        self.flush()
+        self.dump_registers(regs)
 
     def set_charge_enable(self, mode: bool) -> None:
-        self._set_bit(0x03, [None, None, None, mode, None, None, None, None])
+        """Drives the /CE pin right away; the CHG_CONFIG bit is applied by ``flush()``"""
+        self.set_field(F_CHG_CONFIG, mode)
         if not mode:
             self.not_ce_pin.on()
         else:
             self.not_ce_pin.off()
 
     def get_charge_enable(self) -> bool:
-        value = int(self.get_reg_bin(0x03)[3])
+        value = self.get_field(F_CHG_CONFIG)
         return value and not self.not_ce_pin.value()
 
     def input_type(self) -> int:
-        ret = self._read_byte(0x0B)
-        return ret >> 5
+        return self.get_field(F_VBUS_STAT)
 
     def input_type_str(self) -> str:
         return VBUS_TYPE[self.input_type()]
 
     def charge_state(self) -> int:
-        ret = self._read_byte(0x0B)
-        return (ret & 0b00011000) >> 3
+        return self.get_field(F_CHRG_STAT)
 
     def get_charge_state(self) -> str:
         return CHRG_STAT[self.charge_state()]
 
     def power_good_stat(self) -> int:
-        ret = self._read_byte(0x0B)
-        return (ret & 0b00000100) >> 2
+        return self.get_field(F_PG_STAT)
 
     def power_good_stat_str(self) -> str:
         return PG_STAT[self.power_good_stat()]
 
     def adc_battery_volt(self) -> int:
-        ret = self._read_byte(0x0E)
-        return 2304 + (int(ret & 0b01111111) * 20)
+        return self.get_field(F_BATV)
 
     def adc_vbus_volt(self) -> int:
-        ret = self._read_byte(0x11)
-        return 2600 + (int(ret & 0b01111111) * 100)
+        return self.get_field(F_VBUSV)
 
     def adc_charge_current(self) -> int:
-        ret = self._read_byte(0x12)
-        return int(ret & 0b01111111) * 50
+        return self.get_field(F_ICHGR)
 
     def set_charge_current(self, m_A) -> None:
         assert 64 <= m_A <= 5056, f"Charge current range is [64, 5056] mA. ({m_A})"
         assert m_A % 64 == 0, f"Charge current step is 64 mA ({m_A})"
-        reg_val = int(m_A / 64)
-        self._set_bit(0x04, [
-            None,
-            1 if reg_val & 0b01000000 else 0,
-            1 if reg_val & 0b00100000 else 0,
-            1 if reg_val & 0b00010000 else 0,
-            1 if reg_val & 0b00001000 else 0,
-            1 if reg_val & 0b00000100 else 0,
-            1 if reg_val & 0b00000010 else 0,
-            1 if reg_val & 0b00000001 else 0
-        ])
+        self.set_field(F_ICHG, m_A)
 
     def get_charge_current(self) -> int:
-        reg_val = self._read_byte(0x04)
-        current_bin = reg_val & 0b01111111
-        current = current_bin * 64
-        return current
+        return self.get_field(F_ICHG)
 
     def set_current_cut_off(self, m_A) -> None:
         assert 64 <= m_A <= 1024, f"Cut off current must be in range [64, 1024] mA ({m_A})"
         assert m_A % 64 == 0, f"Cut off current step is 64 mA ({m_A})"
-
-        reg_val = m_A - 64
-        reg_val = int(reg_val / 64)
-
-        self._set_bit(0x05, [
-            None,
-            None,
-            None,
-            None,
-            1 if reg_val & 0b00001000 else 0,
-            1 if reg_val & 0b00000100 else 0,
-            1 if reg_val & 0b00000010 else 0,
-            1 if reg_val & 0b00000001 else 0
-        ])
+        self.set_field(F_ITERM, m_A)
 
     def get_current_cut_off(self) -> int:
-        reg_val = self._read_byte(0x05)
-        current_bin = reg_val & 0b00001111
-        current = current_bin * 64
-        return current
+        return self.get_field(F_ITERM)
 
     def set_current_precharge_limit(self, m_A):
         assert 64 <= m_A <= 1024, f"Precharge current must be in range [64, 1024] mA ({m_A})"
         assert m_A % 64 == 0, f"Precharge current limit step is 64 mA ({m_A})"
-
-        reg_val = m_A - 64
-        reg_val = int(reg_val / 64)
-
-        self._set_bit(0x05, [
-            1 if reg_val & 0b00001000 else 0,
-            1 if reg_val & 0b00000100 else 0,
-            1 if reg_val & 0b00000010 else 0,
-            1 if reg_val & 0b00000001 else 0,
-            None,
-            None,
-            None,
-            None
-        ])
+        self.set_field(F_IPRECHG, m_A)
 
     def get_current_precharge_limit(self) -> int:
-        reg_val = self._read_byte(0x05)
-        current_bin = reg_val & 0b11110000
-        current = current_bin * 64
-        return current
+        return self.get_field(F_IPRECHG)
 
     def set_charging_termination(self, mode: bool):
-        self._set_bit(0x07, [
-            mode,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None
-        ])
-        
+        self.set_field(F_EN_TERM, mode)
+
     def get_charging_termination(self) -> int:
-        reg_val: int = self._read_byte(0x07)
-        mode: int = (reg_val & 0b10000000)
-        return mode
+        return self.get_field(F_EN_TERM)
 
-    def get_batfet_mode(self) -> None:
-        reg_val = self._read_byte(0x09)
-        mode = reg_val & 0b00100000
-        return mode
+    def get_batfet_mode(self) -> int:
+        return self.get_field(F_BATFET_DIS)
 
     def set_batfet_mode(self, mode) -> None:
-        self._set_bit(0x09, [None, None, mode, None, None, None, None, None])
+        self.set_field(F_BATFET_DIS, mode)
 
     def set_charge_voltage(self, voltage) -> None:
         assert 3840 <= voltage <= 4608, "Charge voltage must be in range [3840, 4608]"
-        voltage_additional = voltage - 3840
-        reg_val = int(voltage_additional / 16)
         assert voltage % 16 == 0, "Charge voltage must be a multiple of 16 mV"
+        self.set_field(F_VREG, voltage)
 
-        self._set_bit(0x06, [
-            1 if reg_val & 0b00100000 else 0,
-            1 if reg_val & 0b00010000 else 0,
-            1 if reg_val & 0b00001000 else 0,
-            1 if reg_val & 0b00000100 else 0,
-            1 if reg_val & 0b00000010 else 0,
-            1 if reg_val & 0b00000001 else 0,
-            None,
-            None
-        ])
+    def get_charge_voltage(self) -> int:
+        return self.get_field(F_VREG)
 
-    def get_charge_voltage(self) -> float:
-        reg_val: int = self._read_byte(0x06)
-        voltage_bin: int = (reg_val & 0b11111100) >> 2
-        voltage = (voltage_bin * 16) + 3840
-        return voltage
 
+def diff_registers(old, new) -> int:
+    """Returns a bitmask of the registers that differ between two dumps"""
+    changed = 0
+    for i in range(len(new)):
+        if old[i] != new[i]:
+            changed |= 1 << i
+    return changed
 
 
 def handler_all_regs(bq: BQ25895):
     print("INTERRUPTION: ", "=" * 5)
-    for i, old_val in enumerate(regs):
-        new_val = bq._read_byte(i)
-        if new_val != old_val:
-            print(f"INT: REG{hex(i)}: ", bq.get_byte_bin(old_val), " -> ", bq.get_byte_bin(new_val))
-            regs[i] = new_val
+    bq.dump_registers(_regs_now)
+    changed = diff_registers(regs, _regs_now)
+    for i in range(_NUM_REGS):
+        if changed & (1 << i):
+            print(f"INT: REG{hex(i)}: ", bq.get_byte_bin(regs[i]), " -> ", bq.get_byte_bin(_regs_now[i]))
+            regs[i] = _regs_now[i]
 
     print("Ichg: ", bq.adc_charge_current())
     print("Vbat: ", bq.adc_battery_volt())
@@ -282,12 +315,13 @@ def set_current_limits(bq: BQ25895):
     bq.set_charging_termination(False)
     bq.set_charge_current(128)
     bq.set_current_cut_off(64)
+    bq.flush()
 
 
 def test_bq(bq: BQ25895):
     for i in range(5):
-        print("VBUS Type:", bq.vbus_type_str())
-        print("Charge Status:", bq.chrg_stat_str())
+        print("VBUS Type:", bq.input_type_str())
+        print("Charge Status:", bq.get_charge_state())
         print("Battery Voltage (mV):", bq.adc_battery_volt())
         print("Charge Current (mA):", bq.adc_charge_current())
         time.sleep(1)
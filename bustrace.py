@@ -0,0 +1,364 @@
+"""
+Bus transaction tracing
+
+``instrument()`` replaces the bus object of a driver (``INA3221.i2c_device``,
+``BQ25895.i2c``, ``SDCard.spi``) by a traced wrapper with the same API, and
+can wrap driver methods too. While ``Trace.enabled`` is set, every bus
+transaction is stored into preallocated ring buffers (start ``ticks_us``,
+duration, API, I2C address, register or SD command, length, and the traced
+driver call that issued it), and every bus API and traced driver call keeps
+a latency histogram with log2 buckets (bucket ``b`` holds durations of
+``2**(b-1)`` to ``2**b - 1`` us). Recording allocates nothing.
+
+Disabled, a traced bus costs one attribute test per transaction, so the
+wrappers can stay in place. Traced driver methods allocate their argument
+tuple, so only wrap the calls you are looking at.
+
+Example usage:
+    trace = Trace()
+    instrument(trace, ina, calls=("measure_all", "read"))
+    instrument(trace, sd)
+    trace.enabled = True
+    ...
+    trace.report()
+    trace.dump(20)
+    with open("/sd/trace.bin", "wb") as f:
+        trace.export(f)
+"""
+
+from array import array
+from micropython import const
+import struct
+import time
+
+_BUCKETS = const(24)
+_NONE = const(0xFFFF)
+_SPI = const(0xFF)
+_NO_CALL = const(0xFF)
+
+# bus APIs, their ids are fixed; traced driver calls are numbered after them
+API_NAMES = ("readfrom_mem_into", "readfrom_mem", "writeto_mem", "writeto", "readfrom_into", "readfrom",
+             "spi.write", "spi.readinto", "spi.read", "spi.write_readinto")
+_RD_MEM_INTO = const(0)
+_RD_MEM = const(1)
+_WR_MEM = const(2)
+_WRITETO = const(3)
+_RD_INTO = const(4)
+_RD = const(5)
+_SPI_WRITE = const(6)
+_SPI_READINTO = const(7)
+_SPI_READ = const(8)
+_SPI_WRITE_READINTO = const(9)
+
+# export layout, little endian: header, names (length byte + bytes each),
+# then the arrays in this order: ring ts, dur (u32), reg, len (u16), api, dev,
+# call (u8), and per API calls, total_us, max_us, transactions (u32) and the
+# histograms (u32, _BUCKETS per API)
+EXPORT_MAGIC = b"BTr1"
+EXPORT_HEADER = "<4sHIHH"  # magic, ring size, records since reset, APIs, buckets
+
+
+class Trace:
+    def __init__(self, size=256, max_apis=32):
+        self.enabled = False
+        self.size = size
+        self.max_apis = max_apis
+        self.names = list(API_NAMES)
+        self._ts = array("I", (0 for _ in range(size)))
+        self._dur = array("I", (0 for _ in range(size)))
+        self._reg = array("H", (0 for _ in range(size)))
+        self._len = array("H", (0 for _ in range(size)))
+        self._api = bytearray(size)
+        self._dev = bytearray(size)
+        self._call = bytearray(size)
+        self.calls = array("I", (0 for _ in range(max_apis)))
+        self.total_us = array("I", (0 for _ in range(max_apis)))
+        self.max_us = array("I", (0 for _ in range(max_apis)))
+        # bus transactions issued by each traced driver call
+        self.transactions = array("I", (0 for _ in range(max_apis)))
+        self.hist = array("I", (0 for _ in range(max_apis * _BUCKETS)))
+        self._context = _NO_CALL
+        self.reset()
+
+    def reset(self):
+        self._head = 0
+        self.count = 0
+        for i in range(self.max_apis):
+            self.calls[i] = self.total_us[i] = self.max_us[i] = self.transactions[i] = 0
+        for i in range(len(self.hist)):
+            self.hist[i] = 0
+
+    def api(self, name) -> int:
+        """Id of a traced driver call, registered on first use"""
+        if name in self.names:
+            return self.names.index(name)
+        if len(self.names) >= min(self.max_apis, _NO_CALL):
+            raise ValueError("too many traced calls")
+        self.names.append(name)
+        return len(self.names) - 1
+
+    def _latency(self, api, us):
+        self.calls[api] += 1
+        self.total_us[api] += us
+        if us > self.max_us[api]:
+            self.max_us[api] = us
+        bucket = 0
+        while us and bucket < _BUCKETS - 1:
+            us >>= 1
+            bucket += 1
+        self.hist[api * _BUCKETS + bucket] += 1
+
+    def record(self, api, dev, reg, nbytes, start):
+        """Stores a transaction started at ``start`` (``ticks_us``) that ended now"""
+        us = time.ticks_diff(time.ticks_us(), start)
+        i = self._head
+        self._ts[i] = start
+        self._dur[i] = us
+        self._api[i] = api
+        self._dev[i] = dev
+        self._reg[i] = reg
+        self._len[i] = nbytes
+        call = self._context
+        self._call[i] = call
+        if call != _NO_CALL:
+            self.transactions[call] += 1
+        i += 1
+        self._head = 0 if i == self.size else i
+        self.count += 1
+        self._latency(api, us)
+
+    def wrap(self, obj, method, name=None):
+        """Replaces ``obj.method`` by a traced version, named
+        ``Class.method`` unless ``name`` is given"""
+        api = self.api(name or "{}.{}".format(type(obj).__name__, method))
+        fn = getattr(obj, method)
+
+        def traced(*args, **kwargs):
+            if not self.enabled:
+                return fn(*args, **kwargs)
+            outer = self._context
+            self._context = api
+            start = time.ticks_us()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._context = outer
+                self._latency(api, time.ticks_diff(time.ticks_us(), start))
+        setattr(obj, method, traced)
+        return api
+
+    # readout
+
+    def _records(self, last):
+        n = min(self.count, self.size, last)
+        i = self._head - n
+        if i < 0:
+            i += self.size
+        for _ in range(n):
+            yield i
+            i += 1
+            if i == self.size:
+                i = 0
+
+    def dump(self, last=16):
+        """Prints the last transactions"""
+        names = self.names
+        for i in self._records(last):
+            dev = self._dev[i]
+            reg = self._reg[i]
+            call = self._call[i]
+            print("{:10d} {:6d}us {:18s} {} {} {:4d}B {}".format(
+                self._ts[i], self._dur[i], names[self._api[i]],
+                "spi " if dev == _SPI else "0x{:02x}".format(dev),
+                "    " if reg == _NONE else "0x{:02x}".format(reg), self._len[i],
+                "" if call == _NO_CALL else names[call]))
+
+    def histogram(self, api):
+        """Counts per log2 bucket of one API, by name or id"""
+        if isinstance(api, str):
+            api = self.names.index(api)
+        return self.hist[api * _BUCKETS:(api + 1) * _BUCKETS]
+
+    def report(self):
+        """Prints count, mean, max and the non-empty buckets of every API used"""
+        for api in range(len(self.names)):
+            n = self.calls[api]
+            if not n:
+                continue
+            hist = self.histogram(api)
+            buckets = " ".join("<{}:{}".format(1 << b, hist[b]) for b in range(_BUCKETS) if hist[b])
+            tx = self.transactions[api]
+            print("{:26s} {:7d} calls {:7d}us mean {:7d}us max{} | {}".format(
+                self.names[api], n, self.total_us[api] // n, self.max_us[api],
+                " {:5.1f} tr/call".format(tx / n) if tx else "", buckets))
+
+    def export(self, stream):
+        """Writes the ring and the histograms in binary, see ``EXPORT_HEADER``"""
+        stream.write(struct.pack(EXPORT_HEADER, EXPORT_MAGIC, self.size, self.count, len(self.names), _BUCKETS))
+        for name in self.names:
+            data = name.encode()
+            stream.write(bytes((len(data),)))
+            stream.write(data)
+        for buf in (self._ts, self._dur, self._reg, self._len, self._api, self._dev, self._call,
+                    self.calls, self.total_us, self.max_us, self.transactions, self.hist):
+            stream.write(buf)
+
+
+class TracedI2C:
+    """``machine.I2C`` API over ``i2c``, recording into ``trace``. Like
+    ``I2CBus``, ``addrsize`` is only passed on when it is not 8."""
+
+    def __init__(self, i2c, trace):
+        self.bus = i2c
+        self.trace = trace
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        if not self.trace.enabled:
+            if addrsize == 8:
+                return self.bus.readfrom_mem_into(addr, memaddr, buf)
+            return self.bus.readfrom_mem_into(addr, memaddr, buf, addrsize=addrsize)
+        start = time.ticks_us()
+        try:
+            if addrsize == 8:
+                self.bus.readfrom_mem_into(addr, memaddr, buf)
+            else:
+                self.bus.readfrom_mem_into(addr, memaddr, buf, addrsize=addrsize)
+        finally:
+            self.trace.record(_RD_MEM_INTO, addr, memaddr, len(buf), start)
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
+        if not self.trace.enabled:
+            if addrsize == 8:
+                return self.bus.readfrom_mem(addr, memaddr, nbytes)
+            return self.bus.readfrom_mem(addr, memaddr, nbytes, addrsize=addrsize)
+        start = time.ticks_us()
+        try:
+            if addrsize == 8:
+                return self.bus.readfrom_mem(addr, memaddr, nbytes)
+            return self.bus.readfrom_mem(addr, memaddr, nbytes, addrsize=addrsize)
+        finally:
+            self.trace.record(_RD_MEM, addr, memaddr, nbytes, start)
+
+    def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
+        if not self.trace.enabled:
+            if addrsize == 8:
+                return self.bus.writeto_mem(addr, memaddr, buf)
+            return self.bus.writeto_mem(addr, memaddr, buf, addrsize=addrsize)
+        start = time.ticks_us()
+        try:
+            if addrsize == 8:
+                self.bus.writeto_mem(addr, memaddr, buf)
+            else:
+                self.bus.writeto_mem(addr, memaddr, buf, addrsize=addrsize)
+        finally:
+            self.trace.record(_WR_MEM, addr, memaddr, len(buf), start)
+
+    def writeto(self, addr, buf, stop=True):
+        if not self.trace.enabled:
+            return self.bus.writeto(addr, buf, stop)
+        start = time.ticks_us()
+        try:
+            return self.bus.writeto(addr, buf, stop)
+        finally:
+            # the first byte written is the register pointer
+            self.trace.record(_WRITETO, addr, buf[0] if len(buf) else _NONE, len(buf), start)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        if not self.trace.enabled:
+            return self.bus.readfrom_into(addr, buf, stop)
+        start = time.ticks_us()
+        try:
+            self.bus.readfrom_into(addr, buf, stop)
+        finally:
+            self.trace.record(_RD_INTO, addr, _NONE, len(buf), start)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        if not self.trace.enabled:
+            return self.bus.readfrom(addr, nbytes, stop)
+        start = time.ticks_us()
+        try:
+            return self.bus.readfrom(addr, nbytes, stop)
+        finally:
+            self.trace.record(_RD, addr, _NONE, nbytes, start)
+
+
+class TracedSPI:
+    """``machine.SPI`` API over ``spi``; writes of SD commands record the command index"""
+
+    def __init__(self, spi, trace):
+        self.bus = spi
+        self.trace = trace
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+    def write(self, buf):
+        if not self.trace.enabled:
+            return self.bus.write(buf)
+        start = time.ticks_us()
+        try:
+            self.bus.write(buf)
+        finally:
+            # an SD command is one 6-byte write starting with 01 and the index;
+            # data and token writes are not decoded
+            cmd = _NONE
+            if len(buf) == 6 and buf[0] & 0xC0 == 0x40:
+                cmd = buf[0] & 0x3F
+            self.trace.record(_SPI_WRITE, _SPI, cmd, len(buf), start)
+
+    def readinto(self, buf, write=0xFF):
+        if not self.trace.enabled:
+            return self.bus.readinto(buf, write)
+        start = time.ticks_us()
+        try:
+            self.bus.readinto(buf, write)
+        finally:
+            self.trace.record(_SPI_READINTO, _SPI, _NONE, len(buf), start)
+
+    def read(self, nbytes, write=0xFF):
+        if not self.trace.enabled:
+            return self.bus.read(nbytes, write)
+        start = time.ticks_us()
+        try:
+            return self.bus.read(nbytes, write)
+        finally:
+            self.trace.record(_SPI_READ, _SPI, _NONE, nbytes, start)
+
+    def write_readinto(self, write_buf, read_buf):
+        if not self.trace.enabled:
+            return self.bus.write_readinto(write_buf, read_buf)
+        start = time.ticks_us()
+        try:
+            self.bus.write_readinto(write_buf, read_buf)
+        finally:
+            self.trace.record(_SPI_WRITE_READINTO, _SPI, _NONE, len(read_buf), start)
+
+
+_BUS_ATTRS = ("i2c_device", "i2c", "spi")
+
+
+def instrument(trace, driver, calls=()):
+    """Traces the bus of ``driver`` and the driver methods named in ``calls``"""
+    for attr in _BUS_ATTRS:
+        bus = getattr(driver, attr, None)
+        if bus is None:
+            continue
+        if not isinstance(bus, (TracedI2C, TracedSPI)):
+            setattr(driver, attr, (TracedSPI if attr == "spi" else TracedI2C)(bus, trace))
+        break
+    for method in calls:
+        trace.wrap(driver, method)
+
+
+def uninstrument(driver, calls=()):
+    """Restores the bus object and the methods wrapped by ``instrument()``"""
+    for attr in _BUS_ATTRS:
+        bus = getattr(driver, attr, None)
+        if isinstance(bus, (TracedI2C, TracedSPI)):
+            setattr(driver, attr, bus.bus)
+    for method in calls:
+        if method in driver.__dict__:
+            delattr(driver, method)
@@ -0,0 +1,196 @@
+"""
+CC/CV charge controller on top of the BQ25895
+
+The chip does the actual charging; the controller follows its phases as a
+state machine (precharge, constant current, constant voltage, termination,
+fault) and records every transition with its ``ticks_ms`` timestamp.
+
+The state is re-evaluated on the chip interrupt (deferred through
+``IRQEvents``) and on a slow poll, either from a ``machine.Timer`` or from
+``run()`` on an asyncio loop. Each poll costs one block read and one write to
+start the next one-shot ADC conversion, so the bus and the CPU stay idle
+between polls.
+
+Example usage:
+    ctrl = ChargeController(bq, charge_current=512)
+    ctrl.start(machine.Timer(0))
+    ...
+    ctrl.print_log()
+"""
+
+from array import array
+from micropython import const, schedule
+import time
+from aio import sleep_ms
+from bqv3 import F_CONV_RATE, F_CONV_START, CHRG_STAT
+
+IDLE = const(0)
+PRECHARGE = const(1)
+CC = const(2)
+CV = const(3)
+DONE = const(4)
+FAULT = const(5)
+
+STATE_NAMES = ("IDLE", "PRECHARGE", "CC", "CV", "DONE", "FAULT")
+
+# one block read of REG02-REG12 covers CONV_START, status, fault and ADC results
+_REG_FIRST = const(0x02)
+_STATUS_LEN = const(17)
+_REG0B = const(0x0B - 0x02)
+_REG0C = const(0x0C - 0x02)
+_REG0E = const(0x0E - 0x02)
+_REG12 = const(0x12 - 0x02)
+# REG0C faults that stop charging: BOOST_FAULT, CHRG_FAULT, BAT_FAULT, and the
+# NTC_FAULT codes cold and hot. The JEITA warm (010) and cool (011) codes only
+# reduce the charge current or voltage and are normal charging conditions.
+_FAULT_MASK = const(0b01111000)
+_NTC_MASK = const(0b00000111)
+_NTC_COLD = const(0b101)
+_NTC_HOT = const(0b110)
+
+
+def is_fault(reg0c) -> bool:
+    """True when a REG0C value reports a fault that stops charging"""
+    ntc = reg0c & _NTC_MASK
+    return bool(reg0c & _FAULT_MASK) or ntc == _NTC_COLD or ntc == _NTC_HOT
+
+
+class ChargeController:
+    def __init__(self, bq, charge_current=128, charge_voltage=4208, cut_off=64,
+                 precharge_current=128, poll_ms=1000, cv_margin_mv=40, log_size=32):
+        self.bq = bq
+        self.charge_current = charge_current
+        self.charge_voltage = charge_voltage
+        self.cut_off = cut_off
+        self.precharge_current = precharge_current
+        self.poll_ms = poll_ms
+        self.cv_margin_mv = cv_margin_mv
+        self.state = IDLE
+        self.fault = 0
+        self.vbat = 0
+        self.ichg = 0
+        self.polls = 0
+        self._running = False
+        self._status = bytearray(_STATUS_LEN)
+        self._timer = None
+        self._update_ref = self._update
+        self._chained_handler = None
+        # transition log, ring buffer
+        self._log_size = log_size
+        self._log_time = array("L", (0 for _ in range(log_size)))
+        self._log_from = bytearray(log_size)
+        self._log_to = bytearray(log_size)
+        self._log_vbat = array("H", (0 for _ in range(log_size)))
+        self._log_ichg = array("H", (0 for _ in range(log_size)))
+        self._log_head = 0
+        self.transitions = 0
+
+    def start(self, timer=None):
+        """Programs the charge parameters, enables charging and starts polling.
+        Without ``timer``, polling is left to ``run()``."""
+        bq = self.bq
+        bq.set_charge_voltage(self.charge_voltage)
+        bq.set_charge_current(self.charge_current)
+        bq.set_current_precharge_limit(self.precharge_current)
+        bq.set_current_cut_off(self.cut_off)
+        bq.set_charging_termination(True)
+        # one-shot ADC, started at every poll
+        bq.set_field(F_CONV_RATE, 0)
+        bq.set_field(F_CONV_START, 1)
+        bq.set_charge_enable(True)
+        bq.flush()
+
+        self._chained_handler = bq._user_handler
+        bq._user_handler = self._on_interrupt
+        self._running = True
+        if timer is not None:
+            self._timer = timer
+            timer.init(period=self.poll_ms, callback=self._on_timer)
+        self._update()
+
+    def stop(self):
+        self._running = False
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+        bq = self.bq
+        bq._user_handler = self._chained_handler
+        bq.set_charge_enable(False)
+        bq.flush()
+        self._set_state(IDLE)
+
+    def _on_timer(self, timer):
+        # timer callbacks may run in IRQ context; the bus is used from the scheduler
+        try:
+            schedule(self._update_ref, None)
+        except RuntimeError:
+            pass  # queue full, the next tick retries
+
+    def _on_interrupt(self, bq):
+        self._update()
+        if self._chained_handler is not None:
+            self._chained_handler(bq)
+
+    async def run(self):
+        """Polling loop for asyncio, instead of a timer. Returns on termination,
+        fault or ``stop()``."""
+        while self._running and self.state not in (DONE, FAULT):
+            await sleep_ms(self.poll_ms)
+            self._update()
+
+    def _update(self, _arg=None):
+        bq = self.bq
+        self.polls += 1
+        # an INT dispatch that could not be scheduled is run now
+        bq.irq_events.poll()
+        status = self._status
+        bq.i2c.readfrom_mem_into(bq.I2CADDR, _REG_FIRST, status)
+        # REG0C latches faults until read: the status block read reports and clears them
+        self.fault = status[_REG0C]
+        # ADC results are valid once CONV_START has cleared
+        if not status[0] & (1 << F_CONV_START[1]):
+            self.vbat = 2304 + (status[_REG0E] & 0x7F) * 20
+            self.ichg = (status[_REG12] & 0x7F) * 50
+            bq.set_field(F_CONV_START, 1)
+            bq.flush()
+
+        chrg_stat = (status[_REG0B] >> 3) & 0b11
+        if is_fault(self.fault):
+            state = FAULT
+        elif chrg_stat == 1:
+            state = PRECHARGE
+        elif chrg_stat == 2:
+            state = CV if self.vbat >= self.charge_voltage - self.cv_margin_mv else CC
+        elif chrg_stat == 3:
+            state = DONE
+        elif self.state in (DONE, FAULT):
+            state = self.state
+        else:
+            state = IDLE
+        self._set_state(state)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        i = self._log_head
+        self._log_time[i] = time.ticks_ms()
+        self._log_from[i] = self.state
+        self._log_to[i] = state
+        self._log_vbat[i] = self.vbat
+        self._log_ichg[i] = self.ichg
+        self._log_head = (i + 1) % self._log_size
+        self.transitions += 1
+        self.state = state
+
+    def state_name(self) -> str:
+        return STATE_NAMES[self.state]
+
+    def print_log(self):
+        count = min(self.transitions, self._log_size)
+        for n in range(count):
+            i = (self._log_head - count + n) % self._log_size
+            print("{:10d} ms {:>9s} -> {:9s} Vbat={:4d} mV Ichg={:4d} mA".format(
+                self._log_time[i], STATE_NAMES[self._log_from[i]], STATE_NAMES[self._log_to[i]],
+                self._log_vbat[i], self._log_ichg[i]))
+        print("state:", self.state_name(), "chip:", CHRG_STAT[(self._status[_REG0B] >> 3) & 0b11],
+              "fault: {:08b}".format(self.fault))
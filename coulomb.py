@@ -0,0 +1,247 @@
+"""
+Coulomb counting on the three INA3221 channels
+
+Every sample reads all channels (``measure_all``) and adds the charge and
+energy of the interval since the previous sample, with the interval measured
+by ``ticks_us``/``ticks_diff`` (trapezoidal rule). Samples are taken from a
+``machine.Timer`` (deferred with ``micropython.schedule``), or from ``run()``
+on an asyncio loop, either at a fixed period or whenever the INA3221 flags a
+finished conversion (CVRF). The INA3221 conversion time times averaging must
+not be longer than the sampling period.
+
+The sums are kept in raw units (shunt ADC counts x us, shunt counts x bus
+counts x us) so a sample adds only integers. Every product is kept below
+2**29 and added into two-limb accumulators (base 2**29) in an ``array('l')``,
+so all intermediate values stay small ints: sampling allocates nothing and
+the totals do not overflow or lose resolution over months. Conversion to
+mAh/mWh (floats) happens only when reading the results.
+
+Example usage:
+    cc = CoulombCounter(ina, period_ms=5)
+    cc.start(machine.Timer(1))
+    ...
+    print(cc.charge_mah(1), cc.energy_mwh(1))
+    print(cc.window_charge_mah(1)); cc.reset_window()
+"""
+
+from array import array
+from micropython import const, schedule
+import time
+from aio import sleep_ms
+from ina3221 import INA3221Measurement, C_SHUNT_ADC_LSB, C_BUS_ADC_LSB
+
+_BASE = const(1 << 29)
+# longest interval added in one step: 2**13 shunt counts x 2**16 us < 2**29
+_MAX_STEP_US = const(0xFFFF)
+# power products (up to 2**25) are split in 12 low and 13 high bits
+_SPLIT = const(12)
+_LOW_MASK = const(0xFFF)
+# accumulators per channel, two limbs each: charge, energy low bits, energy high bits
+_Q = const(0)
+_E_LO = const(2)
+_E_HI = const(4)
+_PER_CHANNEL = const(6)
+_ACC_LEN = const(18)
+
+
+def _add(acc, i, value):
+    """Adds ``value`` (|value| < 2**29) to the two-limb number at ``acc[i]``"""
+    x = acc[i] + value
+    if x >= _BASE:
+        x -= _BASE
+        acc[i + 1] += 1
+    elif x < 0:
+        x += _BASE
+        acc[i + 1] -= 1
+    acc[i] = x
+
+
+def _value(acc, i):
+    return acc[i] + acc[i + 1] * _BASE
+
+
+class CoulombCounter:
+    def __init__(self, ina, period_ms=10):
+        self.ina = ina
+        self.period_ms = period_ms
+        self.shunt_resistor = ina.shunt_resistor
+        self._meas = INA3221Measurement(ina.shunt_resistor)
+        # window accumulators are folded into the totals on reset_window()
+        self._total = array("l", (0 for _ in range(_ACC_LEN)))
+        self._window = array("l", (0 for _ in range(_ACC_LEN)))
+        self._prev_shunt = array("h", (0, 0, 0))
+        self._prev_power = array("l", (0, 0, 0))
+        # sum of (interval - period), two limbs
+        self._drift = array("l", (0, 0))
+        self._last = 0
+        self._primed = False
+        self._running = False
+        self._timer = None
+        self._sample_ref = self.sample
+        self.reset()
+
+    def reset(self):
+        """Clears the totals, the window and the statistics"""
+        for i in range(_ACC_LEN):
+            self._total[i] = 0
+            self._window[i] = 0
+        self._drift[0] = self._drift[1] = 0
+        self._primed = False
+        self.samples = 0
+        self.late = 0
+        self.min_dt_us = 0
+        self.max_dt_us = 0
+        self.window_samples = 0
+        self._start_ms = self._window_ms = time.ticks_ms()
+
+    # sampling
+
+    def sample(self, _arg=None):
+        """Reads all channels and integrates the interval since the last call"""
+        raw = self.ina.measure_all(self._meas).raw
+        now = time.ticks_us()
+        prev_shunt = self._prev_shunt
+        prev_power = self._prev_power
+        if not self._primed:
+            # first sample only sets the starting point
+            self._primed = True
+            self._last = now
+            for ch in range(3):
+                prev_shunt[ch] = raw[2 * ch] >> 3
+                prev_power[ch] = prev_shunt[ch] * (raw[2 * ch + 1] >> 3)
+            return
+        dt = time.ticks_diff(now, self._last)
+        self._last = now
+
+        self.samples += 1
+        self.window_samples += 1
+        if dt < self.min_dt_us or self.samples == 1:
+            self.min_dt_us = dt
+        if dt > self.max_dt_us:
+            self.max_dt_us = dt
+        period_us = self.period_ms * 1000
+        if dt > period_us + (period_us >> 1):
+            self.late += 1
+        late_us = dt - period_us
+        _add(self._drift, 0, late_us if late_us < _BASE else _BASE - 1)
+
+        acc = self._window
+        for ch in range(3):
+            shunt = raw[2 * ch] >> 3
+            power = shunt * (raw[2 * ch + 1] >> 3)
+            # trapezoid: the sums hold twice the integral
+            q = shunt + prev_shunt[ch]
+            p = power + prev_power[ch]
+            prev_shunt[ch] = shunt
+            prev_power[ch] = power
+            i = ch * _PER_CHANNEL
+            rest = dt
+            while rest > 0:
+                step = rest if rest < _MAX_STEP_US else _MAX_STEP_US
+                _add(acc, i + _Q, q * step)
+                _add(acc, i + _E_LO, (p & _LOW_MASK) * step)
+                _add(acc, i + _E_HI, (p >> _SPLIT) * step)
+                rest -= step
+
+    def start(self, timer=None):
+        """Starts sampling every ``period_ms`` from ``timer``; without one,
+        sampling is left to ``run()``"""
+        self._running = True
+        self._primed = False
+        if timer is not None:
+            self._timer = timer
+            timer.init(period=self.period_ms, callback=self._on_timer)
+
+    def stop(self):
+        self._running = False
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+
+    def _on_timer(self, timer):
+        # timer callbacks may run in IRQ context; the bus is used from the scheduler
+        try:
+            schedule(self._sample_ref, None)
+        except RuntimeError:
+            pass  # queue full, the next interval is simply longer
+
+    async def run(self, conversion_ready=False, poll_ms=1):
+        """Sampling loop for asyncio, until ``stop()``. With ``conversion_ready``
+        every finished INA3221 conversion is sampled (CVRF polled every
+        ``poll_ms``), otherwise the loop keeps to ``period_ms``."""
+        self.start()
+        next_ms = time.ticks_ms()
+        while self._running:
+            if conversion_ready:
+                while not self.ina.is_ready:
+                    await sleep_ms(poll_ms)
+            else:
+                next_ms = time.ticks_add(next_ms, self.period_ms)
+                wait = time.ticks_diff(next_ms, time.ticks_ms())
+                if wait < -self.period_ms:
+                    next_ms = time.ticks_ms()  # fell behind, do not catch up
+                await sleep_ms(wait if wait > 0 else 0)
+            self.sample()
+
+    # results
+
+    def _raw(self, acc, ch, window):
+        i = (ch - 1) * _PER_CHANNEL + acc
+        value = _value(self._window, i)
+        if not window:
+            value += _value(self._total, i)
+        return value
+
+    def _charge_as(self, channel, window):
+        q2 = self._raw(_Q, channel, window)
+        return q2 * (C_SHUNT_ADC_LSB / 2e6) / self.shunt_resistor[channel - 1]
+
+    def _energy_j(self, channel, window):
+        e2 = self._raw(_E_LO, channel, window) + (self._raw(_E_HI, channel, window) << _SPLIT)
+        return e2 * (C_SHUNT_ADC_LSB * C_BUS_ADC_LSB / 2e6) / self.shunt_resistor[channel - 1]
+
+    def charge_mah(self, channel=1) -> float:
+        """Charge since ``reset()``, positive when flowing into IN+"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self._charge_as(channel, False) / 3.6
+
+    def energy_mwh(self, channel=1) -> float:
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self._energy_j(channel, False) / 3.6
+
+    def window_charge_mah(self, channel=1) -> float:
+        """Charge since the last ``reset_window()``"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self._charge_as(channel, True) / 3.6
+
+    def window_energy_mwh(self, channel=1) -> float:
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self._energy_j(channel, True) / 3.6
+
+    def window_ms(self) -> int:
+        return time.ticks_diff(time.ticks_ms(), self._window_ms)
+
+    def reset_window(self):
+        """Starts a new window; its sums are kept in the totals"""
+        total = self._total
+        window = self._window
+        for i in range(0, _ACC_LEN, 2):
+            x = total[i] + window[i]
+            carry = 0
+            if x >= _BASE:
+                x -= _BASE
+                carry = 1
+            total[i] = x
+            total[i + 1] += window[i + 1] + carry
+            window[i] = window[i + 1] = 0
+        self.window_samples = 0
+        self._window_ms = time.ticks_ms()
+
+    def drift_ms(self) -> float:
+        """How far the samples have fallen behind the nominal period, in total"""
+        return _value(self._drift, 0) / 1000
+
+    def stats(self) -> str:
+        return "samples={} late={} dt={}..{}us drift={:.1f}ms over {}ms".format(
+            self.samples, self.late, self.min_dt_us, self.max_dt_us, self.drift_ms(),
+            time.ticks_diff(time.ticks_ms(), self._start_ms))
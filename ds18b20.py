@@ -1,22 +1,150 @@
+"""
+DS18B20 temperature sensors sharing one OneWire bus
+
+A conversion is started on every sensor at once with one bus-wide
+``convert_temp``. The results are collected when the sensors report completion
+(or when the conversion time of the slowest configured resolution is over),
+so the caller is free to do other work in between. Readings are stored in a
+preallocated ``array('h')`` in hundredths of a degree Celsius.
+
+Conversion time per resolution: 9 bit 94 ms, 10 bit 188 ms, 11 bit 375 ms,
+12 bit 750 ms.
+
+Example usage:
+    import machine, onewire, ds18b20
+    sensors = ds18b20.DS18B20Bus(onewire.OneWire(machine.Pin(2)))
+    sensors.set_resolution(10)
+    sensors.start()
+    while not sensors.ready():
+        pass  # do something useful
+    sensors.collect()
+    print(sensors.temps)
+"""
+
+from array import array
+from micropython import const
 import time
-import machine
-import onewire
-import ds18x20
-# the device is on GPIO2
-dat = machine.Pin(2)
-# create the onewire object
-ds = ds18x20.DS18X20(onewire.OneWire(dat))
-# scan for devices on the bus
-roms = ds.scan()
-print('found devices:', roms)
-
-# loop 10 times and print all temperatures
-# [bytearray(b'(\x9fEfT$\x06\xeb'), bytearray(b'(LV\x8fT$\x06\x9e'), bytearray(b'(\xb8\x9d\x9dT$\x06]')]
-
-def scan_temperature():
+
+_CMD_SKIP_ROM = const(0xCC)
+_CMD_CONVERT = const(0x44)
+_CMD_READ_SCRATCH = const(0xBE)
+_CMD_WRITE_SCRATCH = const(0x4E)
+_FAMILY_DS18B20 = const(0x28)
+
+NO_READING = const(-32768)
+
+_CONV_TIME_MS = (94, 188, 375, 750)
+
+
+class DS18B20Bus:
+    def __init__(self, ow, roms=None, poll_bus=True):
+        """``poll_bus`` asks the sensors for completion (needs external power,
+        not parasitic); otherwise the full conversion time is waited."""
+        self.ow = ow
+        self.poll_bus = poll_bus
+        self.roms = self.scan() if roms is None else roms
+        self._scratch = bytearray(9)
+        self._started = None
+        self.errors = 0
+        self._alloc()
+
+    def _alloc(self):
+        count = len(self.roms)
+        self.resolution = bytearray(12 for _ in range(count))
+        self.temps = array("h", (NO_READING for _ in range(count)))
+        # pick up the resolution the sensors kept in their EEPROM
+        for i in range(count):
+            if self._read_scratch(self.roms[i]):
+                self.resolution[i] = ((self._scratch[4] >> 5) & 3) + 9
+        self._update_wait()
+
+    def _update_wait(self):
+        self._wait_ms = _CONV_TIME_MS[max(self.resolution) - 9] if self.roms else 0
+
+    def scan(self):
+        """Searches the bus for DS18B20 ROMs. Only needed again when sensors are added."""
+        return [rom for rom in self.ow.scan() if rom[0] == _FAMILY_DS18B20]
+
+    def rescan(self):
+        self.roms = self.scan()
+        self._alloc()
+
+    def _read_scratch(self, rom) -> bool:
+        self.ow.reset(True)
+        self.ow.select_rom(rom)
+        self.ow.writebyte(_CMD_READ_SCRATCH)
+        self.ow.readinto(self._scratch)
+        return self.ow.crc8(self._scratch) == 0
+
+    def set_resolution(self, bits, index=None):
+        """Sets the resolution (9 to 12 bits) of one sensor, or of all of them"""
+        assert 9 <= bits <= 12, "resolution must be 9 to 12 bits"
+        for i, rom in enumerate(self.roms):
+            if index is not None and i != index:
+                continue
+            if not self._read_scratch(rom):
+                raise OSError("DS18B20 scratchpad CRC error")
+            scratch = self._scratch
+            self.ow.reset(True)
+            self.ow.select_rom(rom)
+            self.ow.writebyte(_CMD_WRITE_SCRATCH)
+            self.ow.writebyte(scratch[2])  # TH
+            self.ow.writebyte(scratch[3])  # TL
+            self.ow.writebyte(((bits - 9) << 5) | 0x1F)
+            self.resolution[i] = bits
+        self._update_wait()
+
+    def conversion_time_ms(self) -> int:
+        """Time needed by the slowest sensor on the bus"""
+        return self._wait_ms
+
+    def start(self):
+        """Starts a conversion on all sensors and returns immediately"""
+        self.ow.reset(True)
+        self.ow.writebyte(_CMD_SKIP_ROM)
+        self.ow.writebyte(_CMD_CONVERT)
+        self._started = time.ticks_ms()
+
+    def ready(self) -> bool:
+        """True once the conversion started by ``start()`` is done"""
+        if self._started is None:
+            return False
+        if time.ticks_diff(time.ticks_ms(), self._started) >= self._wait_ms:
+            return True
+        # sensors hold the bus low while converting
+        return self.poll_bus and self.ow.readbit() == 1
+
+    def collect(self):
+        """Reads all sensors into ``temps`` (1/100 degC); failed reads store ``NO_READING``"""
+        self._started = None
+        temps = self.temps
+        for i in range(len(self.roms)):
+            if not self._read_scratch(self.roms[i]):
+                self.errors += 1
+                temps[i] = NO_READING
+                continue
+            raw = self._scratch[0] | (self._scratch[1] << 8)
+            if raw & 0x8000:
+                raw -= 0x10000
+            # the low bits are undefined below 12 bit resolution
+            raw &= ~((1 << (12 - self.resolution[i])) - 1)
+            temps[i] = (raw * 100) >> 4
+        return temps
+
+    def read(self):
+        """Blocking convenience: start, wait, collect"""
+        self.start()
+        while not self.ready():
+            time.sleep_ms(1)
+        return self.collect()
+
+    def celsius(self, index) -> float:
+        return self.temps[index] / 100
+
+
+def scan_temperature(sensors):
     print('temperatures:', end=' ')
-    ds.convert_temp()
-    time.sleep_ms(750)
-    for rom in roms:
-        print(rom, "вывел: ", ds.read_temp(rom), end='\n')
+    sensors.read()
+    for i, rom in enumerate(sensors.roms):
+        print(rom, "вывел: ", sensors.celsius(i), end='\n')
     print("====")
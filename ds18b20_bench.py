@@ -0,0 +1,19 @@
+"""Readings per second of the DS18B20 sensors at each resolution"""
+
+import time
+from ds18b20 import DS18B20Bus
+
+
+def run(sensors, rounds=10):
+    count = len(sensors.roms)
+    for bits in (12, 11, 10, 9):
+        sensors.set_resolution(bits)
+        start = time.ticks_ms()
+        for _ in range(rounds):
+            sensors.read()
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        print("{:2d} bit: {:5d} ms/round {:6.1f} readings/s".format(
+            bits, elapsed // rounds, count * rounds * 1000 / elapsed))
+
+
+# import machine, onewire;from ds18b20_bench import *;run(DS18B20Bus(onewire.OneWire(machine.Pin(2))))
@@ -0,0 +1,304 @@
+"""
+Shared I2C bus manager
+
+``get_bus()`` returns one ``I2CBus`` per bus id, owning the single hardware
+``machine.I2C`` of that bus, so the drivers (``INA3221``, ``BQ25895``...) are
+given the same controller instead of each creating their own. ``I2CBus`` has
+the ``machine.I2C`` transaction API, and counts transactions, bytes and bus
+time (measured with ``ticks_us``) in total and per device address.
+
+Single calls are atomic. Sequences of calls (a register pointer write
+followed by a read, read-modify-write) are serialized by the bus lock:
+* ``with bus:`` in normal code; the lock is reentrant, so drivers may nest it.
+  The drivers take it around their own sequences (``lock()`` gives them a
+  no-op context for a plain ``machine.I2C``).
+* ``async with bus:`` in asyncio tasks, which waits while another task holds
+  the lock across an ``await``. While a task holds it, sync calls from other
+  tasks cannot wait and raise ``OSError(EBUSY)``; tasks sharing the bus with
+  an async holder use ``async with`` as well.
+* ``bus.run(fn, arg)`` (or a handler wrapped by ``bus.guard()``) for work
+  deferred from interrupts with ``micropython.schedule``. A scheduled
+  callback cannot wait for the code it interrupted, so when the bus is
+  locked the call is queued. The queue is drained by a callback scheduled
+  when the lock is released, not inside the transaction that released it;
+  exceptions of queued calls are counted in ``errors`` and printed.
+
+Example usage:
+    i2c = get_bus(0, scl=5, sda=4, freq=400000)
+    ina = INA3221(i2c)
+    bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12, i2c=i2c)
+    print(i2c.stats())
+"""
+
+from array import array
+from machine import I2C, Pin
+from micropython import schedule
+import time
+from aio import sleep_ms, current_task
+
+_buses = {}
+
+
+def get_bus(id=0, scl=None, sda=None, freq=400000):
+    """The manager of bus ``id``; the pins and frequency are used when it is
+    first created. Raises ValueError when the bus exists on other pins."""
+    bus = _buses.get(id)
+    if bus is None:
+        if scl is None:
+            i2c = I2C(id, freq=freq)
+        else:
+            i2c = I2C(id, scl=Pin(scl), sda=Pin(sda), freq=freq)
+        bus = _buses[id] = I2CBus(i2c, freq, pins=(scl, sda))
+    elif scl is not None and (scl, sda) != bus.pins:
+        raise ValueError("I2C bus {} already uses scl={} sda={}".format(id, *bus.pins))
+    return bus
+
+
+class _NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NO_LOCK = _NoLock()
+
+
+def lock(i2c):
+    """Context manager serializing a driver's transaction sequences on ``i2c``:
+    the bus itself for an ``I2CBus``, a no-op for a plain ``machine.I2C``"""
+    return i2c if hasattr(type(i2c), "__enter__") else _NO_LOCK
+
+
+class I2CBus:
+    def __init__(self, i2c, freq=400000, pending=8, pins=(None, None)):
+        """Wraps an existing ``machine.I2C``; use ``get_bus()`` to share it"""
+        self.i2c = i2c
+        self.freq = freq
+        # (scl, sda) given to get_bus(), None for the port's default pins
+        self.pins = pins
+        self._depth = 0
+        # task holding the lock through ``async with``
+        self._owner = None
+        self._pending_fn = [None] * pending
+        self._pending_arg = [None] * pending
+        self._pending = 0
+        self._drain_scheduled = False
+        # bound method created once, scheduling it does not allocate
+        self._drain_ref = self._drain
+        # per address: transactions, bytes, bus time in us
+        self._devices = {}
+        self.names = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_time_us = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.contended = 0
+        self.errors = 0
+        for counters in self._devices.values():
+            counters[0] = counters[1] = counters[2] = 0
+
+    def name(self, addr, label):
+        """Label for the address in ``stats()``"""
+        self.names[addr] = label
+        self._counters(addr)
+
+    def _counters(self, addr):
+        counters = self._devices.get(addr)
+        if counters is None:
+            counters = self._devices[addr] = array("L", (0, 0, 0))
+        return counters
+
+    def device_stats(self, addr):
+        """``(transactions, bytes, bus time in us)`` of one device"""
+        return tuple(self._counters(addr))
+
+    # lock
+
+    def _busy(self):
+        """Raises when another task holds the lock across an ``await``; a sync
+        caller cannot wait for it"""
+        if current_task() is not self._owner:
+            self.contended += 1
+            raise OSError(16)  # EBUSY
+
+    def __enter__(self):
+        if self._owner is not None:
+            self._busy()
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._release()
+
+    async def __aenter__(self):
+        task = current_task()
+        if self._depth and self._owner is not task:
+            self.contended += 1
+            while self._depth:
+                await sleep_ms(0)
+        if not self._depth:
+            self._owner = task
+        self._depth += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release()
+
+    @property
+    def locked(self) -> bool:
+        return self._depth > 0
+
+    def _release(self):
+        self._depth -= 1
+        if self._depth:
+            return
+        self._owner = None
+        if self._pending and not self._drain_scheduled:
+            try:
+                schedule(self._drain_ref, None)
+                self._drain_scheduled = True
+            except RuntimeError:
+                pass  # scheduler queue full: the next release retries
+
+    def _drain(self, _arg):
+        self._drain_scheduled = False
+        if self._depth:
+            return  # locked again: its release schedules the drain
+        # calls queued by run() while locked, in order; calls they queue
+        # themselves are appended and run in the same pass
+        self._depth = 1
+        i = 0
+        try:
+            while i < self._pending:
+                fn = self._pending_fn[i]
+                arg = self._pending_arg[i]
+                i += 1
+                try:
+                    fn(arg)
+                except Exception as e:
+                    self.errors += 1
+                    print("[I2CBus] deferred call: {}".format(e))
+        finally:
+            n = self._pending - i
+            for k in range(len(self._pending_fn)):
+                j = i + k
+                self._pending_fn[k] = self._pending_fn[j] if k < n else None
+                self._pending_arg[k] = self._pending_arg[j] if k < n else None
+            self._pending = n
+            self._depth = 0
+
+    def run(self, fn, arg=None) -> bool:
+        """Calls ``fn(arg)`` with the bus locked, or queues it when the bus is
+        in use. Returns False when the call was queued or dropped."""
+        if self._depth:
+            if self._pending < len(self._pending_fn):
+                self._pending_fn[self._pending] = fn
+                self._pending_arg[self._pending] = arg
+                self._pending += 1
+                self.deferred += 1
+            else:
+                self.dropped += 1
+            return False
+        self._depth += 1
+        try:
+            fn(arg)
+        finally:
+            self._release()
+        return True
+
+    def guard(self, handler):
+        """Wraps a deferred handler (e.g. of ``IRQEvents``) to run through ``run()``"""
+        def guarded(arg):
+            self.run(handler, arg)
+        return guarded
+
+    # transactions
+
+    def _done(self, addr, nbytes, start):
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        counters = self._devices.get(addr)
+        if counters is None:
+            counters = self._counters(addr)
+        counters[0] += 1
+        counters[1] += nbytes
+        counters[2] += elapsed
+        self.transactions += 1
+        self.bytes += nbytes
+        self.bus_time_us += elapsed
+        self._release()
+
+    def scan(self):
+        with self:
+            return self.i2c.scan()
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        if self._owner is not None:
+            self._busy()
+        self._depth += 1
+        start = time.ticks_us()
+        try:
+            if addrsize == 8:
+                self.i2c.readfrom_mem_into(addr, memaddr, buf)
+            else:
+                self.i2c.readfrom_mem_into(addr, memaddr, buf, addrsize=addrsize)
+        finally:
+            self._done(addr, len(buf) + 1, start)
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
+        buf = bytearray(nbytes)
+        self.readfrom_mem_into(addr, memaddr, buf, addrsize=addrsize)
+        return bytes(buf)
+
+    def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
+        if self._owner is not None:
+            self._busy()
+        self._depth += 1
+        start = time.ticks_us()
+        try:
+            if addrsize == 8:
+                self.i2c.writeto_mem(addr, memaddr, buf)
+            else:
+                self.i2c.writeto_mem(addr, memaddr, buf, addrsize=addrsize)
+        finally:
+            self._done(addr, len(buf) + 1, start)
+
+    def writeto(self, addr, buf, stop=True):
+        if self._owner is not None:
+            self._busy()
+        self._depth += 1
+        start = time.ticks_us()
+        try:
+            return self.i2c.writeto(addr, buf, stop)
+        finally:
+            self._done(addr, len(buf), start)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        if self._owner is not None:
+            self._busy()
+        self._depth += 1
+        start = time.ticks_us()
+        try:
+            self.i2c.readfrom_into(addr, buf, stop)
+        finally:
+            self._done(addr, len(buf), start)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        buf = bytearray(nbytes)
+        self.readfrom_into(addr, buf, stop)
+        return bytes(buf)
+
+    def stats(self) -> str:
+        lines = ["I2C: {} transactions, {} bytes, {:.1f} ms bus time at {} kHz, {} deferred, {} dropped, {} errors".format(
+            self.transactions, self.bytes, self.bus_time_us / 1000, self.freq // 1000, self.deferred, self.dropped,
+            self.errors)]
+        for addr in sorted(self._devices):
+            n, nbytes, us = self._devices[addr]
+            lines.append("  0x{:02x} {:10s} {:8d} transactions {:9d} bytes {:9.1f} ms".format(
+                addr, self.names.get(addr, ""), n, nbytes, us / 1000))
+        return "\n".join(lines)
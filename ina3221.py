@@ -38,6 +38,10 @@ Tested with Micropython v1.17 (2021-09-02) on ESP32 DevKitC:
 * ``from ina3221 import INA3221``                 => 6912 bytes
 * ``ina = INA3221(i2c_bus)``                      => 96 bytes
 
+Register reads and writes go through a buffer preallocated at construction and do
+not allocate, so polling the device does not trigger garbage collections. See
+``ina_bench.py`` to measure the bytes allocated per ``read()``.
+
 **Hardware:**
 
 * Device: `INA3221 <http://www.ti.com/product/INA3221>`_ Triple, Low-/High-Side, I2C Out
@@ -46,6 +50,7 @@ Tested with Micropython v1.17 (2021-09-02) on ESP32 DevKitC:
 """
 
 # imports
+from array import array
 from micropython import const
 
 __version__ = "0.0.0-auto.0"
@@ -124,6 +129,8 @@ C_WARNING_FLAG_CH = (None, const(0x0020), const(0x0010), const(0x0008))
 C_POWER_ALERT_FLAG = const(0x0004)
 C_TIMING_ALERT_FLAG = const(0x0002)
 C_CONV_READY_FLAG = const(0x0001)
+# flags that latch until mask/enable is read: critical, summation, warning
+C_ALERT_FLAGS = const(0x03F8)
 
 # Other registers
 C_REG_POWER_VALID_UPPER_LIMIT = const(0x10)
@@ -138,6 +145,107 @@ C_DIE_ID = const(0x3220)
 # General constants
 C_BUS_ADC_LSB = 0.008             # VBus ADC LSB is 8mV
 C_SHUNT_ADC_LSB = 0.00004           # VShunt ADC LSB is 40µV
+C_BUS_ADC_LSB_MV = const(8)
+C_SHUNT_ADC_LSB_UV = const(40)
+
+# optional viper kernels for the batch conversions
+try:
+    import ina_viper as _kernels
+    _kernels.scale_into(array("h", (8,)), array("i", (0,)), 1, array("i", (0, 1, 1, 0, 0, 2)))
+except (ImportError, SyntaxError, NameError):
+    _kernels = None
+
+
+class _NoLock:
+    # like i2cbus.lock() for a plain machine.I2C, without importing the bus
+    # manager (and asyncio) into this driver
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NO_LOCK = _NoLock()
+
+
+def _itemsize(buf) -> int:
+    """Bytes per item of an array, 0 for a list (which holds any int)"""
+    try:
+        mv = memoryview(buf)
+    except TypeError:
+        return 0
+    try:
+        return mv.itemsize
+    except AttributeError:
+        # memoryview without itemsize: the size of one item in bytes
+        return len(bytes(mv[:1]))
+
+
+def _current_scales(shunt_resistor):
+    """Per channel ``(scale, shift)`` for ``current_uA = (counts * scale) >> shift``.
+    ``scale`` stays below 2**17, so with 13-bit shunt counts the product is a
+    small int."""
+    scales = array("i", (0, 0, 0))
+    shifts = bytearray(3)
+    for i in range(3):
+        per_count = C_SHUNT_ADC_LSB_UV / shunt_resistor[i]  # uA per count
+        shift = 0
+        while shift < 24 and per_count * (2 << shift) < (1 << 17):
+            shift += 1
+        scales[i] = round(per_count * (1 << shift))
+        shifts[i] = shift
+    return scales, shifts
+
+
+class INA3221Measurement:
+    """Raw readings of all channels taken in one pass by ``INA3221.measure_all``
+
+    ``raw`` holds the signed shunt and bus registers, interleaved per channel:
+    ``[shunt1, bus1, shunt2, bus2, shunt3, bus3]``. Disabled channels read as 0.
+    The record is meant to be refilled in place by every new measurement.
+    """
+
+    def __init__(self, shunt_resistor=(0.1, 0.1, 0.1)):
+        self.shunt_resistor = shunt_resistor
+        self.config = 0
+        self.raw = array("h", (0, 0, 0, 0, 0, 0))
+        self._ua_scale, self._ua_shift = _current_scales(shunt_resistor)
+
+    def is_channel_enabled(self, channel=1):
+        """Returns if a given channel was enabled at measurement time"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self.config & C_ENABLE_CH[channel] != 0
+
+    def shunt_voltage(self, channel=1):
+        """Returns the channel's shunt voltage in Volts"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self.raw[2 * channel - 2] / 8.0 * C_SHUNT_ADC_LSB
+
+    def current(self, channel=1):
+        """Return's the channel current in Amps"""
+        return self.shunt_voltage(channel) / self.shunt_resistor[channel-1]
+
+    def bus_voltage(self, channel=1):
+        """Returns the channel's bus voltage in Volts"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self.raw[2 * channel - 1] / 8 * C_BUS_ADC_LSB
+
+    def shunt_uv(self, channel=1) -> int:
+        """Returns the channel's shunt voltage in µV, as a small int"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return (self.raw[2 * channel - 2] >> 3) * C_SHUNT_ADC_LSB_UV
+
+    def current_ua(self, channel=1) -> int:
+        """Returns the channel current in µA, as a small int"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        shift = self._ua_shift[channel - 1]
+        return ((self.raw[2 * channel - 2] >> 3) * self._ua_scale[channel - 1] + ((1 << shift) >> 1)) >> shift
+
+    def bus_mv(self, channel=1) -> int:
+        """Returns the channel's bus voltage in mV, as a small int"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return (self.raw[2 * channel - 1] >> 3) * C_BUS_ADC_LSB_MV
 
 
 class INA3221:
@@ -159,23 +267,38 @@ class INA3221:
 
     def write(self, reg, value):
         """Write value in device register"""
-        seq = bytearray([reg, (value >> 8) & 0xFF, value & 0xFF])
-        self.i2c_device.write(seq)
+        buf = self._buf
+        buf[0] = reg
+        buf[1] = (value >> 8) & 0xFF
+        buf[2] = value & 0xFF
+        if self._mem_api:
+            self.i2c_device.writeto_mem(self.i2c_addr, reg, self._buf_data)
+        else:
+            self.i2c_device.writeto(self.i2c_addr, buf)
 
     def read(self, reg):
         """Return value from device register"""
-        buf = bytearray(3)
-        buf[0] = reg
-        self.write_then_readinto(buf, buf, out_end=1, in_start=1)
-        value = (buf[1] << 8) | (buf[2])
+        buf = self._buf
+        if self._mem_api:
+            self.i2c_device.readfrom_mem_into(self.i2c_addr, reg, self._buf_data)
+        else:
+            buf[0] = reg
+            with self._lock:
+                self.i2c_device.writeto(self.i2c_addr, self._buf_reg, False)
+                self.i2c_device.readfrom_into(self.i2c_addr, self._buf_data)
+        value = (buf[1] << 8) | buf[2]
+        if reg == C_REG_MASK_ENABLE:
+            # the read clears the latched alert flags: keep them for INAAlerts
+            self.alert_flags |= value & C_ALERT_FLAGS
         return value
 
     def update(self, reg, mask, value):
         """Read-modify-write value in register"""
-        regvalue = self.read(reg)
-        regvalue &= ~mask
-        value &= mask
-        self.write(reg, regvalue | value)
+        with self._lock:
+            regvalue = self.read(reg)
+            regvalue &= ~mask
+            value &= mask
+            self.write(reg, regvalue | value)
 
     def writeto_then_readfrom(
         self,
@@ -192,15 +315,16 @@ class INA3221:
         """Write data from buffer_out to an address and then
         read data from an address and into buffer_in
         """
-        if out_end:
-            self.i2c_device.writeto(address, buffer_out[out_start:out_end], stop)
-        else:
-            self.i2c_device.writeto(address, buffer_out[out_start:], stop)
-
+        # slice through a memoryview so the output buffer is not copied
         if not in_end:
             in_end = len(buffer_in)
         read_buffer = memoryview(buffer_in)[in_start:in_end]
-        self.i2c_device.readfrom_into(address, read_buffer, stop)
+        with self._lock:
+            if out_end:
+                self.i2c_device.writeto(address, memoryview(buffer_out)[out_start:out_end], stop)
+            else:
+                self.i2c_device.writeto(address, memoryview(buffer_out)[out_start:], stop)
+            self.i2c_device.readfrom_into(address, read_buffer, stop)
 
     def write_then_readinto(
         self,
@@ -253,6 +377,21 @@ class INA3221:
         self.i2c_device = i2c_instance
         self.i2c_addr = i2c_addr
         self.shunt_resistor = shunt_resistor
+        # preallocated register transfer buffer: [reg, msb, lsb]
+        self._buf = bytearray(3)
+        self._buf_reg = memoryview(self._buf)[:1]
+        self._buf_data = memoryview(self._buf)[1:]
+        # machine.I2C and SoftI2C provide the memory API, bare buses only writeto/readfrom_into
+        self._mem_api = hasattr(i2c_instance, "readfrom_mem_into")
+        # an I2CBus keeps other drivers out of pointer write + read and
+        # read-modify-write sequences
+        self._lock = i2c_instance if hasattr(type(i2c_instance), "__enter__") else _NO_LOCK
+        # alert flags seen by any mask/enable read (is_ready polls it), until
+        # INAAlerts takes them
+        self.alert_flags = 0
+        self._snapshot = INA3221Measurement(shunt_resistor)
+        self._ua_scale, self._ua_shift = _current_scales(shunt_resistor)
+        self._kparams = array("i", (0, 0, 0, 0, 0, 0))
         self.write(C_REG_CONFIG,  C_AVERAGING_16_SAMPLES |
                    C_VBUS_CONV_TIME_1MS |
                    C_SHUNT_CONV_TIME_1MS |
@@ -292,6 +431,96 @@ class INA3221:
         # convert to volts - LSB = 8mV
         return value * C_BUS_ADC_LSB
 
+    def shunt_uv(self, channel=1) -> int:
+        """Returns the channel's shunt voltage in µV, without floating point"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return (self._to_signed(self.read(C_REG_SHUNT_VOLTAGE_CH[channel])) >> 3) * C_SHUNT_ADC_LSB_UV
+
+    def current_ua(self, channel=1) -> int:
+        """Returns the channel current in µA, without floating point"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        counts = self._to_signed(self.read(C_REG_SHUNT_VOLTAGE_CH[channel])) >> 3
+        shift = self._ua_shift[channel - 1]
+        return (counts * self._ua_scale[channel - 1] + ((1 << shift) >> 1)) >> shift
+
+    def bus_mv(self, channel=1) -> int:
+        """Returns the channel's bus voltage in mV, without floating point"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return (self._to_signed(self.read(C_REG_BUS_VOLTAGE_CH[channel])) >> 3) * C_BUS_ADC_LSB_MV
+
+    def _batch(self, raw, out, scale, shift, start, step, count, wide=True):
+        in_place = out is None or out is raw
+        src_size = _itemsize(raw)
+        dst_size = src_size if in_place else _itemsize(out)
+        if wide and 0 < dst_size < 4:
+            # a 16-bit result overflows silently (viper) or raises half way
+            raise ValueError("result needs an array('i')")
+        if count is None:
+            count = (len(raw) - start + step - 1) // step
+        rnd = (1 << shift) >> 1
+        # the kernels read 16 or 32-bit sources and write in place or to a
+        # 32-bit array; anything else takes the Python loop
+        if _kernels is not None and (src_size == 2 or src_size == 4) and (in_place or dst_size == 4):
+            params = self._kparams
+            params[0] = start
+            params[1] = step
+            params[2] = scale
+            params[3] = shift
+            params[4] = rnd
+            params[5] = src_size
+            if in_place:
+                return _kernels.scale_in_place(raw, count, params)
+            return _kernels.scale_into(raw, out, count, params)
+        i = start
+        if in_place:
+            for _ in range(count):
+                raw[i] = ((raw[i] >> 3) * scale + rnd) >> shift
+                i += step
+        else:
+            for k in range(count):
+                out[k] = ((raw[i] >> 3) * scale + rnd) >> shift
+                i += step
+        return count
+
+    def batch_current_ua(self, raw, out=None, channel=1, start=0, step=1, count=None) -> int:
+        """Converts raw shunt registers ``raw[start::step]`` of one channel to µA,
+        into ``out`` or in place; the result array must be an ``array('i')``,
+        ``ValueError`` is raised otherwise. Returns the count."""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        return self._batch(raw, out, self._ua_scale[channel - 1], self._ua_shift[channel - 1], start, step, count)
+
+    def batch_shunt_uv(self, raw, out=None, start=0, step=1, count=None) -> int:
+        """Converts raw shunt registers to µV, like ``batch_current_ua``"""
+        return self._batch(raw, out, C_SHUNT_ADC_LSB_UV, 0, start, step, count)
+
+    def batch_bus_mv(self, raw, out=None, start=0, step=1, count=None) -> int:
+        """Converts raw bus registers to mV; in place fits an ``array('h')``"""
+        return self._batch(raw, out, C_BUS_ADC_LSB_MV, 0, start, step, count, False)
+
+    def measure_all(self, result=None):
+        """Reads the config register once, then the shunt and bus registers of
+        every enabled channel once. ``result`` is refilled in place when given,
+        otherwise a new ``INA3221Measurement`` is returned."""
+        if result is None:
+            result = INA3221Measurement(self.shunt_resistor)
+        config = self.read(C_REG_CONFIG)
+        result.config = config
+        raw = result.raw
+        for channel in range(1, 4):
+            index = 2 * channel - 2
+            if config & C_ENABLE_CH[channel]:
+                raw[index] = self._to_signed(self.read(C_REG_SHUNT_VOLTAGE_CH[channel]))
+                raw[index + 1] = self._to_signed(self.read(C_REG_BUS_VOLTAGE_CH[channel]))
+            else:
+                raw[index] = 0
+                raw[index + 1] = 0
+        return result
+
+    def snapshot(self):
+        """Same as ``measure_all`` but refills a record owned by the driver.
+        The returned object is overwritten by the next call."""
+        return self.measure_all(self._snapshot)
+
     def shunt_critical_alert_limit(self, channel=1):
         """Returns the channel's shunt voltage critical alert limit in Volts"""
         assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
@@ -302,9 +531,15 @@ class INA3221:
     def set_shunt_critical_alert_limit(self, channel, voltage):
         """Sets the channel's shunt voltage critical alert limit in Volts"""
         assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
-        value = self._to_unsigned(round(voltage * C_SHUNT_ADC_LSB) * 8)
+        # 13-bit signed limit, clamped to the ADC range (+-163.8mV)
+        value = self._to_unsigned(min(max(round(voltage / C_SHUNT_ADC_LSB), -4096), 4095) * 8)
         self.write(C_REG_CRITICAL_ALERT_LIMIT_CH[channel], value)
 
+    def set_critical_current_limit(self, channel, current):
+        """Sets the channel's critical alert limit as a current in Amps"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        self.set_shunt_critical_alert_limit(channel, current * self.shunt_resistor[channel - 1])
+
     def shunt_warning_alert_limit(self, channel=1):
         """Returns the channel's shunt voltage warning alert limit in Volts"""
         assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
@@ -315,9 +550,15 @@ class INA3221:
     def set_shunt_warning_alert_limit(self, channel, voltage):
         """Sets the channel's shunt voltage warning alert limit in Volts"""
         assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
-        value = self._to_unsigned(round(voltage * C_SHUNT_ADC_LSB) * 8)
+        # 13-bit signed limit, clamped to the ADC range (+-163.8mV)
+        value = self._to_unsigned(min(max(round(voltage / C_SHUNT_ADC_LSB), -4096), 4095) * 8)
         self.write(C_REG_WARNING_ALERT_LIMIT_CH[channel], value)
 
+    def set_warning_current_limit(self, channel, current):
+        """Sets the channel's warning alert limit as a current in Amps"""
+        assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
+        self.set_shunt_warning_alert_limit(channel, current * self.shunt_resistor[channel - 1])
+
     @property
     def is_ready(self):
         """Returns the CVRF (ConVersion Ready Flag) from the mask/enable register """
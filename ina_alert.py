@@ -0,0 +1,163 @@
+"""
+INA3221 over-current alerts
+
+The INA3221 compares every shunt conversion with the channel's critical
+limit and the averaged value with the warning limit, and pulls its
+open-drain CRITICAL/WARNING pins low on a violation. ``INAAlerts`` wires
+those pins to hard interrupts:
+
+* on CRITICAL the shutdown hooks run directly in the interrupt, within
+  microseconds of the edge. They must not allocate or use the I2C bus;
+  ``charge_off`` and ``motor_off`` build hooks that only touch pins/PWM.
+* both pins then defer through ``IRQEvents`` to a handler that decodes the
+  latched flags of all channels from one mask/enable read (which clears
+  them) and calls the user handler. It runs through the bus lock of an
+  ``I2CBus``, so it does not start a transaction inside another sequence.
+
+Every mask/enable read of the driver (``is_ready`` polls it for CVRF) ORs
+the alert flags into ``INA3221.alert_flags``; ``read_flags`` takes those
+too, so flags cleared by a conversion ready poll are not lost.
+
+Reading mask/enable also clears CVRF, so a CVRF driven ``INASampler`` may
+miss a conversion when an alert is decoded.
+
+Example usage:
+    alerts = INAAlerts(ina, critical_pin=Pin(34), warning_pin=Pin(35),
+                       shutdown=(charge_off(bq), motor_off(motor)))
+    alerts.set_current_limits(1, critical=2.0, warning=1.5)
+"""
+
+from array import array
+from machine import Pin, disable_irq, enable_irq
+import time
+from irqevent import IRQEvents
+from ina3221 import C_REG_MASK_ENABLE, C_CRITICAL_LATCH_ENABLE, C_WARNING_LATCH_ENABLE, \
+    C_CRITICAL_FLAG_CH, C_WARNING_FLAG_CH, C_SUM_ALERT_FLAG, C_POWER_ALERT_FLAG, C_TIMING_ALERT_FLAG
+
+
+def charge_off(bq):
+    """Shutdown hook: drives the BQ25895 /CE pin high, which stops charging
+    without an I2C transaction"""
+    pin = bq.not_ce_pin
+
+    def hook():
+        pin.on()
+    return hook
+
+
+def motor_off(motor):
+    """Shutdown hook: stops the L298N (enable PWM to 0, direction pins low)
+    and drops its queued moves"""
+    stop = motor.stop
+
+    def hook():
+        stop()
+    return hook
+
+
+class INAAlerts:
+    def __init__(self, ina, critical_pin=None, warning_pin=None, shutdown=(), handler=None, latch=True):
+        """``shutdown`` is a hook or a tuple of hooks run in the CRITICAL
+        interrupt; ``handler(alerts)`` runs deferred after every alert. With
+        ``latch`` the flags (and pins) stay set until they are read."""
+        self.ina = ina
+        self._hooks = shutdown if isinstance(shutdown, tuple) else (shutdown,)
+        self._user_handler = handler
+        decode = self._decode
+        if hasattr(ina.i2c_device, "guard"):
+            # deferred until a transaction sequence in progress has finished
+            decode = ina.i2c_device.guard(decode)
+        self.events = IRQEvents(decode)
+        self.flags = 0
+        # bit 0 is channel 1
+        self.critical = 0
+        self.warning = 0
+        self.critical_count = array("L", (0, 0, 0))
+        self.warning_count = array("L", (0, 0, 0))
+        self.shutdowns = 0
+        self.shutdown_us = 0
+        self.max_shutdown_us = 0
+
+        bits = C_CRITICAL_LATCH_ENABLE | C_WARNING_LATCH_ENABLE
+        ina.update(C_REG_MASK_ENABLE, bits, bits if latch else 0)
+        if critical_pin is not None:
+            critical_pin.init(Pin.IN, Pin.PULL_UP)
+            critical_pin.irq(trigger=Pin.IRQ_FALLING, handler=self._critical_irq, hard=True)
+        if warning_pin is not None:
+            warning_pin.init(Pin.IN, Pin.PULL_UP)
+            warning_pin.irq(trigger=Pin.IRQ_FALLING, handler=self.events.irq, hard=True)
+        self.critical_pin = critical_pin
+        self.warning_pin = warning_pin
+
+    def set_current_limits(self, channel, critical=None, warning=None):
+        """Sets the channel's alert limits in Amps"""
+        if critical is not None:
+            self.ina.set_critical_current_limit(channel, critical)
+        if warning is not None:
+            self.ina.set_warning_current_limit(channel, warning)
+
+    def _critical_irq(self, pin):
+        # hard interrupt: no allocation, no bus access
+        start = time.ticks_us()
+        for hook in self._hooks:
+            hook()
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        self.shutdown_us = elapsed
+        if elapsed > self.max_shutdown_us:
+            self.max_shutdown_us = elapsed
+        self.shutdowns += 1
+        self.events.irq(pin)
+
+    def read_flags(self) -> int:
+        """Reads and decodes the flags of all channels with one mask/enable read;
+        this clears the latched flags. Flags latched by earlier mask/enable
+        reads of the driver are included and cleared. Returns the register
+        with those flags merged in."""
+        ina = self.ina
+        flags = ina.read(C_REG_MASK_ENABLE)
+        state = disable_irq()
+        flags |= ina.alert_flags
+        ina.alert_flags = 0
+        enable_irq(state)
+        self.flags = flags
+        critical = 0
+        warning = 0
+        for ch in range(1, 4):
+            if flags & C_CRITICAL_FLAG_CH[ch]:
+                critical |= 1 << (ch - 1)
+                self.critical_count[ch - 1] += 1
+            if flags & C_WARNING_FLAG_CH[ch]:
+                warning |= 1 << (ch - 1)
+                self.warning_count[ch - 1] += 1
+        self.critical = critical
+        self.warning = warning
+        return flags
+
+    def _decode(self, events):
+        self.read_flags()
+        if self._user_handler is not None:
+            self._user_handler(self)
+
+    def is_critical(self, channel) -> bool:
+        return bool(self.critical & (1 << (channel - 1)))
+
+    def is_warning(self, channel) -> bool:
+        return bool(self.warning & (1 << (channel - 1)))
+
+    def describe(self) -> str:
+        flags = self.flags
+        parts = ["critical:"] + ["ch{}".format(ch) for ch in range(1, 4) if self.is_critical(ch)]
+        parts += ["warning:"] + ["ch{}".format(ch) for ch in range(1, 4) if self.is_warning(ch)]
+        if flags & C_SUM_ALERT_FLAG:
+            parts.append("sum")
+        if flags & C_POWER_ALERT_FLAG:
+            parts.append("power-valid")
+        if flags & C_TIMING_ALERT_FLAG:
+            parts.append("timing")
+        return " ".join(parts)
+
+    def stats(self) -> str:
+        ev = self.events
+        return "alerts={} shutdowns={} hook<={}us decode latency<={}us critical={} warning={}".format(
+            ev.events, self.shutdowns, self.max_shutdown_us, ev.max_latency_us,
+            list(self.critical_count), list(self.warning_count))
@@ -0,0 +1,98 @@
+"""Benchmarks for the INA3221 register path
+
+``run()`` compares the heap bytes allocated by one ``INA3221.read()`` with the
+previous implementation, which built a fresh ``bytearray`` and sliced the
+output buffer on every call.
+
+``max_rate()`` finds the highest sustainable sample rate of ``INASampler``:
+the registers are read back to back at the fastest conversion setting, and
+the rate is bounded by whichever is slower, the bus or the conversions.
+"""
+
+import gc
+import time
+from array import array
+from ina3221 import INA3221, C_REG_CONFIG, C_REG_SHUNT_VOLTAGE_CH
+from ina_sampler import INASampler
+
+
+def legacy_read(ina, reg):
+    """Register read as done before the preallocated buffer path"""
+    buf = bytearray(3)
+    buf[0] = reg
+    ina.i2c_device.writeto(ina.i2c_addr, buf[0:1], False)
+    ina.i2c_device.readfrom_into(ina.i2c_addr, memoryview(buf)[1:3])
+    return (buf[1] << 8) | (buf[2])
+
+
+def _begin():
+    gc.collect()
+    gc.disable()
+    return gc.mem_alloc()
+
+
+def _report(name, start, count):
+    used = gc.mem_alloc() - start
+    gc.enable()
+    print("{:14s} {:d} bytes/call".format(name, used // count))
+
+
+def run(ina, count=100):
+    reg = C_REG_SHUNT_VOLTAGE_CH[1]
+    value = ina.read(C_REG_CONFIG)
+
+    start = _begin()
+    for _ in range(count):
+        legacy_read(ina, reg)
+    _report("legacy read()", start, count)
+
+    start = _begin()
+    for _ in range(count):
+        ina.read(reg)
+    _report("read()", start, count)
+
+    start = _begin()
+    for _ in range(count):
+        ina.write(C_REG_CONFIG, value)
+    _report("write()", start, count)
+
+
+def _sample_rate(sampler, out, duration_ms, poll):
+    sampler.reset_stats()
+    start = time.ticks_ms()
+    while time.ticks_diff(time.ticks_ms(), start) < duration_ms:
+        if poll:
+            sampler.poll()
+        else:
+            sampler.sample()
+        if sampler.available() >= 32:
+            sampler.drain(out)
+    sampler.drain(out)
+    return sampler.samples * 1000 / time.ticks_diff(time.ticks_ms(), start)
+
+
+def max_rate(ina, duration_ms=2000, channels=(1, 2, 3), bus=True):
+    """Prints the samples per second per channel, reading back to back and
+    polling CVRF, against the conversion rate"""
+    sampler = INASampler(ina, channels, size=64, bus=bus)
+    conversions = sampler.configure(1000000)
+    out = array("h", (0 for _ in range(32 * sampler.width)))
+    i2c = ina.i2c_device
+    for poll in (False, True):
+        if hasattr(i2c, "reset_stats"):
+            i2c.reset_stats()
+        rate = _sample_rate(sampler, out, duration_ms, poll)
+        line = "{:11s} {} ch{}: {:7.0f} samples/s, conversions {:7.0f}/s".format(
+            "CVRF polled" if poll else "back2back", len(channels), "+bus" if bus else "", rate, conversions)
+        if hasattr(i2c, "bus_time_us"):
+            # simulated bus: the wire time alone, as on the board at the same clock;
+            # one register read per transaction, plus the CVRF read when polling
+            per_sample = i2c.bus_time_us / i2c.transactions * (sampler.width + poll)
+            wire = 1000000 / per_sample
+            line += ", bus bound {:7.0f}/s at {} kHz".format(wire, i2c.freq // 1000)
+            rate = wire
+        print(line + " -> sustainable {:7.0f}/s".format(min(rate, conversions)))
+
+
+# from ina_test import ina1;from ina_bench import run;run(ina1)
+# from ina_test import ina1;from ina_bench import max_rate;max_rate(ina1)
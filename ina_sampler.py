@@ -0,0 +1,192 @@
+"""
+Continuous INA3221 sampling into a ring buffer
+
+``configure()`` picks the averaging and conversion times that fill, but do
+not exceed, the sampling period of a target rate, so every sample is a fresh
+and as quiet as possible conversion. Samples are taken when the conversion
+ready flag (CVRF) is seen by ``poll()``/``run()``, or from a
+``machine.Timer``; each one stores the raw signed shunt (and bus) registers
+of the selected channels into a preallocated ``array('h')`` ring, with its
+``ticks_us`` timestamp. When the ring is full new samples are dropped and
+counted as overruns. Consumers take the samples in batches with ``drain()``.
+
+The INA3221 registers are read one transaction each; on a 400 kHz bus that
+bounds the sample rate, see ``ina_bench.max_rate()``.
+
+Example usage:
+    sampler = INASampler(ina, channels=(1, 2), size=512)
+    rate = sampler.configure(500)
+    sampler.start(machine.Timer(2))
+    ...
+    n = sampler.drain(batch)  # batch = array('h', 64 * sampler.width)
+"""
+
+from array import array
+from micropython import const, schedule
+import time
+from aio import sleep_ms
+from ina3221 import C_REG_CONFIG, C_REG_SHUNT_VOLTAGE_CH, C_REG_BUS_VOLTAGE_CH, C_ENABLE_CH, \
+    C_MODE_SHUNT_AND_BUS_CONTINOUS, C_MODE_SHUNT_VOLTAGE_CONTINUOUS
+
+# conversion time per CT field value in us, and averages per AVG field value
+CONV_TIME_US = (140, 204, 332, 588, 1100, 2116, 4156, 8244)
+AVERAGES = (1, 4, 16, 64, 128, 256, 512, 1024)
+
+_AVG_SHIFT = const(9)
+_VBUS_CT_SHIFT = const(6)
+_VSH_CT_SHIFT = const(3)
+
+
+class INASampler:
+    def __init__(self, ina, channels=(1, 2, 3), size=256, bus=True):
+        """``size`` samples of one shunt register (and with ``bus`` one bus
+        register) per channel in ``channels``"""
+        self.ina = ina
+        self.channels = channels
+        self.bus = bus
+        regs = []
+        for ch in channels:
+            regs.append(C_REG_SHUNT_VOLTAGE_CH[ch])
+            if bus:
+                regs.append(C_REG_BUS_VOLTAGE_CH[ch])
+        self._regs = tuple(regs)
+        self.width = len(regs)
+        self.size = size
+        self.buf = array("h", (0 for _ in range(size * self.width)))
+        self.ts = array("L", (0 for _ in range(size)))
+        self._head = 0
+        self._tail = 0
+        self._running = False
+        self._timer = None
+        self._sample_ref = self.sample
+        self.conversion_us = 0
+        self._last = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.samples = 0
+        self.overruns = 0
+        self.missed = 0
+
+    def index(self, channel, bus=False) -> int:
+        """Position of a channel's shunt (or bus) register within a sample"""
+        i = self.channels.index(channel)
+        if bus and not self.bus:
+            raise ValueError("bus registers are not sampled")
+        return i * 2 + 1 if bus else i * (2 if self.bus else 1)
+
+    def configure(self, rate_hz) -> float:
+        """Enables the selected channels in continuous mode with the longest
+        averaging x conversion time that still completes ``rate_hz`` cycles
+        per second. Returns the resulting conversion rate in Hz."""
+        period_us = 1000000 / rate_hz
+        per_conv = len(self.channels) * (2 if self.bus else 1)
+        # without a fit, the fastest setting
+        cycle, avg, ct = CONV_TIME_US[0] * per_conv, 0, 0
+        for a in range(len(AVERAGES)):
+            for c in range(len(CONV_TIME_US)):
+                t = AVERAGES[a] * CONV_TIME_US[c] * per_conv
+                if cycle < t <= period_us:
+                    cycle, avg, ct = t, a, c
+        config = (avg << _AVG_SHIFT) | (ct << _VBUS_CT_SHIFT) | (ct << _VSH_CT_SHIFT)
+        config |= C_MODE_SHUNT_AND_BUS_CONTINOUS if self.bus else C_MODE_SHUNT_VOLTAGE_CONTINUOUS
+        for ch in self.channels:
+            config |= C_ENABLE_CH[ch]
+        self.ina.write(C_REG_CONFIG, config)
+        self.conversion_us = cycle
+        return 1000000 / cycle
+
+    # producer
+
+    def sample(self, _arg=None):
+        """Reads the selected registers into the ring"""
+        head = self._head
+        nxt = head + 1
+        if nxt == self.size:
+            nxt = 0
+        if nxt == self._tail:
+            self.overruns += 1
+            return
+        ina = self.ina
+        buf = self.buf
+        i = head * self.width
+        for reg in self._regs:
+            value = ina.read(reg)
+            buf[i] = value - 0x10000 if value & 0x8000 else value
+            i += 1
+        now = time.ticks_us()
+        self.ts[head] = now
+        # a gap of more than one and a half conversions lost one
+        if self.conversion_us and self.samples and \
+                time.ticks_diff(now, self._last) > self.conversion_us + (self.conversion_us >> 1):
+            self.missed += 1
+        self._last = now
+        self.samples += 1
+        self._head = nxt
+
+    def poll(self) -> bool:
+        """Takes a sample if a conversion has completed since the last poll"""
+        if not self.ina.is_ready:
+            return False
+        self.sample()
+        return True
+
+    async def run(self, poll_ms=0):
+        """CVRF driven sampling on asyncio, until ``stop()``"""
+        self._running = True
+        while self._running:
+            self.poll()
+            await sleep_ms(poll_ms)
+
+    def start(self, timer, rate_hz=None):
+        """Samples from ``timer`` at ``rate_hz``, by default the conversion rate"""
+        self._running = True
+        self._timer = timer
+        if rate_hz is None:
+            rate_hz = 1000000 // self.conversion_us if self.conversion_us else 100
+        timer.init(freq=rate_hz, callback=self._on_timer)
+
+    def stop(self):
+        self._running = False
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+
+    def _on_timer(self, timer):
+        # timer callbacks may run in IRQ context; the bus is used from the scheduler
+        try:
+            schedule(self._sample_ref, None)
+        except RuntimeError:
+            self.overruns += 1
+
+    # consumer
+
+    def available(self) -> int:
+        n = self._head - self._tail
+        return n + self.size if n < 0 else n
+
+    def drain(self, out, ts=None) -> int:
+        """Moves up to ``len(out) // width`` samples into ``out`` (an
+        ``array('h')``), and their timestamps into ``ts`` when given. Returns
+        the number of samples moved."""
+        width = self.width
+        count = min(self.available(), len(out) // width)
+        tail = self._tail
+        buf = self.buf
+        j = 0
+        for n in range(count):
+            i = tail * width
+            for k in range(width):
+                out[j + k] = buf[i + k]
+            if ts is not None:
+                ts[n] = self.ts[tail]
+            j += width
+            tail += 1
+            if tail == self.size:
+                tail = 0
+        self._tail = tail
+        return count
+
+    def stats(self) -> str:
+        return "samples={} overruns={} missed={} queued={}".format(
+            self.samples, self.overruns, self.missed, self.available())
@@ -3,9 +3,10 @@
 from bqv3 import *
 import time
 import sys
-from machine import Pin, SoftI2C
 from ina3221 import *
-i2c_bus = SoftI2C(scl=Pin(5), sda=Pin(4), freq=400000)
+from i2cbus import get_bus
+# hardware I2C, shared with the BQ25895
+i2c_bus = get_bus(0, scl=5, sda=4, freq=400000)
 ina1 = INA3221(i2c_bus)
 # ina2 = INA3221(i2c_bus, 65)
 # change configuration (requires 'full' version of the lib)
@@ -35,7 +36,7 @@ ina1.update(reg=C_REG_CONFIG,
 
 
 # enable all 3 channels. You can comment (#) a line to disable one
-# bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12)
+# bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12, i2c=i2c_bus)
 
 ina1.enable_channel(1)
 ina1.enable_channel(2)
@@ -62,12 +63,13 @@ def show_ina(ina3221):
         line_shunt_voltage = "Shunt voltage "
         line_current = "Current       "
 
+        measurement = ina3221.snapshot()
         for chan in range(1, 4):
-            if ina3221.is_channel_enabled(chan):
+            if measurement.is_channel_enabled(chan):
                 #
-                bus_voltage = ina3221.bus_voltage(chan)
-                shunt_voltage = ina3221.shunt_voltage(chan)
-                current = ina3221.current(chan)
+                bus_voltage = measurement.bus_voltage(chan)
+                shunt_voltage = measurement.shunt_voltage(chan)
+                current = measurement.current(chan)
                 #
                 line_title += "| Chan#{:d}      ".format(chan)
                 # line_psu_voltage += "| {:6.3f}  mV ".format((bus_voltage + shunt_voltage) * 1000)
@@ -83,4 +85,4 @@ def show_ina(ina3221):
 
         time.sleep(2.0)
 
-# from ina_test import *;bq.set_charge_enable(True);show_ina(ina1)
\ No newline at end of file
+# from ina_test import *;bq.set_charge_enable(True);bq.flush();show_ina(ina1)
\ No newline at end of file
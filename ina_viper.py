@@ -0,0 +1,73 @@
+"""
+Viper kernels for the ``ina3221`` batch conversions
+
+Kept in a module of their own: a port built without the native emitter
+rejects ``@micropython.viper`` when the module is compiled, and ``ina3221``
+then falls back to plain Python loops.
+
+Both kernels convert raw signed registers with
+``value = ((raw >> 3) * scale + round) >> shift``; ``params`` is an
+``array('i')`` of ``[start, step, scale, shift, round, source item size]``.
+The source is read with ``ptr16`` (``array('h')``) or, for an item size of
+4, with ``ptr32`` (``array('i')``); a ``ptr16`` over 32-bit items would
+read and write their halves.
+"""
+
+import micropython
+
+
+@micropython.viper
+def scale_into(src, dst, n: int, params) -> int:
+    """``dst[k] = f(src[start + k * step])`` for ``k < n``, ``dst`` 32-bit (``array('i')``)"""
+    d = ptr32(dst)
+    p = ptr32(params)
+    i = p[0]
+    step = p[1]
+    scale = p[2]
+    shift = p[3]
+    rnd = p[4]
+    k = 0
+    if p[5] == 4:
+        s32 = ptr32(src)
+        while k < n:
+            d[k] = ((s32[i] >> 3) * scale + rnd) >> shift
+            i += step
+            k += 1
+        return n
+    s = ptr16(src)
+    while k < n:
+        v = s[i]
+        if v & 0x8000:
+            v -= 0x10000
+        d[k] = ((v >> 3) * scale + rnd) >> shift
+        i += step
+        k += 1
+    return n
+
+
+@micropython.viper
+def scale_in_place(buf, n: int, params) -> int:
+    """Same conversion written back over the source, 16 or 32-bit"""
+    p = ptr32(params)
+    i = p[0]
+    step = p[1]
+    scale = p[2]
+    shift = p[3]
+    rnd = p[4]
+    k = 0
+    if p[5] == 4:
+        s32 = ptr32(buf)
+        while k < n:
+            s32[i] = ((s32[i] >> 3) * scale + rnd) >> shift
+            i += step
+            k += 1
+        return n
+    s = ptr16(buf)
+    while k < n:
+        v = s[i]
+        if v & 0x8000:
+            v -= 0x10000
+        s[i] = ((v >> 3) * scale + rnd) >> shift
+        i += step
+        k += 1
+    return n
@@ -0,0 +1,139 @@
+"""
+Deferred interrupt processing
+
+``IRQEvents.irq`` is meant to be attached to ``Pin.irq`` (``hard=True``). It only
+stores a ``ticks_us`` timestamp into a preallocated ring buffer and requests a
+dispatch, either through ``micropython.schedule`` or by setting an asyncio
+``ThreadSafeFlag``. The handler then runs in normal context where it may use
+the I2C bus, print and allocate.
+
+Events arriving while a dispatch is still pending are coalesced into that
+dispatch; the handler sees them as one batch. Events that do not fit in the
+ring buffer are counted as dropped.
+
+Example usage with asyncio:
+    flag = asyncio.ThreadSafeFlag()
+    events = IRQEvents(handler, flag=flag)
+    pin.irq(trigger=Pin.IRQ_FALLING, handler=events.irq, hard=True)
+    asyncio.create_task(events.run())
+"""
+
+from array import array
+from machine import disable_irq, enable_irq
+from micropython import schedule
+import time
+
+
+class IRQEvents:
+    def __init__(self, handler, size=16, flag=None):
+        self._handler = handler
+        self._flag = flag
+        self._size = size
+        self._stamps = array("L", (0 for _ in range(size)))
+        self._head = 0
+        self._count = 0
+        self._pending = False
+        self._retry = False
+        # bound method created once, creating it in the IRQ would allocate
+        self._dispatch_ref = self._dispatch
+        # current batch, valid while the handler runs
+        self.batch_start = 0
+        self.batch_len = 0
+        # counters
+        self.events = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.dispatched = 0
+        self.schedule_errors = 0
+        self.last_latency_us = 0
+        self.max_latency_us = 0
+        self.last_handler_us = 0
+        self.max_handler_us = 0
+
+    def irq(self, pin):
+        """Interrupt stub: timestamp the event and request a dispatch"""
+        now = time.ticks_us()
+        self.events += 1
+        if self._count < self._size:
+            self._stamps[self._head] = now
+            self._head = (self._head + 1) % self._size
+            self._count += 1
+        else:
+            self.dropped += 1
+        if self._pending and not self._retry:
+            self.coalesced += 1
+            return
+        self._pending = True
+        if self._flag is not None:
+            self._flag.set()
+            return
+        try:
+            schedule(self._dispatch_ref, None)
+            self._retry = False
+        except RuntimeError:
+            # scheduler queue full: the dispatch stays pending, retried by the
+            # next event or by poll()
+            self._retry = True
+            self.schedule_errors += 1
+
+    def poll(self) -> bool:
+        """Runs a dispatch whose scheduling failed; call it from a periodic
+        task so a lost dispatch does not wait for the next edge"""
+        if not self._retry:
+            return False
+        self._dispatch()
+        return True
+
+    def stamp(self, index):
+        """Returns the ``ticks_us`` timestamp of event ``index`` of the current batch"""
+        return self._stamps[(self.batch_start + index) % self._size]
+
+    def _dispatch(self, _arg=None):
+        state = disable_irq()
+        count = self._count
+        start = (self._head - count) % self._size
+        self._count = 0
+        self._pending = False
+        self._retry = False
+        enable_irq(state)
+        if not count:
+            return
+
+        self.batch_start = start
+        self.batch_len = count
+        begin = time.ticks_us()
+        latency = time.ticks_diff(begin, self._stamps[start])
+        self.last_latency_us = latency
+        if latency > self.max_latency_us:
+            self.max_latency_us = latency
+
+        self._handler(self)
+
+        self.dispatched += 1
+        duration = time.ticks_diff(time.ticks_us(), begin)
+        self.last_handler_us = duration
+        if duration > self.max_handler_us:
+            self.max_handler_us = duration
+
+    async def run(self):
+        """Dispatch loop for the ``ThreadSafeFlag`` mode"""
+        while True:
+            await self._flag.wait()
+            self._dispatch()
+
+    def reset_stats(self):
+        self.events = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.dispatched = 0
+        self.schedule_errors = 0
+        self.last_latency_us = 0
+        self.max_latency_us = 0
+        self.last_handler_us = 0
+        self.max_handler_us = 0
+
+    def stats(self) -> str:
+        return "events={} dispatched={} coalesced={} dropped={} schedule_errors={} latency={}/{}us handler={}/{}us".format(
+            self.events, self.dispatched, self.coalesced, self.dropped, self.schedule_errors,
+            self.last_latency_us, self.max_latency_us,
+            self.last_handler_us, self.max_handler_us)
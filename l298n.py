@@ -24,35 +24,131 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from machine import Pin
+from array import array
+from machine import disable_irq, enable_irq
+from micropython import const
 import time
+from aio import sleep_ms
+
+DIRECTIONS = ('STOP', 'FORWARD', 'BACKWARD')
+_STOP = const(0)
+_FORWARD = const(1)
+_BACKWARD = const(2)
+_MAX_DUTY = const(65535)
 
 
 class L298N:
-    def __init__(self, ENA, IN1):
+    """One channel of the L298N: ``ENA`` is a ``machine.PWM`` on the enable
+    input, ``IN1``/``IN2`` the direction ``Pin`` objects.
+
+    Timed moves (``forwardFor``, ``backwardFor``, ``runFor``, ``move``) go
+    into a command queue and return at once. They are carried out by the
+    motion engine, which also applies the speed ramps: ``tick()`` called
+    every ``period_ms``, from a ``machine.Timer`` (``begin(timer)``) or an
+    asyncio task (``drive()``). ``tick()`` only touches the pins and the PWM
+    and allocates nothing. While the engine runs with a ramp, a change of
+    direction (queued or by ``forward()``/``backward()``) ramps down to 0
+    first; without it the direction changes at once. The queue and the move
+    state are changed with interrupts disabled, so commands may come from
+    the main program while the timer runs the engine.
+
+    Example usage:
+        motor = L298N(PWM(Pin(25)), Pin(26, Pin.OUT), Pin(27, Pin.OUT), accel=200000)
+        motor.begin(Timer(3))
+        motor.forwardFor(2)
+        motor.move('BACKWARD', 1500, speed=30000)
+    """
+
+    def __init__(self, ENA, IN1, IN2, freq=15000, accel=None, period_ms=10, queue_size=8):
+        """``accel`` in duty (0-65535) per second, None switches the speed at once"""
         self.IN1 = IN1
+        self.IN2 = IN2
         self.pwm = ENA
+        # set once, reprogramming the frequency restarts the PWM period
+        self.pwm.freq(freq)
         self.speed = 40000
         self.ismoving = False
         self.direction = 'STOP'
         self.time = 0
+        self.period_ms = period_ms
+        self.setRamp(accel)
+        self.running = False
+        self._timer = None
+        self._duty = 0
+        self._target = 0
+        self._pins = _STOP
+        # current move: direction, timed, end; a reversal waits in _pending_dir
+        self._move_dir = _STOP
+        self._timed = False
+        self._end = 0
+        self._pending_dir = -1
+        self._pending_speed = 0
+        self._pending_ms = 0
+        # command queue, ring buffer
+        self._q_dir = bytearray(queue_size)
+        self._q_speed = array('H', (0 for _ in range(queue_size)))
+        self._q_ms = array('L', (0 for _ in range(queue_size)))
+        self._q_head = 0
+        self._q_len = 0
+        self.IN1.value(0)
+        self.IN2.value(0)
+        self.pwm.duty_u16(0)
+
+    # immediate control
+
+    def _set_pins(self, code):
+        self.IN1.value(1 if code == _FORWARD else 0)
+        self.IN2.value(1 if code == _BACKWARD else 0)
+        self._pins = code
+        self.direction = DIRECTIONS[code]
+        self.ismoving = code != _STOP
+
+    def _set_duty(self, duty):
+        self._duty = duty
+        self.pwm.duty_u16(duty)
+
+    def _go(self, code):
+        state = disable_irq()
+        self.clear()
+        self._pending_dir = -1
+        if not self._ramp_down(code, self.speed, 0):
+            self._timed = False
+            self._move_dir = code
+            self._set_pins(code)
+            self._target = self.speed
+            if self._step is None or not self.running:
+                self._set_duty(self.speed)
+        enable_irq(state)
 
     def forward(self):
-        self.IN1.value(1)
-        self.IN2.value(0)
-        self.ismoving = True
-        self.direction = 'FORWARD'
+        self._go(_FORWARD)
+
+    def backward(self):
+        self._go(_BACKWARD)
 
     def stop(self):
-        self.IN1.value(0)
-        self.IN2.value(0)
-        self.ismoving = False
-        self.Direction = 'STOP'
+        """Stops at once and drops the queued moves; safe in a hard interrupt"""
+        state = disable_irq()
+        self._q_len = 0
+        self._pending_dir = -1
+        self._timed = False
+        self._move_dir = _STOP
+        self._target = 0
+        self._set_duty(0)
+        self._set_pins(_STOP)
+        enable_irq(state)
 
     def setSpeed(self, speed):
-        self.pwm.freq(15000)
+        """Duty (0-65535) of the current and following moves, reached along the ramp"""
         self.speed = speed
-        self.pwm.duty_u16(speed)
+        if self._move_dir != _STOP:
+            self._target = speed
+            if self._step is None or not self.running:
+                self._set_duty(speed)
+
+    def setRamp(self, accel):
+        self.accel = accel
+        self._step = None if accel is None else max(1, accel * self.period_ms // 1000)
 
     def getSpeed(self):
         return self.speed
@@ -61,49 +157,147 @@ class L298N:
         return self.direction
 
     def run(self, direction):
-        self.direction = direction
-        if self.direction == 'FORWARD':
+        if direction == 'FORWARD':
             self.forward()
-        elif self.direction == 'BACKWARD':
+        elif direction == 'BACKWARD':
             self.backward()
-        elif self.direction == 'STOP':
+        elif direction == 'STOP':
             self.stop()
-        else:
-            pass
+
+    # queued moves
+
+    def move(self, direction, time_ms=0, speed=None) -> bool:
+        """Queues a move of ``time_ms`` (0: until the next command) at ``speed``
+        (default ``self.speed``). Returns False when the queue is full."""
+        code = DIRECTIONS.index(direction)
+        size = len(self._q_dir)
+        state = disable_irq()
+        if self._q_len == size:
+            enable_irq(state)
+            return False
+        i = (self._q_head + self._q_len) % size
+        self._q_dir[i] = code
+        self._q_speed[i] = self.speed if speed is None else speed
+        self._q_ms[i] = time_ms
+        self._q_len += 1
+        if not self._timed and self._pending_dir < 0:
+            # an untimed move lasts until the next command
+            self._next()
+        enable_irq(state)
+        return True
 
     def forwardFor(self, Time):
+        """Queues ``Time`` seconds forward, then a stop"""
         self.time = Time
-        self.forward()
-        time.sleep(self.time)
-        self.stop()
+        return self.move('FORWARD', int(Time * 1000))
 
     def backwardFor(self, Time):
         self.time = Time
-        self.backward()
-        time.sleep(self.time)
-        self.stop()
+        return self.move('BACKWARD', int(Time * 1000))
 
     def runFor(self, direction, Time):
-        self.direction = direction
         self.time = Time
-        if self.direction == 'FORWARD':
-            self.forward()
-            time.sleep(self.time)
-            self.stop()
-        elif self.direction == 'BACKWARD':
-            self.backward()
-            time.sleep(self.time)
-            self.stop()
-        elif self.direction == 'STOP':
-            self.stop()
-            time.sleep(self.time)
-        else:
-            pass
+        return self.move(direction, int(Time * 1000))
+
+    def clear(self):
+        """Drops the queued moves, the current one continues"""
+        self._q_len = 0
+
+    def queued(self) -> int:
+        return self._q_len
+
+    def isIdle(self) -> bool:
+        """Nothing queued, no timed move running and the motor stopped"""
+        return not self._q_len and not self._timed and self._pending_dir < 0 and not self.ismoving
 
-    def isMoving(self):
-        if self.ismoving == True:
-            print('True')
-        elif self.ismoving == False:
-            print('False')
+    def isMoving(self) -> bool:
+        return self.ismoving
+
+    # motion engine
+
+    def _start(self, code, speed, ms):
+        self._move_dir = code
+        self._timed = ms > 0
+        self._end = time.ticks_add(time.ticks_ms(), ms)
+        self._target = speed if code != _STOP else 0
+        if code != _STOP:
+            self._set_pins(code)
+        if self._step is None or not self.running:
+            self._set_duty(self._target)
+            if code == _STOP:
+                self._set_pins(_STOP)
+
+    def _ramp_down(self, code, speed, ms) -> bool:
+        """Makes a reversal while the motor turns wait for the ramp down to 0,
+        when the engine runs a ramp. Returns False when it can start now."""
+        if code == _STOP or self._pins == _STOP or code == self._pins or not self._duty:
+            return False
+        if self._step is None or not self.running:
+            return False
+        self._pending_dir = code
+        self._pending_speed = speed
+        self._pending_ms = ms
+        self._move_dir = _STOP
+        self._timed = False
+        self._target = 0
+        return True
+
+    def _next(self):
+        """Starts the next queued move, or stops when there is none; called
+        with interrupts disabled"""
+        if self._q_len:
+            i = self._q_head
+            code = self._q_dir[i]
+            speed = self._q_speed[i]
+            ms = self._q_ms[i]
+            self._q_head = (i + 1) % len(self._q_dir)
+            self._q_len -= 1
         else:
-            pass
+            code, speed, ms = _STOP, 0, 0
+        if not self._ramp_down(code, speed, ms):
+            self._start(code, speed, ms)
+
+    def tick(self, _timer=None):
+        """One engine step: ends timed moves and moves the duty along the ramp"""
+        state = disable_irq()
+        if self._timed and time.ticks_diff(time.ticks_ms(), self._end) >= 0:
+            self._timed = False
+            self._next()
+        duty = self._duty
+        target = self._target
+        if duty != target:
+            step = self._step
+            if step is None or abs(target - duty) <= step:
+                duty = target
+            else:
+                duty += step if target > duty else -step
+            self._set_duty(duty)
+        if duty == 0 and self._move_dir == _STOP:
+            if self._pending_dir >= 0:
+                code = self._pending_dir
+                self._pending_dir = -1
+                self._start(code, self._pending_speed, self._pending_ms)
+            elif self._pins != _STOP:
+                self._set_pins(_STOP)
+        enable_irq(state)
+
+    def begin(self, timer):
+        """Runs the engine from ``timer``"""
+        self.running = True
+        self._timer = timer
+        timer.init(period=self.period_ms, callback=self.tick)
+
+    def end(self):
+        """Stops the engine, from a timer or ``drive()``; the motor is stopped"""
+        self.running = False
+        if self._timer is not None:
+            self._timer.deinit()
+            self._timer = None
+        self.stop()
+
+    async def drive(self):
+        """Runs the engine on asyncio, until ``end()``"""
+        self.running = True
+        while self.running:
+            self.tick()
+            await sleep_ms(self.period_ms)
@@ -0,0 +1,59 @@
+"""
+Scheduling throughput of the async drivers against the simulated devices
+
+Runs INA3221 sampling, BQ25895 ADC polling and a motor task on one asyncio
+loop and prints the per-task deadline accounting. Runs on a PC:
+    python3 sched_bench.py [seconds] [ina_period_ms]
+"""
+
+import sys
+import sim
+
+sim.install()
+
+from machine import Pin, PWM
+from aio import asyncio
+from adrivers import AsyncINA3221, AsyncBQ25895, AsyncL298N
+from bqv3 import BQ25895
+from i2cbus import get_bus
+from l298n import L298N
+from ina3221 import INA3221, INA3221Measurement, C_REG_CONFIG, C_AVERAGING_MASK, C_AVERAGING_NONE
+from scheduler import Scheduler
+from sim.bqsim import BQ25895Sim
+from sim.inasim import INA3221Sim
+
+
+def run(duration_s=5, ina_period_ms=10):
+    i2c = get_bus(0, scl=5, sda=4)
+    ina_sim = i2c.i2c.attach(0x40, INA3221Sim())
+    ina_sim.set_channel(1, bus_voltage=4.1, current=0.5)
+    ina_sim.set_channel(2, bus_voltage=5.0, current=0.1)
+    i2c.i2c.attach(0x6A, BQ25895Sim(int_pin=Pin(14), adc_time=0.05))
+    i2c.name(0x40, "INA3221")
+    i2c.name(0x6A, "BQ25895")
+
+    ina = INA3221(i2c)
+    # __init__ leaves the channels disabled; all three make a full measure_all()
+    for ch in (1, 2, 3):
+        ina.enable_channel(ch)
+    ina.update(C_REG_CONFIG, C_AVERAGING_MASK, C_AVERAGING_NONE)
+    bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12, i2c=i2c)
+    aina = AsyncINA3221(ina)
+    abq = AsyncBQ25895(bq)
+    motor = L298N(PWM(Pin(25)), Pin(26, Pin.OUT), Pin(27, Pin.OUT), accel=400000)
+    amotor = AsyncL298N(motor)
+    result = INA3221Measurement()
+
+    sched = Scheduler()
+    sched.add("ina", lambda: aina.measure_all(result), ina_period_ms)
+    sched.add("bq", abq.charge_current, 1000)
+    # a 300 ms move with ramps every second, sampling has to keep its deadlines
+    sched.add("motor", lambda: amotor.run_for('FORWARD', 300), 1000)
+    i2c.reset_stats()
+    asyncio.run(sched.run(duration_s * 1000))
+    sched.report()
+    print(i2c.stats())
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:]])
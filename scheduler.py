@@ -0,0 +1,116 @@
+"""
+Periodic task scheduler on one asyncio loop
+
+Each task runs at its own period. A run that finishes later than its deadline
+(by default one period after its release time) counts as a deadline miss;
+periods that are skipped entirely because a task fell behind are counted too.
+
+Example usage:
+    sched = Scheduler()
+    sched.add("ina", lambda: ina.measure_all(result), 10)
+    sched.add("temp", sensors.aread, 1000)
+    asyncio.run(sched.run(60000))
+    sched.report()
+"""
+
+from aio import asyncio, sleep_ms, ticks_ms, ticks_diff, ticks_add, is_awaitable
+
+
+class Task:
+    def __init__(self, name, func, period_ms, deadline_ms=None):
+        self.name = name
+        self.func = func
+        self.period_ms = period_ms
+        self.deadline_ms = period_ms if deadline_ms is None else deadline_ms
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.runs = 0
+        self.misses = 0
+        self.skipped = 0
+        self.errors = 0
+        self.max_late_ms = 0
+        self.max_run_ms = 0
+        self.total_run_ms = 0
+
+    def __str__(self):
+        return "{:10s} period={:5d}ms runs={:6d} misses={:4d} skipped={:4d} errors={:3d} late<={:4d}ms run<={:4d}ms".format(
+            self.name, self.period_ms, self.runs, self.misses, self.skipped, self.errors,
+            self.max_late_ms, self.max_run_ms)
+
+
+class Scheduler:
+    def __init__(self):
+        self.tasks = []
+        self._running = False
+        self._aws = []
+
+    def add(self, name, func, period_ms, deadline_ms=None) -> Task:
+        """Registers ``func`` (plain or ``async``) to run every ``period_ms``"""
+        task = Task(name, func, period_ms, deadline_ms)
+        self.tasks.append(task)
+        if self._running:
+            self._aws.append(asyncio.create_task(self._loop(task)))
+        return task
+
+    async def _loop(self, task):
+        release = ticks_ms()
+        while self._running:
+            start = ticks_ms()
+            late = ticks_diff(start, release)
+            if late > task.max_late_ms:
+                task.max_late_ms = late
+
+            try:
+                result = task.func()
+                if is_awaitable(result):
+                    await result
+            except Exception as e:
+                task.errors += 1
+                print("[Scheduler] {}: {}".format(task.name, e))
+
+            end = ticks_ms()
+            run = ticks_diff(end, start)
+            task.runs += 1
+            task.total_run_ms += run
+            if run > task.max_run_ms:
+                task.max_run_ms = run
+            if ticks_diff(end, release) > task.deadline_ms:
+                task.misses += 1
+
+            # next release; periods that are already over are skipped, not run back to back
+            release = ticks_add(release, task.period_ms)
+            behind = ticks_diff(end, release)
+            if behind >= task.period_ms:
+                skip = behind // task.period_ms
+                task.skipped += skip
+                release = ticks_add(release, skip * task.period_ms)
+            wait = ticks_diff(release, ticks_ms())
+            await sleep_ms(wait if wait > 0 else 0)
+
+    def start(self):
+        """Creates one asyncio task per registered task; must be called from a running loop"""
+        self._running = True
+        self._aws = [asyncio.create_task(self._loop(task)) for task in self.tasks]
+
+    def stop(self):
+        self._running = False
+        for aw in self._aws:
+            aw.cancel()
+        self._aws = []
+
+    async def run(self, duration_ms=None):
+        """Runs all tasks, for ``duration_ms`` or until ``stop()``"""
+        self.start()
+        try:
+            if duration_ms is None:
+                while self._running:
+                    await sleep_ms(100)
+            else:
+                await sleep_ms(duration_ms)
+        finally:
+            self.stop()
+
+    def report(self):
+        for task in self.tasks:
+            print(task)
@@ -0,0 +1,160 @@
+"""
+SDCard driver benchmarks
+
+``run()`` measures sustained writeblocks throughput against the simulated
+card, with and without pre-erasing (ACMD23, ``pre_erase``), and compares the
+write path with the previous one, which polled the busy card with
+``spi.read(1, 0xFF)`` and allocated a bytes object per poll.
+Runs on a PC:
+    python3 sd_bench.py [blocks] [busy_polls]
+
+``crc_penalty(sd)`` also runs on the board against a real card and reports
+the cost of CRC verified reads. ``remount(spi, cs)`` compares a cold
+initialisation (card parameters unknown) with a warm one and ``log_rate(sd, ...)``
+reports the sustained rate of the raw block log, on either.
+"""
+
+import os
+import sys
+import time
+
+try:
+    import machine
+except ImportError:
+    import sim
+    sim.install()
+
+from machine import Pin
+import sdcard
+from sdcard import SDCard
+
+_BAUDRATE = 20000000
+
+
+def legacy_write(sd, token, buf):
+    """Block write as done before the allocation-free path"""
+    sd.cs(0)
+    sd.spi.read(1, token)
+    sd.spi.write(buf)
+    sd.spi.write(b"\xff")
+    sd.spi.write(b"\xff")
+    if (sd.spi.read(1, 0xFF)[0] & 0x1F) != 0x05:
+        sd.cs(1)
+        sd.spi.write(b"\xff")
+        return
+    while sd.spi.read(1, 0xFF)[0] == 0:
+        pass
+    sd.cs(1)
+    sd.spi.write(b"\xff")
+
+
+def measure(name, sd, card, blocks, per_call):
+    buf = bytearray(512 * per_call)
+    card.reset_stats()
+    sd.max_busy_us = sd.total_busy_us = sd.blocks_written = 0
+    start = time.perf_counter()
+    for block in range(0, blocks, per_call):
+        sd.writeblocks(block, buf)
+    elapsed = time.perf_counter() - start
+    bus_s = card.bus_time_us / 1000000
+    print("{:26s} {:6.2f} MB/s on the bus {:7.1f} SPI allocs/block {:6d} us max busy".format(
+        name, blocks * 512 / bus_s / 1e6, card.allocs / blocks, sd.max_busy_us))
+    return elapsed
+
+
+def _read_us(sd, blocks, nblocks):
+    buf = bytearray(512 * nblocks)
+    start = time.ticks_us()
+    for block in range(0, blocks, nblocks):
+        sd.readblocks(block, buf)
+    return time.ticks_diff(time.ticks_us(), start)
+
+
+def crc_penalty(sd, blocks=64, nblocks=8):
+    """Read throughput with and without CRC verification, and the CRC cost alone"""
+    verify = sd.verify_reads
+    sd.verify_reads = False
+    plain = _read_us(sd, blocks, nblocks)
+    sd.verify_reads = True
+    verified = _read_us(sd, blocks, nblocks)
+    sd.verify_reads = verify
+    buf = bytearray(512)
+    start = time.ticks_us()
+    for _ in range(blocks):
+        sdcard._crc16(buf)
+    crc = time.ticks_diff(time.ticks_us(), start)
+    print("plain read:    {:8.3f} MB/s".format(blocks * 512 / plain))
+    print("verified read: {:8.3f} MB/s ({:+.1f}%)".format(blocks * 512 / verified, (verified - plain) * 100 / plain))
+    print("crc16:         {:8d} us/block".format(crc // blocks))
+
+
+def remount(spi, cs, count=5, **kwargs):
+    """Initialisation time of an unknown card, then of the same card once its
+    parameters are cached (RTC memory and ``PARAMS_FILE``)"""
+    rtc = SDCard.USE_RTC and sdcard.RTC is not None
+    if rtc:
+        SDCard.forget_rtc()
+    try:
+        os.remove(SDCard.PARAMS_FILE)
+    except OSError:
+        pass
+    sd = SDCard(spi, cs, **kwargs)
+    print("cold init: {:8d} us".format(sd.init_us))
+    total = 0
+    for _ in range(count):
+        sd = SDCard(spi, cs, **kwargs)
+        assert sd.warm
+        total += sd.init_us
+    print("warm init: {:8d} us (mean of {}, {})".format(
+        total // count, count, "RTC memory" if rtc else "flash"))
+    return sd
+
+
+def log_rate(sd, start, count, records=31 * 64):
+    """Sustained ``blocklog`` rate: records logged and written per second"""
+    import blocklog
+    log = blocklog.BlockLog(sd, start, count)
+    log.format()
+    begin = time.ticks_us()
+    for i in range(records):
+        log.log(blocklog.SRC_INA3221, 0, i & 0x7FFF, i, 0)
+        log.service()
+    log.flush()
+    elapsed = time.ticks_diff(time.ticks_us(), begin)
+    print("blocklog: {:8.0f} records/s, {}".format(records * 1000000 / elapsed, log.stats()))
+
+
+def run(blocks=256, busy_polls=200):
+    import tempfile
+    from sim.sdsim import SDCardSim
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/sd.img"
+        # keep the card parameters away from the host's root directory
+        SDCard.PARAMS_FILE = tmp + "/sdcard.cfg"
+        SDCardSim.create(path, 8192)
+        cs = Pin(15)
+        card = SDCardSim(path, cs, busy_polls=busy_polls)
+        sd = SDCard(card, cs, baudrate=_BAUDRATE)
+
+        measure("writeblocks x1", sd, card, blocks, 1)
+        measure("writeblocks x8", sd, card, blocks, 8)
+        sd.acmd23 = False
+        measure("writeblocks x8 no ACMD23", sd, card, blocks, 8)
+        sd.acmd23 = True
+        sd.pre_erase(0, blocks)
+        measure("writeblocks x1 pre-erased", sd, card, blocks, 1)
+        sd.write = lambda token, buf: legacy_write(sd, token, buf)
+        measure("legacy writeblocks x1", sd, card, blocks, 1)
+        measure("legacy writeblocks x8", sd, card, blocks, 8)
+        print()
+        crc_penalty(SDCard(card, cs, baudrate=_BAUDRATE, crc=True))
+        print()
+        remount(card, cs, baudrate=_BAUDRATE)
+        print()
+        log_rate(SDCard(card, cs, baudrate=_BAUDRATE), 4096, 1024)
+        card.close()
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:]])
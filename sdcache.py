@@ -0,0 +1,148 @@
+"""
+Write-back LRU sector cache for a block device such as ``sdcard.SDCard``
+
+``BlockCache`` has the same ``readblocks``/``writeblocks``/``ioctl`` interface
+as the device it wraps, so it can be mounted in its place. FAT keeps
+re-reading and rewriting the same FAT and directory sectors on every small
+append; with the cache these hit RAM and reach the card only when evicted or
+on sync (``ioctl`` op 3, i.e. ``os.sync()``/file close).
+
+Transfers larger than half the cache bypass it, so a big sequential read or
+write does not flush the FAT sectors out.
+
+Example usage:
+    sd = sdcard.SDCard(machine.SPI(1), machine.Pin(15))
+    cache = sdcache.BlockCache(sd, 16)
+    os.mount(cache, '/sd')
+"""
+
+from array import array
+from micropython import const
+
+_BLOCK = const(512)
+_NO_BLOCK = const(-1)
+
+
+class BlockCache:
+    def __init__(self, dev, nblocks=8):
+        self.dev = dev
+        self._nblocks = nblocks
+        self._data = bytearray(nblocks * _BLOCK)
+        self._mv = memoryview(self._data)
+        self._tag = array("l", (_NO_BLOCK for _ in range(nblocks)))
+        self._used = array("L", (0 for _ in range(nblocks)))
+        self._dirty = bytearray(nblocks)
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def _find(self, block):
+        tag = self._tag
+        for slot in range(self._nblocks):
+            if tag[slot] == block:
+                return slot
+        return _NO_BLOCK
+
+    def _touch(self, slot):
+        self._clock += 1
+        self._used[slot] = self._clock
+
+    def _writeback(self, slot):
+        offset = slot * _BLOCK
+        self.dev.writeblocks(self._tag[slot], self._mv[offset: offset + _BLOCK])
+        self._dirty[slot] = 0
+        self.writebacks += 1
+
+    def _slot(self, block, load):
+        """Returns the slot holding ``block``, evicting the least recently used one on a miss"""
+        slot = self._find(block)
+        if slot != _NO_BLOCK:
+            self.hits += 1
+            self._touch(slot)
+            return slot
+        self.misses += 1
+        slot = 0
+        oldest = self._used[0]
+        for i in range(self._nblocks):
+            if self._tag[i] == _NO_BLOCK:
+                slot = i
+                break
+            if self._used[i] < oldest:
+                oldest = self._used[i]
+                slot = i
+        if self._tag[slot] != _NO_BLOCK:
+            self.evictions += 1
+            if self._dirty[slot]:
+                self._writeback(slot)
+        self._tag[slot] = _NO_BLOCK
+        if load:
+            offset = slot * _BLOCK
+            self.dev.readblocks(block, self._mv[offset: offset + _BLOCK])
+        self._tag[slot] = block
+        self._touch(slot)
+        return slot
+
+    def readblocks(self, block_num, buf):
+        nblocks = len(buf) // _BLOCK
+        mv = memoryview(buf)
+        if nblocks > self._nblocks // 2:
+            self.dev.readblocks(block_num, buf)
+            # cached copies may be newer than the card
+            for slot in range(self._nblocks):
+                index = self._tag[slot] - block_num
+                if self._dirty[slot] and 0 <= index < nblocks:
+                    mv[index * _BLOCK: (index + 1) * _BLOCK] = self._mv[slot * _BLOCK: (slot + 1) * _BLOCK]
+            return
+        for i in range(nblocks):
+            offset = self._slot(block_num + i, True) * _BLOCK
+            mv[i * _BLOCK: (i + 1) * _BLOCK] = self._mv[offset: offset + _BLOCK]
+
+    def writeblocks(self, block_num, buf):
+        nblocks = len(buf) // _BLOCK
+        mv = memoryview(buf)
+        if nblocks > self._nblocks // 2:
+            self.dev.writeblocks(block_num, buf)
+            # keep cached copies in step, they are now clean
+            for slot in range(self._nblocks):
+                index = self._tag[slot] - block_num
+                if self._tag[slot] != _NO_BLOCK and 0 <= index < nblocks:
+                    self._mv[slot * _BLOCK: (slot + 1) * _BLOCK] = mv[index * _BLOCK: (index + 1) * _BLOCK]
+                    self._dirty[slot] = 0
+            return
+        for i in range(nblocks):
+            slot = self._slot(block_num + i, False)
+            offset = slot * _BLOCK
+            self._mv[offset: offset + _BLOCK] = mv[i * _BLOCK: (i + 1) * _BLOCK]
+            self._dirty[slot] = 1
+
+    def flush(self):
+        """Writes all dirty sectors back, in ascending block order"""
+        while True:
+            slot = _NO_BLOCK
+            for i in range(self._nblocks):
+                if self._dirty[i] and (slot == _NO_BLOCK or self._tag[i] < self._tag[slot]):
+                    slot = i
+            if slot == _NO_BLOCK:
+                return
+            self._writeback(slot)
+
+    def invalidate(self, block=None):
+        """Forgets one cached block, or all of them (dirty data is lost)"""
+        for slot in range(self._nblocks):
+            if block is None or self._tag[slot] == block:
+                self._tag[slot] = _NO_BLOCK
+                self._dirty[slot] = 0
+
+    def ioctl(self, op, arg):
+        if op == 2 or op == 3:  # shutdown, sync
+            self.flush()
+            return 0
+        if op == 6:  # block erase
+            self.invalidate(arg)
+        return self.dev.ioctl(op, arg)
+
+    def stats(self) -> str:
+        return "hits={} misses={} evictions={} writebacks={}".format(
+            self.hits, self.misses, self.evictions, self.writebacks)
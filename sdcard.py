@@ -14,16 +14,24 @@ Example usage on ESP8266:
     os.listdir('/')
 """
 
+from array import array
 from micropython import const
+import binascii
+import struct
 import time
 
+try:
+    from machine import RTC
+except ImportError:
+    RTC = None
+
 
 _CMD_TIMEOUT = const(100)
 
 _R1_IDLE_STATE = const(1 << 0)
 # R1_ERASE_RESET = const(1 << 1)
 _R1_ILLEGAL_COMMAND = const(1 << 2)
-# R1_COM_CRC_ERROR = const(1 << 3)
+_R1_COM_CRC_ERROR = const(1 << 3)
 # R1_ERASE_SEQUENCE_ERROR = const(1 << 4)
 # R1_ADDRESS_ERROR = const(1 << 5)
 # R1_PARAMETER_ERROR = const(1 << 6)
@@ -31,21 +39,119 @@ _TOKEN_CMD25 = const(0xFC)
 _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
 
+# ACMD41 poll interval and overall timeout; a known card is polled faster
+_INIT_TIMEOUT_MS = const(5000)
+_COLD_POLL_MS = const(50)
+_WARM_POLL_MS = const(1)
+
+# erase busy timeout: base plus one allowance per 4 MB allocation unit
+_ERASE_TIMEOUT_MS = const(250)
+_ERASE_AU_BLOCKS = const(8192)
+
+# card parameters kept in RTC memory across deep sleep: magic, CID, baud rate, cdv, sectors
+_RTC_MAGIC = b"SDp1"
+_RTC_FORMAT = "<4s16sIHI"
+
+# SPI clocks tried by tune_baudrate(), up to the 25 MHz default speed mode
+BAUDRATES = (1320000, 4000000, 8000000, 12000000, 16000000, 20000000, 25000000)
+
+
+
+def _make_crc_tables():
+    crc16 = array("H", (0 for _ in range(256)))
+    crc7 = bytearray(256)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        crc16[i] = crc & 0xFFFF
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x12) if crc & 0x80 else (crc << 1)
+        crc7[i] = crc & 0xFF
+    return crc16, crc7
+
+
+# byte-wise lookup tables: CRC16-CCITT for data blocks, CRC7 (shifted left by
+# one bit) for commands
+_CRC16_TABLE, _CRC7_TABLE = _make_crc_tables()
+
+
+def _crc16(buf):
+    """CRC16-CCITT (XModem) as used for SD data blocks"""
+    crc = 0
+    table = _CRC16_TABLE
+    for byte in buf:
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
+def _crc7(buf, n):
+    """CRC7 of the first ``n`` bytes, returned as the command's last byte (with end bit)"""
+    crc = 0
+    table = _CRC7_TABLE
+    for i in range(n):
+        crc = table[crc ^ buf[i]]
+    return crc | 1
+
 
 class SDCard:
-    def __init__(self, spi, cs, baudrate=1320000):
+    # parameters of known cards (baud rate, addressing, size), on the internal flash
+    PARAMS_FILE = "/sdcard.cfg"
+    # also keep the last card's parameters in RTC memory, which survives deep
+    # sleep. Opt-in, since the application may use RTC memory itself; only the
+    # 30 bytes from RTC_OFFSET on are changed.
+    USE_RTC = False
+    RTC_OFFSET = 0
+
+    def __init__(self, spi, cs, baudrate=1320000, busy_timeout_ms=500, autotune=False, crc=False):
+        """With ``autotune`` the SPI clock is negotiated with ``tune_baudrate``
+        on first use of a card and reused from ``PARAMS_FILE`` afterwards.
+        With ``crc`` the card checks commands and written data (CMD59) and
+        every read block is verified; mismatches raise ``OSError(EIO)``.
+
+        A card seen before (same CID in RTC memory or ``PARAMS_FILE``) is
+        remounted without reading its CSD; ``warm`` tells which path was taken
+        and ``init_us`` how long the initialisation took."""
         self.spi = spi
         self.cs = cs
+        self.crc = crc
+        self.verify_reads = crc
+        self.crc_errors = 0
+        self._crc_on = False
+        self.busy_timeout_ms = busy_timeout_ms
+        self.baudrate = baudrate
+        self.cid = None
+        self.warm = False
+        self.init_us = 0
+        self._params = None
+        # the parameters of this card differ from the saved ones
+        self._changed = False
+        # pre-erase count before multiple block writes, dropped if the card refuses it
+        self.acmd23 = True
+
+        # busy time of the card after each written block
+        self.busy_us = 0
+        self.max_busy_us = 0
+        self.total_busy_us = 0
+        self.blocks_written = 0
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.crcbuf = bytearray(2)
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
 
         # initialise the card
+        start = time.ticks_us()
         self.init_card(baudrate)
+        if autotune:
+            self.autotune()
+        # one write of new parameters, after tuning
+        self._store()
+        self.init_us = time.ticks_diff(time.ticks_us(), start)
 
     def init_spi(self, baudrate):
         try:
@@ -69,6 +175,9 @@ class SDCard:
         for i in range(16):
             self.spi.write(b"\xff")
 
+        # CMD0 turns CRC checking off on the card
+        self._crc_on = False
+
         # CMD0: init card; should return _R1_IDLE_STATE (allow 5 attempts)
         for _ in range(5):
             if self.cmd(0, 0, 0x95) == _R1_IDLE_STATE:
@@ -76,15 +185,48 @@ class SDCard:
         else:
             raise OSError("no SD card")
 
+        # a card seen before is likely to come up again; poll it more often
+        if self._params is None:
+            self._params = self._load_params()
+        poll_ms = _WARM_POLL_MS if self._params else _COLD_POLL_MS
+
         # CMD8: determine card version
         r = self.cmd(8, 0x01AA, 0x87, 4)
         if r == _R1_IDLE_STATE:
-            self.init_card_v2()
+            self.init_card_v2(poll_ms)
         elif r == (_R1_IDLE_STATE | _R1_ILLEGAL_COMMAND):
-            self.init_card_v1()
+            self.init_card_v1(poll_ms)
         else:
             raise OSError("couldn't determine SD card version")
 
+        # the CID tells whether the size is already known
+        self.read_cid()
+        known = self._params.get(self._key())
+        self.warm = known is not None and known[1] == self.cdv and known[2] != 0
+        if self.warm:
+            self.sectors = known[2]
+        else:
+            self._read_csd()
+
+        # CMD59: turn CRC checking on
+        if self.crc:
+            self._crc_on = True
+            if self.cmd(59, 1, 0) != 0:
+                self._crc_on = False
+                raise OSError("SD card refused CRC mode")
+
+        # CMD16: set block length to 512 bytes
+        if self.cmd(16, 512, 0) != 0:
+            raise OSError("can't set 512 block size")
+
+        # set to high data rate now that it's initialised
+        self.init_spi(baudrate)
+        self.baudrate = baudrate
+
+        if not self.warm:
+            self._remember(known[0] if known else 0)
+
+    def _read_csd(self):
         # get the number of sectors
         # CMD9: response R2 (R1 byte + 16-byte block read)
         if self.cmd(9, 0, 0, 0, False) != 0:
@@ -103,16 +245,159 @@ class SDCard:
             raise OSError("SD card CSD format not supported")
         # print('sectors', self.sectors)
 
-        # CMD16: set block length to 512 bytes
-        if self.cmd(16, 512, 0) != 0:
-            raise OSError("can't set 512 block size")
+    def read_cid(self):
+        """Reads the card identification register (CMD10)"""
+        if self.cmd(10, 0, 0, 0, False) != 0:
+            raise OSError("no response from SD card")
+        cid = bytearray(16)
+        self.readinto(cid)
+        self.cid = bytes(cid)
+        return self.cid
+
+    def check_crc(self, buf):
+        """Checks ``buf`` against the CRC16 received with it by the last ``readinto``"""
+        return _crc16(buf) == (self.crcbuf[0] << 8 | self.crcbuf[1])
+
+    def tune_baudrate(self, candidates=BAUDRATES, block=0, reads=8, verbose=True):
+        """Steps the SPI clock up through ``candidates`` and keeps the fastest rate
+        at which ``reads`` CRC checked reads of ``block`` all succeed. Returns
+        ``(baudrate, MB/s)`` for every rate that passed."""
+        buf = bytearray(512)
+        ref = bytearray(512)
+        self.init_spi(candidates[0])
+        self.readblocks(block, ref)
+        if not self.check_crc(ref):
+            raise OSError("SD card CRC error at {} Hz".format(candidates[0]))
+        results = []
+        best = candidates[0]
+        for rate in candidates:
+            self.init_spi(rate)
+            try:
+                start = time.ticks_us()
+                for _ in range(reads):
+                    self.readblocks(block, buf)
+                    if buf != ref or not self.check_crc(buf):
+                        raise OSError(5)  # EIO
+                elapsed = time.ticks_diff(time.ticks_us(), start)
+            except OSError:
+                if verbose:
+                    print("[SDCard] {:9d} Hz: failed".format(rate))
+                break
+            mbps = reads * 512 / max(elapsed, 1)
+            results.append((rate, mbps))
+            best = rate
+            if verbose:
+                print("[SDCard] {:9d} Hz: {:.3f} MB/s".format(rate, mbps))
+        self.init_spi(best)
+        self.baudrate = best
+        return results
+
+    def autotune(self):
+        """Uses the baud rate saved for this card, negotiating and saving it on first use"""
+        if self.cid is None:
+            self.read_cid()
+        if self._params is None:
+            self._params = self._load_params()
+        known = self._params.get(self._key())
+        if known is not None and known[0]:
+            self.init_spi(known[0])
+            self.baudrate = known[0]
+            return
+        self.tune_baudrate(verbose=False)
+        self._remember(self.baudrate)
+        self._store()
+
+    def _key(self):
+        return binascii.hexlify(self.cid).decode()
+
+    def _remember(self, baudrate):
+        """Records this card's parameters; a baud rate of 0 means not negotiated yet"""
+        entry = (baudrate, self.cdv, self.sectors)
+        key = self._key()
+        if self._params.get(key) != entry:
+            self._params[key] = entry
+            self._changed = True
+
+    def _store(self):
+        """Saves the parameters if ``_remember`` changed them"""
+        if not self._changed:
+            return
+        self._changed = False
+        self._save_params(self._params)
+        self._save_rtc(self._params[self._key()][0])
 
-        # set to high data rate now that it's initialised
-        self.init_spi(baudrate)
+    def _load_params(self):
+        """Known cards by hexlified CID: ``(baudrate, cdv, sectors)``"""
+        params = {}
+        try:
+            with open(self.PARAMS_FILE) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 4:
+                        params[fields[0]] = (int(fields[1]), int(fields[2]), int(fields[3]))
+                    elif len(fields) == 2:
+                        # baud rate only, size still to be read from the CSD
+                        params[fields[0]] = (int(fields[1]), 0, 0)
+        except OSError:
+            pass
+        # RTC memory is faster to read and works without the flash filesystem
+        rtc = self._load_rtc()
+        if rtc is not None:
+            params[rtc[0]] = rtc[1:]
+        return params
 
-    def init_card_v1(self):
-        for i in range(_CMD_TIMEOUT):
-            time.sleep_ms(50)
+    def _save_params(self, params):
+        try:
+            with open(self.PARAMS_FILE, "w") as f:
+                for key in params:
+                    baudrate, cdv, sectors = params[key]
+                    f.write("{} {} {} {}\n".format(key, baudrate, cdv, sectors))
+        except OSError:
+            pass  # read-only or no filesystem; RTC memory may still hold them
+
+    def _load_rtc(self):
+        if not self.USE_RTC or RTC is None:
+            return None
+        try:
+            data = RTC().memory()
+        except (AttributeError, OSError):
+            return None
+        offset = self.RTC_OFFSET
+        if len(data) < offset + struct.calcsize(_RTC_FORMAT) or data[offset:offset + 4] != _RTC_MAGIC:
+            return None
+        _, cid, baudrate, cdv, sectors = struct.unpack_from(_RTC_FORMAT, data, offset)
+        return binascii.hexlify(cid).decode(), baudrate, cdv, sectors
+
+    def _save_rtc(self, baudrate):
+        if not self.USE_RTC or RTC is None:
+            return
+        self._write_rtc(struct.pack(_RTC_FORMAT, _RTC_MAGIC, self.cid, baudrate, self.cdv, self.sectors))
+
+    @classmethod
+    def forget_rtc(cls):
+        """Clears the card parameters kept in RTC memory"""
+        if RTC is not None:
+            cls._write_rtc(bytes(struct.calcsize(_RTC_FORMAT)))
+
+    @classmethod
+    def _write_rtc(cls, record):
+        # read-modify-write, the rest of RTC memory belongs to the application
+        try:
+            rtc = RTC()
+            data = bytearray(rtc.memory())
+            end = cls.RTC_OFFSET + len(record)
+            if len(data) < end:
+                data.extend(bytes(end - len(data)))
+            data[cls.RTC_OFFSET:end] = record
+            rtc.memory(data)
+        except (AttributeError, OSError, ValueError):
+            pass
+
+    def init_card_v1(self, poll_ms=_COLD_POLL_MS):
+        # a deadline, not a poll count: every poll also costs command time
+        deadline = time.ticks_add(time.ticks_ms(), _INIT_TIMEOUT_MS)
+        while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+            time.sleep_ms(poll_ms)
             self.cmd(55, 0, 0)
             if self.cmd(41, 0, 0) == 0:
                 # SDSC card, uses byte addressing in read/write/erase commands
@@ -121,9 +406,10 @@ class SDCard:
                 return
         raise OSError("timeout waiting for v1 card")
 
-    def init_card_v2(self):
-        for i in range(_CMD_TIMEOUT):
-            time.sleep_ms(50)
+    def init_card_v2(self, poll_ms=_COLD_POLL_MS):
+        deadline = time.ticks_add(time.ticks_ms(), _INIT_TIMEOUT_MS)
+        while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+            time.sleep_ms(poll_ms)
             self.cmd(58, 0, 0, 4)
             self.cmd(55, 0, 0)
             if self.cmd(41, 0x40000000, 0) == 0:
@@ -145,11 +431,11 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
-        buf[5] = crc
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
+        buf[5] = _crc7(buf, 5) if self._crc_on else crc
         self.spi.write(buf)
 
         if skip1:
@@ -197,41 +483,69 @@ class SDCard:
         self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.readinto(self.crcbuf, 0xFF)
 
         self.cs(1)
         self.spi.write(b"\xff")
 
+        if self.verify_reads and not self.check_crc(buf):
+            self.crc_errors += 1
+            raise OSError(5)  # EIO
+
+    def wait_busy(self, timeout_ms=0):
+        """Polls until the card releases DO after a write; returns the busy time in us"""
+        tokenbuf = self.tokenbuf
+        timeout_us = (timeout_ms or self.busy_timeout_ms) * 1000
+        start = time.ticks_us()
+        self.spi.readinto(tokenbuf, 0xFF)
+        while tokenbuf[0] == 0x00:
+            if time.ticks_diff(time.ticks_us(), start) > timeout_us:
+                self.cs(1)
+                self.spi.write(b"\xff")
+                raise OSError(110)  # ETIMEDOUT
+            self.spi.readinto(tokenbuf, 0xFF)
+        return time.ticks_diff(time.ticks_us(), start)
+
     def write(self, token, buf):
         self.cs(0)
 
         # send: start of block, data, checksum
-        self.spi.read(1, token)
+        self.tokenbuf[0] = token
+        self.spi.write(self.tokenbuf)
         self.spi.write(buf)
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        if self._crc_on:
+            crc = _crc16(buf)
+            self.crcbuf[0] = crc >> 8
+            self.crcbuf[1] = crc & 0xFF
+            self.spi.write(self.crcbuf)
+        else:
+            self.spi.write(b"\xff\xff")
 
-        # check the response
-        if (self.spi.read(1, 0xFF)[0] & 0x1F) != 0x05:
+        # check the response: 0x05 accepted, 0x0B CRC error, 0x0D write error
+        self.spi.readinto(self.tokenbuf, 0xFF)
+        if (self.tokenbuf[0] & 0x1F) != 0x05:
             self.cs(1)
             self.spi.write(b"\xff")
-            return
+            raise OSError(5)  # EIO
 
         # wait for write to finish
-        while self.spi.read(1, 0xFF)[0] == 0:
-            pass
+        busy = self.wait_busy()
+        self.busy_us = busy
+        self.total_busy_us += busy
+        self.blocks_written += 1
+        if busy > self.max_busy_us:
+            self.max_busy_us = busy
 
         self.cs(1)
         self.spi.write(b"\xff")
 
     def write_token(self, token):
         self.cs(0)
-        self.spi.read(1, token)
+        self.tokenbuf[0] = token
+        self.spi.write(self.tokenbuf)
         self.spi.write(b"\xff")
         # wait for write to finish
-        while self.spi.read(1, 0xFF)[0] == 0x00:
-            pass
+        self.wait_busy()
 
         self.cs(1)
         self.spi.write(b"\xff")
@@ -255,11 +569,17 @@ class SDCard:
                 raise OSError(5)  # EIO
             offset = 0
             mv = memoryview(buf)
-            while nblocks:
-                # receive the data and release card
-                self.readinto(mv[offset: offset + 512])
-                offset += 512
-                nblocks -= 1
+            try:
+                while nblocks:
+                    # receive the data and release card
+                    self.readinto(mv[offset: offset + 512])
+                    offset += 512
+                    nblocks -= 1
+            except OSError:
+                # a failed block (CRC, timeout) still ends the transfer, or
+                # the card keeps streaming into the next command
+                self.cmd(12, 0, 0xFF, skip1=True)
+                raise
             if self.cmd(12, 0, 0xFF, skip1=True):
                 raise OSError(5)  # EIO
 
@@ -274,20 +594,59 @@ class SDCard:
             # send the data
             self.write(_TOKEN_DATA, buf)
         else:
+            # ACMD23: number of blocks to pre-erase, so the card does not
+            # erase block by block while the data streams in
+            if self.acmd23:
+                self.cmd(55, 0, 0)
+                if self.cmd(23, nblocks, 0) != 0:
+                    self.acmd23 = False
             # CMD25: set write address for first block
             if self.cmd(25, block_num * self.cdv, 0) != 0:
                 raise OSError(5)  # EIO
             # send the data
             offset = 0
             mv = memoryview(buf)
-            while nblocks:
-                self.write(_TOKEN_CMD25, mv[offset: offset + 512])
-                offset += 512
-                nblocks -= 1
-            self.write_token(_TOKEN_STOP_TRAN)
+            try:
+                while nblocks:
+                    self.write(_TOKEN_CMD25, mv[offset: offset + 512])
+                    offset += 512
+                    nblocks -= 1
+            finally:
+                # end the transfer even when a block was rejected
+                self.write_token(_TOKEN_STOP_TRAN)
+
+    def erase(self, start, count=1):
+        """Erases ``count`` blocks from ``start`` (CMD32/CMD33/CMD38). Depending on
+        the card they then read back as all zeros or all ones."""
+        if self.cmd(32, start * self.cdv, 0) != 0:
+            raise OSError(5)  # EIO
+        if self.cmd(33, (start + count - 1) * self.cdv, 0) != 0:
+            raise OSError(5)  # EIO
+        if self.cmd(38, 0, 0, release=False) != 0:
+            self.cs(1)
+            raise OSError(5)  # EIO
+        busy = self.wait_busy(_ERASE_TIMEOUT_MS * (1 + count // _ERASE_AU_BLOCKS))
+        self.cs(1)
+        self.spi.write(b"\xff")
+        return busy
+
+    def pre_erase(self, start, count, chunk=_ERASE_AU_BLOCKS):
+        """Erases a region reserved for sequential writes (a raw log) ahead of
+        time, ``chunk`` blocks per command to keep each busy wait short. Later
+        writes to it skip the card's internal erase. Returns the busy time in us."""
+        busy = 0
+        end = start + count
+        while start < end:
+            n = min(chunk, end - start)
+            busy += self.erase(start, n)
+            start += n
+        return busy
 
     def ioctl(self, op, arg):
         if op == 4:  # get number of blocks
             return self.sectors
         if op == 5:  # get block size in bytes
             return 512
+        if op == 6:  # block erase
+            self.erase(arg)
+            return 0
@@ -0,0 +1,59 @@
+"""
+Simulated hardware for running the drivers under CPython
+
+``install()`` must be called before importing any driver module. It registers
+stand-ins for the MicroPython-only modules (``machine``, ``micropython``,
+``onewire``) and adds the MicroPython extensions of ``time`` (``ticks_*``,
+``sleep_ms``...).
+
+Device models: ``inasim.INA3221Sim`` and ``bqsim.BQ25895Sim`` on ``I2C``,
+``sdsim.SDCardSim`` on ``SPI`` (or used as the SPI object itself) and
+``dssim.DS18B20Sim`` on ``onewire.OneWire``. ``bench`` runs every driver
+against them:
+    python3 -m sim.bench
+
+Example usage:
+    import sim
+    sim.install()
+    from machine import I2C
+    from sim.inasim import INA3221Sim
+    i2c = I2C(0)
+    i2c.attach(0x40, INA3221Sim())
+"""
+
+import sys
+import time
+
+
+def install():
+    from sim import machine, micropython, onewire
+
+    sys.modules.setdefault("machine", machine)
+    sys.modules.setdefault("micropython", micropython)
+    sys.modules.setdefault("onewire", onewire)
+    _patch_time()
+
+
+def _patch_time():
+    if hasattr(time, "ticks_ms"):
+        return
+    from aio import ticks_ms, ticks_us, ticks_diff, ticks_add
+    from sim.micropython import run_pending
+
+    def sleep_ms(ms):
+        run_pending()
+        time.sleep(ms / 1000)
+        run_pending()
+
+    def sleep_us(us):
+        run_pending()
+        time.sleep(us / 1000000)
+        run_pending()
+
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_cpu = ticks_us
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
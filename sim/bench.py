@@ -0,0 +1,252 @@
+"""
+Driver benchmarks against the simulated devices
+
+Every driver operation runs ``count`` times against the device models and
+reports, per call:
+* transactions and bytes on the bus it uses, and their simulated wire time
+* the heap bytes allocated (peak above the starting point over the calls,
+  measured with ``tracemalloc``; this includes the device models), and the
+  bytes still held by driver code afterwards
+* the CPU time on this host
+
+Allocation counts are those of CPython, not of MicroPython, but an operation
+that starts to allocate (or to use more transactions) shows up in both.
+With ``--baseline`` the results are saved on the first run and compared on
+the following ones; operations that got worse are marked and make the exit
+status non-zero.
+
+Runs on a PC:
+    python3 -m sim.bench [--count N] [--only NAME] [--baseline FILE]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sim
+
+sim.install()
+
+from array import array
+from machine import Pin, SPI
+from onewire import OneWire
+
+import sdcard
+from blocklog import BlockLog, SRC_INA3221
+from bqv3 import BQ25895, F_ICHG, F_CONV_START
+from charger import ChargeController
+from coulomb import CoulombCounter
+from ds18b20 import DS18B20Bus
+from i2cbus import get_bus
+from ina3221 import INA3221, INA3221Measurement, C_REG_CONFIG, C_AVERAGING_MASK, C_AVERAGING_NONE, \
+    C_VBUS_CONV_TIME_MASK, C_SHUNT_CONV_TIME_MASK
+from ina_alert import INAAlerts
+from ina_sampler import INASampler
+from sim.bqsim import BQ25895Sim
+from sim.dssim import DS18B20Sim
+from sim.inasim import INA3221Sim
+from sim.sdsim import SDCardSim
+
+# held memory is only counted for driver code, not for the models or this file
+_FILTERS = (tracemalloc.Filter(False, "*/sim/*"), tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<*>"))
+_COLUMNS = ("transactions", "bytes", "bus_us", "peak", "held")
+# differences within these are noise: timing dependent polls, allocator
+# granularity, counters growing past the small int cache
+_TOLERANCE = {"transactions": 0.05, "bytes": 0.5, "bus_us": 5.0, "peak": 256, "held": 256}
+
+
+def _setup(tmp):
+    """Drivers on simulated devices. Returns the operations, each
+    ``(name, bus, function)``."""
+    i2c = get_bus(0, scl=5, sda=4, freq=400000)
+    ina_sim = i2c.i2c.attach(0x40, INA3221Sim())
+    ina_sim.set_channel(1, bus_voltage=4.1, current=0.5)
+    ina_sim.set_channel(2, bus_voltage=5.0, current=0.1)
+    bq_sim = i2c.i2c.attach(0x6A, BQ25895Sim(int_pin=Pin(14), adc_time=0.0005, ce_pin=Pin(12)))
+    bq_sim.ichg = 500
+
+    ina = INA3221(i2c)
+    for ch in (1, 2, 3):
+        ina.enable_channel(ch)
+    # fastest conversions, so conversion ready polls succeed
+    ina.update(C_REG_CONFIG, C_AVERAGING_MASK | C_VBUS_CONV_TIME_MASK | C_SHUNT_CONV_TIME_MASK,
+               C_AVERAGING_NONE)
+    result = INA3221Measurement(ina.shunt_resistor)
+    raw = array("h", (8 * i for i in range(64)))
+    out = array("i", (0 for _ in range(64)))
+    sampler = INASampler(ina, size=16)
+    cc = CoulombCounter(ina)
+    alerts = INAAlerts(ina)
+
+    bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12, i2c=i2c)
+    regs = bytearray(21)
+    ctrl = ChargeController(bq)
+
+    def sampler_sample():
+        sampler.sample()
+        sampler._tail = sampler._head  # keep the ring from filling up
+
+    def batch():
+        for i in range(64):
+            raw[i] = 8 * i
+        ina.batch_current_ua(raw, out)
+
+    def set_and_flush():
+        bq.set_field(F_ICHG, 512 if bq.get_field(F_ICHG) != 512 else 576)
+        bq.flush()
+
+    def one_shot_adc():
+        bq.set_field(F_CONV_START, 1)
+        bq.flush()
+        while bq._read_byte(F_CONV_START[0]) & (1 << F_CONV_START[1]):
+            time.sleep_ms(0)
+        return bq.adc_battery_volt()
+
+    path = tmp + "/sd.img"
+    sdcard.SDCard.PARAMS_FILE = tmp + "/sdcard.cfg"
+    SDCardSim.create(path, 8192)
+    spi = SPI(1)
+    cs = Pin(15)
+    spi.attach(SDCardSim(path, cs, busy_polls=20))
+    sd = sdcard.SDCard(spi, cs, baudrate=20000000)
+    block = bytearray(512)
+    blocks8 = bytearray(512 * 8)
+    log = BlockLog(sd, 4096, 256)
+    log.format()
+
+    def log_block():
+        # one block of records
+        for i in range(31):
+            log.log(SRC_INA3221, 0, i, 2, 3)
+            log.service()
+
+    ow = OneWire(Pin(2))
+    for t in (21.5, 22.25, -3.0):
+        ow.attach(DS18B20Sim(t))
+    sensors = DS18B20Bus(ow)
+    # 94 ms conversions keep the run short
+    sensors.set_resolution(9)
+
+    def convert():
+        # waiting out the conversion keeps the number of polls deterministic
+        sensors.start()
+        time.sleep_ms(sensors.conversion_time_ms())
+        while not sensors.ready():
+            time.sleep_ms(1)
+
+    ops = [
+        ("INA3221.read", i2c, lambda: ina.read(C_REG_CONFIG)),
+        ("INA3221.update", i2c, lambda: ina.update(C_REG_CONFIG, C_AVERAGING_MASK, C_AVERAGING_NONE)),
+        ("INA3221.is_ready", i2c, lambda: ina.is_ready),
+        ("INA3221.current", i2c, lambda: ina.current(1)),
+        ("INA3221.current_ua", i2c, lambda: ina.current_ua(1)),
+        ("INA3221.bus_voltage", i2c, lambda: ina.bus_voltage(1)),
+        ("INA3221.bus_mv", i2c, lambda: ina.bus_mv(1)),
+        ("INA3221.measure_all", i2c, lambda: ina.measure_all(result)),
+        ("INA3221.snapshot", i2c, ina.snapshot),
+        ("INA3221.batch_current_ua x64", None, batch),
+        ("INASampler.sample", i2c, sampler_sample),
+        ("CoulombCounter.sample", i2c, cc.sample),
+        ("INAAlerts.read_flags", i2c, alerts.read_flags),
+        ("BQ25895.get_field", i2c, lambda: bq.get_field(F_ICHG)),
+        ("BQ25895.set_field+flush", i2c, set_and_flush),
+        ("BQ25895.charge_state", i2c, bq.charge_state),
+        ("BQ25895.dump_registers", i2c, lambda: bq.dump_registers(regs)),
+        ("BQ25895.reload", i2c, bq.reload),
+        ("BQ25895 one-shot ADC", i2c, one_shot_adc),
+        ("ChargeController poll", i2c, ctrl._update),
+        ("SDCard.readblocks x1", spi, lambda: sd.readblocks(0, block)),
+        ("SDCard.readblocks x8", spi, lambda: sd.readblocks(0, blocks8)),
+        ("SDCard.writeblocks x1", spi, lambda: sd.writeblocks(0, block)),
+        ("SDCard.writeblocks x8", spi, lambda: sd.writeblocks(8, blocks8)),
+        ("SDCard.erase x64", spi, lambda: sd.erase(64, 64)),
+        ("BlockLog block (31 records)", spi, log_block),
+        ("DS18B20Bus.start+ready", ow, convert),
+        ("DS18B20Bus.collect", ow, sensors.collect),
+        ("DS18B20Bus.set_resolution", ow, lambda: sensors.set_resolution(9)),
+    ]
+    return ops
+
+
+def _wire(bus):
+    """The simulated bus behind a driver's bus object"""
+    return bus.i2c if hasattr(bus, "i2c") else bus
+
+
+def measure(bus, fn, count):
+    fn()  # first call: lazy initialisation, caches
+    wire = _wire(bus) if bus is not None else None
+    if wire is not None:
+        wire.reset_stats()
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    cpu_us = (time.perf_counter() - start) * 1e6 / count
+    row = {"transactions": 0.0, "bytes": 0.0, "bus_us": 0.0}
+    if wire is not None:
+        row = {"transactions": wire.transactions / count, "bytes": wire.bytes / count,
+               "bus_us": wire.bus_time_us / count}
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    for _ in range(count):
+        fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    tracemalloc.stop()
+    row["peak"] = peak - base
+    row["held"] = max(0, sum(stat.size_diff for stat in after.compare_to(before, "filename")))
+    row["cpu_us"] = cpu_us
+    return row
+
+
+def _worse(row, old):
+    return [col for col in _COLUMNS if col in old and row[col] > old[col] + _TOLERANCE[col]]
+
+
+def run(count=20, only=None, baseline=None):
+    """Runs the operations whose name contains ``only``. Returns the number of
+    regressions against ``baseline``."""
+    old = {}
+    if baseline is not None and os.path.exists(baseline):
+        with open(baseline) as f:
+            old = json.load(f)
+    results = {}
+    regressions = 0
+    print("{:30s} {:>7s} {:>7s} {:>9s} {:>8s} {:>8s} {:>9s}".format(
+        "operation", "trans", "bytes", "bus us", "alloc B", "held B", "cpu us"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, bus, fn in _setup(tmp):
+            if only and only not in name:
+                continue
+            row = results[name] = measure(bus, fn, count)
+            worse = _worse(row, old[name]) if name in old else []
+            regressions += bool(worse)
+            print("{:30s} {:7.1f} {:7.1f} {:9.1f} {:8d} {:8d} {:9.1f}{}".format(
+                name, row["transactions"], row["bytes"], row["bus_us"], row["peak"], row["held"],
+                row["cpu_us"], "  worse: " + ", ".join(worse) if worse else ""))
+    if baseline is not None and not old:
+        with open(baseline, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("baseline saved to", baseline)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m sim.bench")
+    parser.add_argument("--count", type=int, default=20, help="calls per operation")
+    parser.add_argument("--only", help="run the operations whose name contains this")
+    parser.add_argument("--baseline", help="results file to compare with, written when missing")
+    args = parser.parse_args()
+    sys.exit(1 if run(args.count, args.only, args.baseline) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Register model of the BQ25895 for the simulated I2C bus"""
+
+import time
+
+_DEFAULTS = (0x08, 0x06, 0x1D, 0x3A, 0x20, 0x13, 0x5E, 0x9D, 0x03, 0x44, 0x93,
+             0x00, 0x00, 0x12, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x39)
+
+
+class BQ25895Sim:
+    """The battery is described by ``vbat``, ``vsys``, ``vbus`` (mV), ``ichg``
+    (mA) and ``ts_pct`` (TS as % of REGN), numbers or functions of the
+    simulated time in seconds. The ADC registers (REG0E-REG12) follow them
+    once per conversion, one-shot (CONV_START) or continuous (CONV_RATE),
+    quantized and clamped like the chip. The charge current reads 0 while
+    charging is disabled by CHG_CONFIG or by ``ce_pin`` (/CE) being high."""
+
+    def __init__(self, int_pin=None, adc_time=1.0, ce_pin=None):
+        self.int_pin = int_pin
+        self.ce_pin = ce_pin
+        self.adc_time = adc_time
+        self.vbat = 3700
+        self.vsys = 3750
+        self.vbus = 5000
+        self.ichg = 0
+        self.ts_pct = 50.0
+        self.pointer = 0
+        self.conversions = 0
+        self.reset()
+
+    def reset(self):
+        self.regs = bytearray(_DEFAULTS)
+        self._conv_done = None
+        self._last_conv = time.monotonic()
+
+    @staticmethod
+    def _value(source, t):
+        return source(t) if callable(source) else source
+
+    @staticmethod
+    def _adc(value, offset, step):
+        return max(0, min(127, int((value - offset) // step)))
+
+    def _convert(self):
+        now = time.monotonic()
+        self.conversions += 1
+        vbus = self._value(self.vbus, now)
+        charging = self.regs[0x03] & 0x10 and (self.ce_pin is None or not self.ce_pin.value())
+        self.regs[0x0E] = (self.regs[0x0E] & 0x80) | self._adc(self._value(self.vbat, now), 2304, 20)
+        self.regs[0x0F] = self._adc(self._value(self.vsys, now), 2304, 20)
+        self.regs[0x10] = self._adc(self._value(self.ts_pct, now), 21, 0.465)
+        # VBUS_GD above the 3.8 V good threshold
+        self.regs[0x11] = (0x80 if vbus >= 3800 else 0) | self._adc(vbus, 2600, 100)
+        self.regs[0x12] = self._adc(self._value(self.ichg, now), 0, 50) if charging and vbus >= 3800 else 0
+
+    def _update(self):
+        now = time.monotonic()
+        if self._conv_done is not None and now >= self._conv_done:
+            self._conv_done = None
+            self.regs[0x02] &= 0x7F
+            self._convert()
+        if self.regs[0x02] & 0x40:
+            # continuous conversion, CONV_START reads high while a conversion runs
+            if now - self._last_conv >= self.adc_time:
+                self._last_conv = now
+                self._convert()
+
+    def read(self, reg, buf):
+        self._update()
+        for i in range(len(buf)):
+            buf[i] = self.regs[(reg + i) % len(self.regs)]
+
+    def write(self, reg, data):
+        for i, value in enumerate(data):
+            self._write_reg((reg + i) % len(self.regs), value)
+
+    def _write_reg(self, reg, value):
+        if reg == 0x14:
+            if value & 0x80:
+                self.reset()
+            return
+        if reg in (0x0B, 0x0C, 0x0E, 0x0F, 0x10, 0x11, 0x12, 0x13):
+            return  # read-only
+        if reg == 0x02:
+            if value & 0x40:
+                # continuous conversion: CONV_START is read-only
+                value &= 0x7F
+            elif value & 0x80:
+                self._conv_done = time.monotonic() + self.adc_time
+        self.regs[reg] = value
+
+    def set_status(self, chrg_stat=None, pg_stat=None, vbus_stat=None, fault=None):
+        """Changes the status registers and pulses the INT pin like the chip does"""
+        reg = self.regs[0x0B]
+        if chrg_stat is not None:
+            reg = (reg & ~0x18) | (chrg_stat << 3)
+        if pg_stat is not None:
+            reg = (reg & ~0x04) | (pg_stat << 2)
+        if vbus_stat is not None:
+            reg = (reg & ~0xE0) | (vbus_stat << 5)
+        self.regs[0x0B] = reg
+        if fault is not None:
+            self.regs[0x0C] = fault
+        if self.int_pin is not None:
+            self.int_pin.drive(0)
+            self.int_pin.drive(1)
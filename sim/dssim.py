@@ -0,0 +1,94 @@
+"""Model of the DS18B20 for the simulated OneWire bus"""
+
+import time
+from sim.onewire import crc8
+
+# conversion time per resolution (9 to 12 bits), in seconds
+_CONV_TIME = (0.09375, 0.1875, 0.375, 0.75)
+_POWER_ON_TEMP = 0x0550  # 85 degC
+
+
+class DS18B20Sim:
+    """``temperature`` (degC) is a number or a function of the simulated time
+    in seconds, sampled when a conversion completes. The scratchpad, the
+    EEPROM copy of TH/TL/configuration and the conversion time of the
+    configured resolution follow the datasheet."""
+
+    _serial = 1
+
+    def __init__(self, temperature=25.0, rom=None, resolution=12):
+        if rom is None:
+            serial = DS18B20Sim._serial
+            DS18B20Sim._serial += 1
+            rom = bytes((0x28,)) + serial.to_bytes(6, "little")
+            rom += bytes((crc8(rom),))
+        self.rom = bytes(rom)
+        self.temperature = temperature
+        self.eeprom = bytearray((0x4B, 0x46, ((resolution - 9) << 5) | 0x1F))
+        self.conversions = 0
+        self.power_on()
+
+    def power_on(self):
+        self.scratch = bytearray((_POWER_ON_TEMP & 0xFF, _POWER_ON_TEMP >> 8, 0, 0, 0, 0xFF, 0x0C, 0x10, 0))
+        self.scratch[2:5] = self.eeprom
+        self._conv_done = None
+        self.bus_reset()
+
+    def bus_reset(self):
+        """A reset pulse aborts a read or write in progress, not a conversion"""
+        self._out = bytearray()
+        self._command = None
+        self._args = bytearray()
+
+    @property
+    def resolution(self):
+        return ((self.scratch[4] >> 5) & 3) + 9
+
+    def _update(self):
+        if self._conv_done is None or time.monotonic() < self._conv_done:
+            return
+        self._conv_done = None
+        t = self.temperature(time.monotonic()) if callable(self.temperature) else self.temperature
+        raw = round(max(-55.0, min(125.0, t)) * 16)
+        # the undefined low bits read as 0
+        raw &= ~((1 << (12 - self.resolution)) - 1)
+        raw &= 0xFFFF
+        self.scratch[0] = raw & 0xFF
+        self.scratch[1] = raw >> 8
+        self.conversions += 1
+
+    # OneWire function phase, after the device was selected
+
+    def write_byte(self, value):
+        self._update()
+        if self._command == 0x4E:
+            self._args.append(value)
+            if len(self._args) == 3:
+                self.scratch[2] = self._args[0]
+                self.scratch[3] = self._args[1]
+                self.scratch[4] = (self._args[2] & 0x60) | 0x1F
+                self._command = None
+            return
+        self._command = None
+        if value == 0x44:
+            self._conv_done = time.monotonic() + _CONV_TIME[self.resolution - 9]
+        elif value == 0xBE:
+            self.scratch[8] = crc8(self.scratch[:8])
+            self._out = bytearray(self.scratch)
+        elif value == 0x4E:
+            self._command = value
+            self._args = bytearray()
+        elif value == 0x48:
+            self.eeprom[:] = self.scratch[2:5]
+        elif value == 0xB8:
+            self.scratch[2:5] = self.eeprom
+
+    def read_byte(self):
+        if self._out:
+            return self._out.pop(0)
+        return 0xFF
+
+    def read_bit(self):
+        # held low while converting
+        self._update()
+        return 0 if self._conv_done is not None else 1
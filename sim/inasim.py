@@ -0,0 +1,157 @@
+"""Register model of the INA3221 for the simulated I2C bus"""
+
+import time
+
+_CONFIG_DEFAULT = 0x7127
+_MASK_ENABLE_DEFAULT = 0x0002
+# conversion times selected by the CT fields, in seconds
+_CONV_TIME = (140e-6, 204e-6, 332e-6, 588e-6, 1.1e-3, 2.116e-3, 4.156e-3, 8.244e-3)
+_AVERAGES = (1, 4, 16, 64, 128, 256, 512, 1024)
+
+
+class INA3221Sim:
+    """Channels are described by their bus voltage and current, either numbers
+    or functions of the simulated time in seconds. Conversions follow the
+    operating mode, conversion times and averaging of the configuration
+    register; results are clamped to the ADC ranges and the measurement
+    registers are read-only. The optional pins are driven like the open-drain
+    CRITICAL/WARNING outputs."""
+
+    def __init__(self, shunt_resistor=(0.1, 0.1, 0.1), critical_pin=None, warning_pin=None):
+        self.shunt_resistor = shunt_resistor
+        self.critical_pin = critical_pin
+        self.warning_pin = warning_pin
+        self.bus_voltage = [5.0, 5.0, 5.0]
+        self.current = [0.0, 0.0, 0.0]
+        self.pointer = 0
+        self.reset()
+
+    def reset(self):
+        self.regs = [0] * 0x12
+        self.regs[0x00] = _CONFIG_DEFAULT
+        self.regs[0x0F] = _MASK_ENABLE_DEFAULT
+        self.regs[0x07] = self.regs[0x09] = self.regs[0x0B] = 0x7FF8
+        self.regs[0x0E] = 0x7FFE
+        self.regs[0x10] = 0x2710
+        self.regs[0x11] = 0x2328
+        self._cycle_start = time.monotonic()
+        self._single = False
+
+    def set_channel(self, channel, bus_voltage=None, current=None):
+        if bus_voltage is not None:
+            self.bus_voltage[channel - 1] = bus_voltage
+        if current is not None:
+            self.current[channel - 1] = current
+
+    def _value(self, source, t):
+        return source(t) if callable(source) else source
+
+    def conversion_time(self):
+        """Seconds for one full measurement cycle over the enabled channels"""
+        config = self.regs[0x00]
+        mode = config & 7
+        averages = _AVERAGES[(config >> 9) & 7]
+        per_channel = 0
+        if mode & 2:
+            per_channel += _CONV_TIME[(config >> 6) & 7]
+        if mode & 1:
+            per_channel += _CONV_TIME[(config >> 3) & 7]
+        channels = bin(config & 0x7000).count("1")
+        return averages * per_channel * max(channels, 1)
+
+    def _update(self):
+        config = self.regs[0x00]
+        mode = config & 7
+        # power-down (0, 4), or a single shot that has already completed
+        if not mode & 3 or (mode < 4 and not self._single):
+            return
+        now = time.monotonic()
+        if now - self._cycle_start < self.conversion_time():
+            return
+        self._cycle_start = now
+        self._single = False
+        for ch in range(3):
+            if not config & (0x4000 >> ch):
+                continue
+            if mode & 1:
+                shunt = self._value(self.current[ch], now) * self.shunt_resistor[ch]
+                counts = max(-4096, min(4095, round(shunt / 40e-6)))
+                self.regs[1 + 2 * ch] = (counts << 3) & 0xFFF8
+            if mode & 2:
+                bus = self._value(self.bus_voltage[ch], now)
+                counts = max(0, min(4095, round(bus / 8e-3)))
+                self.regs[2 + 2 * ch] = counts << 3
+        self.regs[0x0F] |= 0x0001  # CVRF
+        self._compare()
+
+    @staticmethod
+    def _signed(value):
+        return value - 0x10000 if value & 0x8000 else value
+
+    def _compare(self):
+        """Sets the critical/warning flags against the limits and drives the pins"""
+        config = self.regs[0x00]
+        mask = self.regs[0x0F]
+        critical = warning = 0
+        for ch in range(3):
+            if not config & (0x4000 >> ch):
+                continue
+            shunt = self._signed(self.regs[1 + 2 * ch])
+            if shunt > self._signed(self.regs[0x07 + 2 * ch]):
+                critical |= 0x0200 >> ch
+            if shunt > self._signed(self.regs[0x08 + 2 * ch]):
+                warning |= 0x0020 >> ch
+        # latched flags stay until mask/enable is read, transparent ones follow
+        if not mask & 0x0400:
+            mask &= ~0x0380
+        if not mask & 0x0800:
+            mask &= ~0x0038
+        self.regs[0x0F] = mask | critical | warning
+        self._drive_pins()
+
+    def _drive_pins(self):
+        mask = self.regs[0x0F]
+        if self.critical_pin is not None:
+            self.critical_pin.drive(not mask & 0x0380)
+        if self.warning_pin is not None:
+            self.warning_pin.drive(not mask & 0x0038)
+
+    def step(self):
+        """Runs a conversion if one is due, as the free running chip would"""
+        self._update()
+
+    def _read_reg(self, reg):
+        if reg == 0xFE:
+            return 0x5449
+        if reg == 0xFF:
+            return 0x3220
+        self._update()
+        value = self.regs[reg]
+        if reg == 0x0F:
+            # reading mask/enable clears the conversion ready and latched alert flags
+            self.regs[0x0F] &= 0x7C00
+            self._drive_pins()
+        return value
+
+    def read(self, reg, buf):
+        # registers are 16 bits, a longer read repeats the same register
+        value = self._read_reg(reg)
+        for i in range(len(buf)):
+            buf[i] = (value >> 8) & 0xFF if i % 2 == 0 else value & 0xFF
+
+    def write(self, reg, data):
+        if len(data) < 2:
+            return
+        value = (data[0] << 8) | data[1]
+        if reg == 0x00 and value & 0x8000:
+            self.reset()
+            return
+        if reg == 0x0F:
+            value = (self.regs[0x0F] & 0x03FF) | (value & 0x7C00)
+        if reg == 0x00:
+            # a configuration write restarts the conversion cycle, single shot
+            # modes (1-3) convert once
+            self._cycle_start = time.monotonic()
+            self._single = (value & 7) < 4
+        if reg in (0x00, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0E, 0x0F, 0x10, 0x11):
+            self.regs[reg] = value
@@ -0,0 +1,306 @@
+"""
+Stand-in for the MicroPython ``machine`` module
+
+Buses do not talk to hardware but to device models attached to them. Every
+transaction is counted together with the time it would take on the wire.
+Timers fire from ``run_pending()``, i.e. on the next bus transaction or
+``time.sleep_ms``/``sleep_us`` once they are due.
+"""
+
+import time
+from sim.micropython import run_pending, pollers
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state):
+    pass
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    # like on the board, Pin(n) always refers to the same pin
+    _pins = {}
+
+    def __new__(cls, id, *args, **kwargs):
+        pin = Pin._pins.get(id)
+        if pin is None:
+            pin = Pin._pins[id] = super().__new__(cls)
+            pin.id = id
+            pin._value = 0
+            pin._handler = None
+            pin._trigger = 0
+        return pin
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if mode != -1:
+            self.mode = mode
+        if pull == Pin.PULL_UP:
+            self._value = 1
+        if value is not None:
+            self._value = 1 if value else 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    __call__ = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._handler = handler
+        self._trigger = trigger
+
+    def drive(self, level):
+        """Simulates the external circuit changing the pin level, firing the IRQ handler"""
+        level = 1 if level else 0
+        if level == self._value:
+            return
+        self._value = level
+        edge = Pin.IRQ_RISING if level else Pin.IRQ_FALLING
+        if self._handler is not None and self._trigger & edge:
+            self._handler(self)
+
+
+class PWM:
+    def __init__(self, pin, freq=5000, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+        self.freq_changes = 0
+        self.duty_changes = 0
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+        self.freq_changes += 1
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        self.duty_changes += 1
+
+    def deinit(self):
+        self._duty = 0
+
+
+class RTC:
+    # RTC memory survives deep sleep, so it is kept per process, not per object
+    _memory = b""
+
+    def memory(self, data=None):
+        if data is None:
+            return RTC._memory
+        if len(data) > 2048:
+            raise ValueError("data too large")
+        RTC._memory = bytes(data)
+
+
+class I2C:
+    # devices attached per bus id, shared by all I2C objects on that bus
+    _buses = {}
+
+    def __init__(self, id=0, *, scl=None, sda=None, freq=400000, timeout=50000):
+        self.id = id
+        self.freq = freq
+        self.devices = I2C._buses.setdefault(id, {})
+        self.reset_stats()
+
+    def init(self, *, scl=None, sda=None, freq=400000):
+        self.freq = freq
+
+    def attach(self, addr, device):
+        self.devices[addr] = device
+        return device
+
+    def reset_stats(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_time_us = 0.0
+
+    def _device(self, addr, nbytes):
+        # address byte plus data, 9 clocks each, plus start/stop conditions
+        self.transactions += 1
+        self.bytes += nbytes
+        self.bus_time_us += ((nbytes + 1) * 9 + 2) * 1000000 / self.freq
+        run_pending()
+        try:
+            return self.devices[addr]
+        except KeyError:
+            raise OSError(19)  # ENODEV
+
+    def scan(self):
+        return sorted(self.devices)
+
+    def readfrom_mem_into(self, addr, memaddr, buf, *, addrsize=8):
+        # register write, repeated start, read
+        dev = self._device(addr, 2 + len(buf))
+        dev.read(memaddr, buf)
+
+    def readfrom_mem(self, addr, memaddr, nbytes, *, addrsize=8):
+        buf = bytearray(nbytes)
+        self.readfrom_mem_into(addr, memaddr, buf)
+        return bytes(buf)
+
+    def writeto_mem(self, addr, memaddr, buf, *, addrsize=8):
+        dev = self._device(addr, 1 + len(buf))
+        dev.write(memaddr, bytes(buf))
+
+    def writeto(self, addr, buf, stop=True):
+        dev = self._device(addr, len(buf))
+        buf = bytes(buf)
+        dev.pointer = buf[0]
+        if len(buf) > 1:
+            dev.write(buf[0], buf[1:])
+        return len(buf)
+
+    def readfrom_into(self, addr, buf, stop=True):
+        dev = self._device(addr, len(buf))
+        dev.read(dev.pointer, buf)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        buf = bytearray(nbytes)
+        self.readfrom_into(addr, buf, stop)
+        return bytes(buf)
+
+
+SoftI2C = I2C
+
+
+class SPI:
+    MSB = 0
+    LSB = 1
+    # devices attached per bus id; a device is selected by its ``cs`` pin
+    _buses = {}
+
+    def __init__(self, id=1, baudrate=1000000, *, polarity=0, phase=0, bits=8, firstbit=MSB,
+                 sck=None, mosi=None, miso=None):
+        self.id = id
+        self.baudrate = baudrate
+        self.devices = SPI._buses.setdefault(id, [])
+        self.reset_stats()
+
+    def init(self, baudrate=None, **kwargs):
+        if baudrate is not None:
+            self.baudrate = baudrate
+            for dev in self.devices:
+                dev.init(baudrate=baudrate)
+
+    def deinit(self):
+        pass
+
+    def attach(self, device):
+        """``device`` has the SPI methods and a ``cs`` pin, like ``SDCardSim``"""
+        self.devices.append(device)
+        device.init(baudrate=self.baudrate)
+        return device
+
+    def reset_stats(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.bus_time_us = 0.0
+
+    def _device(self, nbytes):
+        self.transactions += 1
+        self.bytes += nbytes
+        self.bus_time_us += nbytes * 8000000 / self.baudrate
+        run_pending()
+        for dev in self.devices:
+            if not dev.cs.value():
+                return dev
+        return None
+
+    def write(self, buf):
+        dev = self._device(len(buf))
+        if dev is not None:
+            dev.write(buf)
+
+    def readinto(self, buf, write=0xFF):
+        dev = self._device(len(buf))
+        if dev is None:
+            for i in range(len(buf)):
+                buf[i] = 0xFF
+        else:
+            dev.readinto(buf, write)
+
+    def read(self, nbytes, write=0xFF):
+        buf = bytearray(nbytes)
+        self.readinto(buf, write)
+        return bytes(buf)
+
+    def write_readinto(self, write_buf, read_buf):
+        dev = self._device(len(read_buf))
+        if dev is None:
+            for i in range(len(read_buf)):
+                read_buf[i] = 0xFF
+        else:
+            dev.write_readinto(write_buf, read_buf)
+
+
+SoftSPI = SPI
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+    _active = []
+
+    def __init__(self, id=-1, **kwargs):
+        self.id = id
+        self._callback = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, *, mode=PERIODIC, freq=None, period=None, callback=None):
+        if freq is not None:
+            self._period = 1 / freq
+        else:
+            self._period = (1000 if period is None else period) / 1000
+        self._mode = mode
+        self._callback = callback
+        self._next = time.monotonic() + self._period
+        if self not in Timer._active:
+            Timer._active.append(self)
+
+    def deinit(self):
+        if self in Timer._active:
+            Timer._active.remove(self)
+
+    @staticmethod
+    def poll():
+        """Fires the due timers once; periods missed in between are skipped"""
+        now = time.monotonic()
+        for timer in list(Timer._active):
+            if now < timer._next:
+                continue
+            if timer._mode == Timer.ONE_SHOT:
+                timer.deinit()
+            else:
+                timer._next += timer._period
+                if timer._next < now:
+                    timer._next = now + timer._period
+            if timer._callback is not None:
+                timer._callback(timer)
+
+
+pollers.append(Timer.poll)
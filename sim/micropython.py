@@ -0,0 +1,48 @@
+"""Stand-in for the MicroPython ``micropython`` module"""
+
+_SCHEDULE_DEPTH = 8
+_pending = []
+# called by run_pending() before the queue, e.g. to fire due machine.Timer callbacks
+pollers = []
+_polling = False
+
+
+def const(value):
+    return value
+
+
+def schedule(func, arg):
+    """Queues ``func(arg)``; the queue is run by ``run_pending()`` and by the
+    ``time.sleep_ms``/``sleep_us`` stand-ins, like between bytecodes on the board"""
+    if len(_pending) >= _SCHEDULE_DEPTH:
+        raise RuntimeError("schedule queue full")
+    _pending.append((func, arg))
+
+
+def run_pending():
+    global _polling
+    if pollers and not _polling:
+        _polling = True
+        try:
+            for poll in pollers:
+                poll()
+        finally:
+            _polling = False
+    while _pending:
+        func, arg = _pending.pop(0)
+        func(arg)
+
+
+def native(func):
+    return func
+
+
+viper = native
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def mem_info(verbose=False):
+    pass
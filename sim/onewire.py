@@ -0,0 +1,153 @@
+"""
+Stand-in for the MicroPython ``onewire`` module
+
+The bus works at byte level: after ``reset()`` the first byte is the ROM
+command (SKIP ROM, or MATCH ROM followed by the 8 ROM bytes), which selects
+the devices that receive the following function bytes. Reads return the
+wired-AND of the selected devices. ``scan()`` returns the attached ROMs
+directly, with the bus time of a full search. Bus time uses the standard
+speed slot timing (480+480 us reset, 65 us per bit).
+"""
+
+from sim.micropython import run_pending
+
+_RESET_US = 960
+_SLOT_US = 65
+
+
+class OneWireError(Exception):
+    pass
+
+
+def crc8(data):
+    """Dallas/Maxim CRC8; 0 over data followed by its CRC"""
+    crc = 0
+    for byte in data:
+        for _ in range(8):
+            mix = (crc ^ byte) & 1
+            crc >>= 1
+            if mix:
+                crc ^= 0x8C
+            byte >>= 1
+    return crc
+
+
+class OneWire:
+    SEARCH_ROM = 0xF0
+    MATCH_ROM = 0x55
+    SKIP_ROM = 0xCC
+
+    # devices attached per pin, shared by all OneWire objects on that pin
+    _buses = {}
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.devices = OneWire._buses.setdefault(pin.id, [])
+        self._selected = []
+        self._rom_phase = False
+        self._match = None
+        self.reset_stats()
+
+    def attach(self, device):
+        self.devices.append(device)
+        return device
+
+    def reset_stats(self):
+        self.transactions = 0
+        self.resets = 0
+        self.bytes = 0
+        self.bus_time_us = 0
+
+    def _slots(self, bits):
+        self.transactions += 1
+        self.bus_time_us += bits * _SLOT_US
+        run_pending()
+
+    def reset(self, required=False):
+        self.transactions += 1
+        self.resets += 1
+        self.bus_time_us += _RESET_US
+        run_pending()
+        self._rom_phase = True
+        self._match = None
+        self._selected = []
+        for dev in self.devices:
+            dev.bus_reset()
+        present = bool(self.devices)
+        if required and not present:
+            raise OneWireError
+        return present
+
+    def _write(self, value):
+        self.bytes += 1
+        if not self._rom_phase:
+            for dev in self._selected:
+                dev.write_byte(value)
+        elif self._match is not None:
+            self._match.append(value)
+            if len(self._match) == 8:
+                self._selected = [dev for dev in self.devices if bytes(dev.rom) == bytes(self._match)]
+                self._match = None
+                self._rom_phase = False
+        elif value == OneWire.MATCH_ROM:
+            self._match = bytearray()
+        elif value == OneWire.SKIP_ROM:
+            self._selected = list(self.devices)
+            self._rom_phase = False
+        else:
+            self._rom_phase = False
+
+    def _read(self):
+        self.bytes += 1
+        value = 0xFF
+        for dev in self._selected:
+            value &= dev.read_byte()
+        return value
+
+    def writebyte(self, value):
+        self._slots(8)
+        self._write(value)
+
+    def write(self, buf):
+        self._slots(8 * len(buf))
+        for value in buf:
+            self._write(value)
+
+    def writebit(self, value):
+        self._slots(1)
+
+    def readbyte(self):
+        self._slots(8)
+        return self._read()
+
+    def readinto(self, buf):
+        self._slots(8 * len(buf))
+        for i in range(len(buf)):
+            buf[i] = self._read()
+
+    def readbit(self):
+        self._slots(1)
+        value = 1
+        for dev in self._selected:
+            value &= dev.read_bit()
+        return value
+
+    def select_rom(self, rom):
+        self.reset()
+        self.writebyte(OneWire.MATCH_ROM)
+        self.write(rom)
+
+    def scan(self):
+        # one search pass per device: command byte, then 64 x (2 read + 1 write) slots
+        roms = []
+        for dev in self.devices:
+            self.reset()
+            self.writebyte(OneWire.SEARCH_ROM)
+            self._slots(64 * 3)
+            roms.append(bytearray(dev.rom))
+        self._rom_phase = False
+        self._selected = []
+        return roms
+
+    def crc8(self, data):
+        return crc8(data)
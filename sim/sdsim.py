@@ -0,0 +1,316 @@
+"""
+SD card in SPI mode, backed by an image file
+
+The model works byte by byte like the card: every byte clocked in by the host
+is parsed as command, data token or data, while the reply is clocked out from
+an output queue. It implements the subset of the protocol used by
+``sdcard.SDCard``.
+"""
+
+import random
+
+_BLOCK = 512
+_IDLE = 0x01
+_ILLEGAL = 0x04
+_COM_CRC = 0x08
+
+# receive states
+_CMD = 0
+_WAIT_TOKEN = 1
+_DATA = 2
+
+
+class SDCardSim:
+    def __init__(self, path, cs, sdhc=True, init_polls=2, read_delay=2, busy_polls=20,
+                 max_baudrate=25000000, erased_busy_polls=None):
+        """``init_polls`` ACMD41 calls before the card leaves idle, ``read_delay``
+        bytes before a data token, ``busy_polls`` busy bytes after a write.
+        Writes to erased blocks (CMD38 or ACMD23) only take ``erased_busy_polls``,
+        by default a quarter. Above ``max_baudrate`` the wiring is too slow and
+        bits get corrupted."""
+        self.file = open(path, "r+b")
+        self.file.seek(0, 2)
+        self.sectors = self.file.tell() // _BLOCK
+        self.cs = cs
+        self.sdhc = sdhc
+        self.init_polls = init_polls
+        self.read_delay = read_delay
+        self.busy_polls = busy_polls
+        self.erased_busy_polls = busy_polls // 4 if erased_busy_polls is None else erased_busy_polls
+        self.erased = bytearray(self.sectors)
+        self._erase_start = 0
+        self._erase_end = 0
+        self.max_baudrate = max_baudrate
+        self.baudrate = 100000
+        self.cid = bytes((0x03, 0x53, 0x44, 0x53, 0x49, 0x4D, 0x43, 0x44,
+                          0x10, 0x12, 0x34, 0x56, 0x78, 0x01, 0x6A, 0x00))
+        self._reset()
+        self.reset_stats()
+
+    @staticmethod
+    def create(path, sectors):
+        """Creates a sparse, zero filled image file"""
+        with open(path, "wb") as f:
+            f.truncate(sectors * _BLOCK)
+
+    def reset_stats(self):
+        self.bytes = 0
+        self.bus_time_us = 0.0
+        self.commands = 0
+        self.blocks_read = 0
+        self.blocks_written = 0
+        self.blocks_erased = 0
+        self.allocs = 0
+
+    def _reset(self):
+        self.idle = True
+        self._acmd41 = 0
+        self.crc_on = False
+        self._app = False
+        self._out = bytearray()
+        self._pos = 0
+        self._state = _CMD
+        self._cmdbuf = bytearray()
+        self._data = bytearray()
+        self._multi = False
+        self._read_next = None
+        self._write_next = 0
+        self._pre_erase = 0
+
+    # SPI interface
+
+    def init(self, *args, baudrate=None, **kwargs):
+        if baudrate is not None:
+            self.baudrate = baudrate
+
+    def deinit(self):
+        pass
+
+    def write(self, buf):
+        for b in buf:
+            self._xfer(b)
+
+    def readinto(self, buf, write=0xFF):
+        for i in range(len(buf)):
+            buf[i] = self._xfer(write)
+
+    def read(self, nbytes, write=0xFF):
+        self.allocs += 1
+        buf = bytearray(nbytes)
+        self.readinto(buf, write)
+        return bytes(buf)
+
+    def write_readinto(self, write_buf, read_buf):
+        for i in range(len(read_buf)):
+            read_buf[i] = self._xfer(write_buf[i])
+
+    # card
+
+    def _xfer(self, b):
+        self.bytes += 1
+        self.bus_time_us += 8000000 / self.baudrate
+        if self.cs.value():
+            return 0xFF
+        if self._pos == len(self._out) and self._read_next is not None:
+            # multiple block read: stream the next block
+            self._queue_block(self._read_next)
+            self._read_next += 1
+        if self._pos < len(self._out):
+            out = self._out[self._pos]
+            self._pos += 1
+        else:
+            out = 0xFF
+        if self.baudrate > self.max_baudrate and random.getrandbits(6) == 0:
+            out ^= 1 << random.getrandbits(3)
+        self._receive(b)
+        return out
+
+    def _receive(self, b):
+        if self._state == _CMD:
+            if self._cmdbuf or (b & 0xC0) == 0x40:
+                self._cmdbuf.append(b)
+                if len(self._cmdbuf) == 6:
+                    cmd = self._cmdbuf
+                    self._cmdbuf = bytearray()
+                    if self.crc_on and crc7(cmd[:5]) != cmd[5]:
+                        self._respond(self._r1(_COM_CRC))
+                    else:
+                        self._command(cmd[0] & 0x3F, int.from_bytes(cmd[1:5], "big"), cmd[5])
+        elif self._state == _WAIT_TOKEN:
+            if b == 0xFE or (self._multi and b == 0xFC):
+                self._state = _DATA
+                self._data = bytearray()
+            elif self._multi and b == 0xFD:
+                self._state = _CMD
+                self._queue(bytes(1 + self.busy_polls))
+        elif self._state == _DATA:
+            self._data.append(b)
+            if len(self._data) == _BLOCK + 2:
+                self._receive_block(self._data)
+
+    def _receive_block(self, data):
+        if self.crc_on and crc16(data[:_BLOCK]) != (data[_BLOCK] << 8 | data[_BLOCK + 1]):
+            # data rejected, CRC error
+            self._queue(bytes((0xEB,)))
+            self._state = _WAIT_TOKEN if self._multi else _CMD
+            return
+        block = self._write_next
+        busy = self.erased_busy_polls if block < self.sectors and self.erased[block] else self.busy_polls
+        self._write_block(block, data[:_BLOCK])
+        self._write_next += 1
+        self._queue(bytes((0xE5,)) + bytes(busy))
+        self._state = _WAIT_TOKEN if self._multi else _CMD
+
+    def _r1(self, value=0):
+        return value | (_IDLE if self.idle else 0)
+
+    def _queue(self, data):
+        if self._pos == len(self._out):
+            self._out = bytearray()
+            self._pos = 0
+        self._out += data
+
+    def _respond(self, *values):
+        # one byte of Ncr delay before the response
+        self._queue(bytes((0xFF,) + values))
+
+    def _block_addr(self, arg):
+        return arg if self.sdhc else arg // _BLOCK
+
+    def _command(self, cmd, arg, crc):
+        self.commands += 1
+        app = self._app
+        self._app = False
+        if cmd == 0:
+            self._reset()
+            self._respond(_IDLE)
+        elif cmd == 8:
+            self._respond(self._r1(), 0x00, 0x00, 0x01, arg & 0xFF)
+        elif cmd == 55:
+            self._app = True
+            self._respond(self._r1())
+        elif cmd == 41 and app:
+            self._acmd41 += 1
+            if self._acmd41 >= self.init_polls:
+                self.idle = False
+            self._respond(self._r1())
+        elif cmd == 23 and app:
+            # SET_WR_BLK_ERASE_COUNT, applies to the next CMD25
+            self._pre_erase = arg & 0x7FFFFF
+            self._respond(self._r1())
+        elif cmd == 58:
+            ocr0 = 0x00 if self.idle else (0x80 | (0x40 if self.sdhc else 0x00))
+            self._respond(self._r1(), ocr0, 0xFF, 0x80, 0x00)
+        elif cmd == 9:
+            self._respond(self._r1())
+            self._queue_data(self._csd())
+        elif cmd == 10:
+            self._respond(self._r1())
+            self._queue_data(self.cid)
+        elif cmd == 59:
+            self.crc_on = bool(arg & 1)
+            self._respond(self._r1())
+        elif cmd == 16:
+            self._respond(self._r1(0 if arg == _BLOCK else 0x40))
+        elif cmd == 17:
+            self._respond(self._r1())
+            self._queue_block(self._block_addr(arg))
+        elif cmd == 18:
+            self._respond(self._r1())
+            self._read_next = self._block_addr(arg)
+        elif cmd == 12:
+            self._read_next = None
+            # stuff byte, R1, then a short busy
+            self._out = bytearray((0xFF, self._r1(), 0x00, 0x00))
+            self._pos = 0
+        elif cmd in (24, 25):
+            self._respond(self._r1())
+            self._multi = cmd == 25
+            self._write_next = self._block_addr(arg)
+            self._state = _WAIT_TOKEN
+            if self._multi and self._pre_erase:
+                self._erase(self._write_next, self._write_next + self._pre_erase, False)
+            self._pre_erase = 0
+        elif cmd == 32:
+            self._erase_start = self._block_addr(arg)
+            self._respond(self._r1())
+        elif cmd == 33:
+            self._erase_end = self._block_addr(arg) + 1
+            self._respond(self._r1())
+        elif cmd == 38:
+            count = self._erase(self._erase_start, self._erase_end, True)
+            self._respond(self._r1())
+            self._queue(bytes(self.busy_polls + count // 64))
+        else:
+            self._respond(self._r1(_ILLEGAL))
+
+    def _csd(self):
+        c_size = self.sectors // 1024 - 1
+        csd = bytearray(16)
+        csd[0] = 0x40
+        csd[5] = 0x59
+        csd[7] = (c_size >> 16) & 0x3F
+        csd[8] = (c_size >> 8) & 0xFF
+        csd[9] = c_size & 0xFF
+        return csd
+
+    def _queue_data(self, data):
+        crc = crc16(data)
+        self._queue(bytes((0xFF,) * self.read_delay) + b"\xfe" + bytes(data) + bytes((crc >> 8, crc & 0xFF)))
+
+    def _queue_block(self, block):
+        self.blocks_read += 1
+        self._queue_data(self._read_block(block))
+
+    def _read_block(self, block):
+        self.file.seek(block * _BLOCK)
+        data = self.file.read(_BLOCK)
+        return data + bytes(_BLOCK - len(data))
+
+    def _erase(self, start, end, clear):
+        """Marks blocks as erased; CMD38 also clears the data (ACMD23 may keep it)"""
+        end = min(end, self.sectors)
+        if end <= start:
+            return 0
+        self.erased[start:end] = bytes((1,)) * (end - start)
+        if clear:
+            self.file.seek(start * _BLOCK)
+            self.file.write(bytes((end - start) * _BLOCK))
+        self.blocks_erased += end - start
+        return end - start
+
+    def _write_block(self, block, data):
+        if block < self.sectors:
+            self.erased[block] = 0
+        self.blocks_written += 1
+        self.file.seek(block * _BLOCK)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def crc16(data):
+    """CRC16-CCITT (XModem) of an SD data block"""
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        crc &= 0xFFFF
+    return crc
+
+
+def crc7(data):
+    """CRC7 of a command, as its last byte with the end bit set"""
+    crc = 0
+    for byte in data:
+        for bit in range(7, -1, -1):
+            crc = (crc << 1) | ((byte >> bit) & 1)
+            if crc & 0x80:
+                crc ^= 0x89
+    for _ in range(7):
+        crc <<= 1
+        if crc & 0x80:
+            crc ^= 0x89
+    return (crc << 1) | 1
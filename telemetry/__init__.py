@@ -0,0 +1,21 @@
+"""
+Host-side (CPython + NumPy) analysis of ``blocklog`` telemetry
+
+Not for the board. Reads a binary dump of the raw sample log, taken off the
+SD card or received over serial, into NumPy structured arrays and derives
+per channel power, charge (mAh) and energy (Wh), BQ25895 charge phases and
+per cycle statistics.
+
+Example usage:
+    import telemetry
+    cap = telemetry.load("card.img", start_block=1000000)
+    ch1 = telemetry.ina_channel(cap, 0, shunt_ohm=0.1)
+    print(ch1["charge_mah"][-1])
+    for line in telemetry.summary(cap):
+        print(line)
+or from the shell:
+    python3 -m telemetry card.img --start-block 1000000
+"""
+
+from telemetry.decode import Capture, load, load_bytes, unwrap_ticks
+from telemetry.metrics import ina_channel, charger, charge_phases, cycles, temperatures, summary
@@ -0,0 +1,25 @@
+"""
+Prints the summary of a dump:
+    python3 -m telemetry dump.bin [--start-block N] [--shunt OHM OHM OHM] [--crc]
+"""
+
+import argparse
+
+from telemetry.decode import load
+from telemetry.metrics import summary
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m telemetry")
+    parser.add_argument("path", help="card image or dump of the log's block range")
+    parser.add_argument("--start-block", type=int, default=0, help="first block of the log range in the image")
+    parser.add_argument("--shunt", type=float, nargs=3, default=(0.1, 0.1, 0.1), help="shunt resistors in ohm")
+    parser.add_argument("--crc", action="store_true", help="check the CRC32 of every block")
+    args = parser.parse_args()
+    cap = load(args.path, args.start_block, check_crc=args.crc)
+    for line in summary(cap, args.shunt):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
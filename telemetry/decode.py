@@ -0,0 +1,126 @@
+"""
+Loading of ``blocklog`` dumps
+
+A dump is a run of 512-byte blocks: a copy of the log's block range read off
+the card (``dd`` of the whole card with ``start_block``, or of the range
+alone) or blocks sent over the serial port. The blocks are mapped with
+``np.memmap``/``np.frombuffer`` and viewed as structured arrays without
+copying; only the records of valid blocks are copied out, once, in sequence
+order.
+"""
+
+import zlib
+
+import numpy as np
+
+from telemetry.format import BLOCK, BLOCK_MAGIC, DATA_BLOCK, LOG_HEADER, LOG_MAGIC, \
+    RECORD, RECORDS_PER_BLOCK, TICKS_HALFPERIOD, TICKS_PERIOD
+
+
+class Capture:
+    """Records of one dump, oldest first
+
+    ``records`` is a structured array of ``format.RECORD`` and ``t`` the
+    matching time in seconds since the first record, with the ticks_ms
+    wrap-around removed. With a log header, blocks of another epoch (left
+    over from before the last ``format()``) are not valid.
+    """
+
+    def __init__(self, blocks, header=None, check_crc=False):
+        self.blocks = blocks
+        self.header = header
+        valid = (blocks["magic"] == BLOCK_MAGIC) & (blocks["count"] <= RECORDS_PER_BLOCK) \
+            & (blocks["rec_size"] == RECORD.itemsize)
+        if header is not None:
+            valid &= blocks["epoch"] == header["epoch"]
+        index = np.flatnonzero(valid)
+        if check_crc:
+            index = index[[self._crc_ok(blocks[i]) for i in index]]
+        # the ring wraps: order by sequence number, not position
+        index = index[np.argsort(blocks["seq"][index], kind="stable")]
+        self.block_index = index
+        self.seq = blocks["seq"][index]
+        self.records = self._gather(blocks, index)
+        self.t = unwrap_ticks(self.records["ts"])
+
+    @staticmethod
+    def _crc_ok(block):
+        data = block["records"].tobytes()[:int(block["count"]) * RECORD.itemsize]
+        return zlib.crc32(data) == int(block["crc"])
+
+    @staticmethod
+    def _gather(blocks, index):
+        """Copies the records of the blocks at ``index`` into one array, one
+        slice of the mapping per run of adjacent blocks (normally two: the
+        ring before and after the wrap)"""
+        counts = blocks["count"][index]
+        records = np.empty(int(counts.sum()), dtype=RECORD)
+        breaks = np.flatnonzero(np.diff(index) != 1) + 1
+        pos = 0
+        for run in np.split(np.arange(len(index)), breaks):
+            if not len(run):
+                continue
+            first = index[run[0]]
+            chunk = blocks["records"][first: first + len(run)]
+            keep = np.arange(RECORDS_PER_BLOCK) < counts[run][:, None]
+            n = int(counts[run].sum())
+            records[pos: pos + n] = chunk[keep]
+            pos += n
+        return records
+
+    def __len__(self):
+        return len(self.records)
+
+    def gaps(self):
+        """Positions in ``seq`` where blocks are missing (overwritten or lost)"""
+        return np.flatnonzero(np.diff(self.seq.astype(np.int64)) != 1) + 1
+
+    def select(self, source, channel=None):
+        """Boolean mask of the records of one source (and channel)"""
+        mask = self.records["source"] == source
+        if channel is not None:
+            mask &= self.records["channel"] == channel
+        return mask
+
+
+def unwrap_ticks(ts):
+    """ticks_ms values (wrapping at 2**30) to seconds since the first one.
+    Like ``ticks_diff``, a step of more than half the period is a step
+    backwards (jitter, records logged out of order), not a wrap-around."""
+    if not len(ts):
+        return np.zeros(0)
+    step = (np.diff(ts.astype(np.int64)) + TICKS_HALFPERIOD) % TICKS_PERIOD - TICKS_HALFPERIOD
+    t = np.empty(len(ts))
+    t[0] = 0.0
+    np.cumsum(step, out=t[1:])
+    return t / 1000.0
+
+
+def _split(blocks, start_block, header):
+    header_block = None
+    if header is None:
+        header = start_block < len(blocks) and blocks[start_block].view(LOG_HEADER)[0]["magic"] == LOG_MAGIC
+    if header:
+        header_block = blocks[start_block].view(LOG_HEADER)[0]
+        start_block += 1
+    data = blocks[start_block:]
+    if header_block is not None and header_block["blocks"] <= len(data):
+        data = data[: header_block["blocks"]]
+    return data.view(DATA_BLOCK)[:, 0], header_block
+
+
+def load(path, start_block=0, header=None, check_crc=False) -> Capture:
+    """Maps a dump file. ``start_block`` is the first block of the log range
+    (the header) in a whole-card image. ``header`` is detected by default."""
+    raw = np.memmap(path, dtype=np.uint8, mode="r")
+    blocks = raw[: len(raw) // BLOCK * BLOCK].reshape(-1, BLOCK)
+    data, header_block = _split(blocks, start_block, header)
+    return Capture(data, header_block, check_crc)
+
+
+def load_bytes(buf, header=None, check_crc=False) -> Capture:
+    """Same as ``load`` for a dump already in memory (e.g. read from serial)"""
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    blocks = raw[: len(raw) // BLOCK * BLOCK].reshape(-1, BLOCK)
+    data, header_block = _split(blocks, 0, header)
+    return Capture(data, header_block, check_crc)
@@ -0,0 +1,63 @@
+"""
+NumPy dtypes of the ``blocklog`` on-card format
+
+These mirror the ``struct`` formats in ``blocklog.py`` and must be kept in
+step with them.
+"""
+
+import numpy as np
+
+BLOCK = 512
+RECORDS_PER_BLOCK = 31
+
+SRC_INA3221 = 1
+SRC_BQ25895 = 2
+SRC_DS18B20 = 3
+
+BLOCK_MAGIC = b"BLKd"
+LOG_MAGIC = b"BLKh"
+VERSION = 2
+
+# MicroPython's ticks_ms() wraps at 2**30
+TICKS_PERIOD = 1 << 30
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+# "<IBBhii"
+RECORD = np.dtype([
+    ("ts", "<u4"),
+    ("source", "u1"),
+    ("channel", "u1"),
+    ("h", "<i2"),
+    ("a", "<i4"),
+    ("b", "<i4"),
+])
+
+# "<4sIBBHI" followed by the records
+DATA_BLOCK = np.dtype([
+    ("magic", "S4"),
+    ("seq", "<u4"),
+    ("count", "u1"),
+    ("rec_size", "u1"),
+    ("epoch", "<u2"),
+    ("crc", "<u4"),
+    ("records", RECORD, (RECORDS_PER_BLOCK,)),
+])
+
+# "<4sHHIIIH", padded to a block
+LOG_HEADER = np.dtype([
+    ("magic", "S4"),
+    ("version", "<u2"),
+    ("rec_size", "<u2"),
+    ("blocks", "<u4"),
+    ("seq", "<u4"),
+    ("index", "<u4"),
+    ("epoch", "<u2"),
+    ("pad", "V", BLOCK - 22),
+])
+
+assert RECORD.itemsize == 16
+assert DATA_BLOCK.itemsize == BLOCK
+assert LOG_HEADER.itemsize == BLOCK
+
+# BQ25895 REG0B CHRG_STAT
+CHRG_STAT_NAMES = ("Not Charging", "Pre-charge", "Fast Charging", "Charge Termination Done")
@@ -0,0 +1,149 @@
+"""
+Derived metrics of a ``Capture``, vectorised over all samples
+
+Charge and energy are integrated with the trapezoidal rule over the real
+sample times, so gaps and jitter in the sampling period are accounted for.
+"""
+
+import numpy as np
+
+from telemetry.format import SRC_BQ25895, SRC_DS18B20, SRC_INA3221
+
+# INA3221 register LSBs, the low three bits of both registers are unused
+SHUNT_LSB = 40e-6
+BUS_LSB = 8e-3
+
+INA_CHANNEL = np.dtype([
+    ("t", "f8"),
+    ("bus_v", "f8"),
+    ("current_a", "f8"),
+    ("power_w", "f8"),
+    ("charge_mah", "f8"),
+    ("energy_wh", "f8"),
+])
+
+PHASE = np.dtype([
+    ("phase", "u1"),  # CHRG_STAT
+    ("start", "f8"),
+    ("end", "f8"),
+    ("first", "i8"),  # index into the BQ25895 samples
+    ("last", "i8"),
+])
+
+CYCLE = np.dtype([
+    ("start", "f8"),
+    ("duration_s", "f8"),
+    ("precharge_s", "f8"),
+    ("fast_s", "f8"),
+    ("terminated", "?"),
+    ("vbat_start", "f8"),
+    ("vbat_end", "f8"),
+    ("ichg_max", "f8"),
+    ("charge_mah", "f8"),
+    ("energy_wh", "f8"),
+])
+
+
+def _integrate(t, y):
+    """Running integral of ``y`` over ``t``, starting at 0"""
+    out = np.zeros(len(t))
+    if len(t) > 1:
+        np.cumsum(0.5 * (y[1:] + y[:-1]) * np.diff(t), out=out[1:])
+    return out
+
+
+def ina_channel(cap, channel, shunt_ohm=0.1):
+    """Voltage, current, power and running charge/energy of one INA3221 channel
+    (0-2), as an ``INA_CHANNEL`` array"""
+    mask = cap.select(SRC_INA3221, channel)
+    rec = cap.records[mask]
+    out = np.empty(len(rec), dtype=INA_CHANNEL)
+    out["t"] = cap.t[mask]
+    out["bus_v"] = (rec["a"] >> 3) * BUS_LSB
+    out["current_a"] = (rec["h"] >> 3) * (SHUNT_LSB / shunt_ohm)
+    out["power_w"] = out["bus_v"] * out["current_a"]
+    out["charge_mah"] = _integrate(out["t"], out["current_a"]) / 3.6
+    out["energy_wh"] = _integrate(out["t"], out["power_w"]) / 3600
+    return out
+
+
+def charger(cap):
+    """BQ25895 samples: ``(t, chrg_stat, vbat_v, ichg_a, state)``"""
+    mask = cap.select(SRC_BQ25895)
+    rec = cap.records[mask]
+    return cap.t[mask], (rec["h"] >> 3) & 0b11, rec["a"] / 1000, rec["b"] / 1000, rec["channel"]
+
+
+def charge_phases(cap):
+    """Splits the capture into runs of equal CHRG_STAT, as a ``PHASE`` array"""
+    t, stat, _, _, _ = charger(cap)
+    if not len(t):
+        return np.empty(0, dtype=PHASE)
+    first = np.concatenate(([0], np.flatnonzero(np.diff(stat)) + 1))
+    last = np.concatenate((first[1:] - 1, [len(t) - 1]))
+    out = np.empty(len(first), dtype=PHASE)
+    out["phase"] = stat[first]
+    out["first"] = first
+    out["last"] = last
+    out["start"] = t[first]
+    # a phase lasts until the next one starts
+    out["end"] = np.concatenate((t[first[1:]], [t[-1]]))
+    return out
+
+
+def cycles(cap):
+    """Per charge cycle statistics, as a ``CYCLE`` array. A cycle starts when
+    CHRG_STAT leaves "not charging"/"done" for pre-charge or fast charge and
+    ends with termination or when charging stops."""
+    t, _, vbat, ichg, _ = charger(cap)
+    phases = charge_phases(cap)
+    charging = (phases["phase"] == 1) | (phases["phase"] == 2)
+    # group adjacent charging phases
+    starts = np.flatnonzero(charging & ~np.concatenate(([False], charging[:-1])))
+    ends = np.flatnonzero(charging & ~np.concatenate((charging[1:], [False])))
+    out = np.zeros(len(starts), dtype=CYCLE)
+    energy = _integrate(t, vbat * ichg) / 3600
+    charge = _integrate(t, ichg) / 3.6
+    for n, (s, e) in enumerate(zip(starts, ends)):
+        group = phases[s: e + 1]
+        first = group["first"][0]
+        last = group["last"][-1]
+        length = group["end"] - group["start"]
+        stop = phases["end"][e]
+        out[n]["start"] = phases["start"][s]
+        out[n]["duration_s"] = stop - phases["start"][s]
+        out[n]["precharge_s"] = length[group["phase"] == 1].sum()
+        out[n]["fast_s"] = length[group["phase"] == 2].sum()
+        out[n]["terminated"] = e + 1 < len(phases) and phases["phase"][e + 1] == 3
+        out[n]["vbat_start"] = vbat[first]
+        out[n]["vbat_end"] = vbat[last]
+        out[n]["ichg_max"] = ichg[first: last + 1].max()
+        end = min(last + 1, len(t) - 1)
+        out[n]["charge_mah"] = charge[end] - charge[first]
+        out[n]["energy_wh"] = energy[end] - energy[first]
+    return out
+
+
+def temperatures(cap, sensor):
+    """``(t, degC)`` of one DS18B20 sensor"""
+    mask = cap.select(SRC_DS18B20, sensor)
+    return cap.t[mask], cap.records["h"][mask] / 100
+
+
+def summary(cap, shunt_ohm=(0.1, 0.1, 0.1)):
+    """Totals per INA3221 channel and charge cycle, as printable lines"""
+    lines = ["{} records, {:.1f} s, {} gaps".format(len(cap), cap.t[-1] if len(cap) else 0, len(cap.gaps()))]
+    for ch in range(3):
+        data = ina_channel(cap, ch, shunt_ohm[ch])
+        if not len(data):
+            continue
+        lines.append("ch{}: {:7d} samples  I mean {:8.4f} A max {:8.4f} A  P mean {:8.4f} W  {:10.3f} mAh {:9.4f} Wh".format(
+            ch + 1, len(data), data["current_a"].mean(), np.abs(data["current_a"]).max(),
+            data["power_w"].mean(), data["charge_mah"][-1], data["energy_wh"][-1]))
+    for c in cycles(cap):
+        lines.append("cycle at {:8.1f} s: {:8.1f} s (pre {:6.1f} s, fast {:8.1f} s) {}  Vbat {:.3f} -> {:.3f} V  "
+                     "Ichg max {:.3f} A  {:8.2f} mAh {:7.3f} Wh".format(
+                         c["start"], c["duration_s"], c["precharge_s"], c["fast_s"],
+                         "done   " if c["terminated"] else "stopped", c["vbat_start"], c["vbat_end"],
+                         c["ichg_max"], c["charge_mah"], c["energy_wh"]))
+    return lines
@@ -1,21 +1,17 @@
 from bqv3 import BQ25895, test_bq
-from time import sleep
+from charger import ChargeController, DONE, FAULT
+from machine import Timer
+from time import sleep_ms
 
 # bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12)
 
 
-def charge(bq):
-    bq.set_baterry_charge(False)
-    # charge voltage default is 4,20
-
-    bq.set_charge_current(128)
-    # set current limin, disable termination
-    bq._set_bit(0x07, [0, None, None, None, None, None, None, None])
-    bq._set_bit(0x05, [None, None, None, None, 0, 0, 0, 0])
-
-    bq.set_baterry_charge(True)
-    current = bq.read_charge_current()
-    while current >= 50:
-        print(f"Vbat={bq.read_battery_volt} Ichg={current}")
-        current = bq.read_charge_current()
-    bq.set_baterry_charge(False)
+def charge(bq, charge_current=128):
+    # charge voltage default is 4,20; the chip terminates at the 64 mA cut off
+    ctrl = ChargeController(bq, charge_current=charge_current, cut_off=64)
+    ctrl.start(Timer(0))
+    while ctrl.state not in (DONE, FAULT):
+        sleep_ms(ctrl.poll_ms)
+        print(f"{ctrl.state_name()} Vbat={ctrl.vbat} Ichg={ctrl.ichg}")
+    ctrl.stop()
+    ctrl.print_log()
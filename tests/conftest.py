@@ -0,0 +1,10 @@
+"""The drivers run against the simulated devices of the ``sim`` package"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim
+
+sim.install()
@@ -0,0 +1,46 @@
+import pytest
+from machine import I2C, Pin
+
+from bqv3 import BQ25895
+from charger import ChargeController, is_fault, CC, FAULT
+from i2cbus import I2CBus
+from sim.bqsim import BQ25895Sim
+
+
+@pytest.mark.parametrize("reg0c, fault", [
+    (0b00000000, False),
+    (0b00000010, False),  # NTC warm
+    (0b00000011, False),  # NTC cool
+    (0b00000101, True),   # NTC cold
+    (0b00000110, True),   # NTC hot
+    (0b00001000, True),   # BAT_FAULT
+    (0b00010000, True),   # CHRG_FAULT input
+    (0b00110000, True),   # CHRG_FAULT safety timer
+    (0b01000000, True),   # BOOST_FAULT
+    (0b10000000, False),  # WATCHDOG_FAULT
+])
+def test_is_fault(reg0c, fault):
+    assert is_fault(reg0c) == fault
+
+
+def _controller():
+    bus = I2CBus(I2C(1))
+    model = bus.i2c.attach(0x6A, BQ25895Sim(int_pin=Pin(14), adc_time=0))
+    bq = BQ25895(sda_pin=4, scl_pin=5, intr_pin=14, not_ce_pin=12, i2c=bus)
+    return ChargeController(bq), model
+
+
+@pytest.mark.parametrize("ntc", (0b010, 0b011))
+def test_jeita_warm_and_cool_keep_charging(ntc):
+    ctrl, model = _controller()
+    model.set_status(chrg_stat=2, fault=ntc)
+    ctrl._update()
+    assert ctrl.state == CC
+
+
+@pytest.mark.parametrize("ntc", (0b101, 0b110))
+def test_ntc_cold_and_hot_are_faults(ntc):
+    ctrl, model = _controller()
+    model.set_status(chrg_stat=2, fault=ntc)
+    ctrl._update()
+    assert ctrl.state == FAULT
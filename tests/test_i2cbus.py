@@ -0,0 +1,47 @@
+import pytest
+from machine import I2C
+from micropython import run_pending
+
+from i2cbus import I2CBus, get_bus
+from ina3221 import INA3221, C_REG_CONFIG
+from sim.inasim import INA3221Sim
+
+
+def test_deferred_call_waits_for_read_modify_write(monkeypatch):
+    bus = I2CBus(I2C(4))
+    bus.i2c.attach(0x40, INA3221Sim())
+    ina = INA3221(bus)
+    log = []
+    read = bus.i2c.readfrom_mem_into
+    write = bus.i2c.writeto_mem
+
+    def read_then_interrupt(addr, memaddr, buf, **kwargs):
+        read(addr, memaddr, buf, **kwargs)
+        # an interrupt handler deferred through the bus, between the read and the write
+        bus.run(lambda _: log.append("deferred"))
+
+    def logged_write(addr, memaddr, buf, **kwargs):
+        log.append("write")
+        write(addr, memaddr, buf, **kwargs)
+
+    ina_write = ina.write
+
+    def write_register(reg, value):
+        # scheduled callbacks may run between any two bytecodes on the board
+        run_pending()
+        ina_write(reg, value)
+
+    monkeypatch.setattr(bus.i2c, "readfrom_mem_into", read_then_interrupt)
+    monkeypatch.setattr(bus.i2c, "writeto_mem", logged_write)
+    monkeypatch.setattr(ina, "write", write_register)
+    ina.update(C_REG_CONFIG, 0x0007, 0x0007)
+    run_pending()
+    assert log == ["write", "deferred"]
+
+
+def test_get_bus_pins():
+    bus = get_bus(9, scl=5, sda=4)
+    assert get_bus(9, scl=5, sda=4) is bus
+    assert get_bus(9) is bus
+    with pytest.raises(ValueError):
+        get_bus(9, scl=22, sda=21)
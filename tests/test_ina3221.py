@@ -0,0 +1,83 @@
+import builtins
+from array import array
+
+import pytest
+from machine import I2C
+
+import ina3221
+import ina_viper
+from i2cbus import I2CBus
+from ina3221 import INA3221
+from sim.inasim import INA3221Sim
+
+
+class _Ptr:
+    """Viper ``ptr16``/``ptr32`` on CPython: loads and stores of 16 or 32-bit words"""
+
+    def __init__(self, buf, fmt):
+        self._mv = memoryview(buf).cast("B").cast(fmt)
+        self._bits = self._mv.itemsize * 8
+        self._signed = fmt.islower()
+
+    def __getitem__(self, i):
+        return self._mv[i]
+
+    def __setitem__(self, i, value):
+        value &= (1 << self._bits) - 1
+        if self._signed and value >> (self._bits - 1):
+            value -= 1 << self._bits
+        self._mv[i] = value
+
+
+@pytest.fixture(params=["python", "viper"])
+def ina(request, monkeypatch):
+    if request.param == "viper":
+        monkeypatch.setattr(builtins, "ptr16", lambda buf: _Ptr(buf, "H"), raising=False)
+        monkeypatch.setattr(builtins, "ptr32", lambda buf: _Ptr(buf, "i"), raising=False)
+        monkeypatch.setattr(ina3221, "_kernels", ina_viper)
+    else:
+        monkeypatch.setattr(ina3221, "_kernels", None)
+    bus = I2CBus(I2C(3))
+    bus.i2c.attach(0x40, INA3221Sim())
+    return INA3221(bus)
+
+
+RAW = (8 * 100, -8 * 100, 8 * 4095, -8 * 4096, 0, 8)
+
+
+def _expected(ina, raw):
+    shift = ina._ua_shift[0]
+    return [((r >> 3) * ina._ua_scale[0] + ((1 << shift) >> 1)) >> shift for r in raw]
+
+
+def test_current_in_place_on_32_bit_array(ina):
+    raw = array("i", RAW)
+    assert ina.batch_current_ua(raw) == len(RAW)
+    assert list(raw) == _expected(ina, RAW)
+    assert raw[2] == 1638000  # 4095 x 40 uV over 0.1 ohm
+
+
+def test_current_from_16_and_32_bit_sources(ina):
+    for typecode in ("h", "i"):
+        out = array("i", [0] * len(RAW))
+        ina.batch_current_ua(array(typecode, RAW), out)
+        assert list(out) == _expected(ina, RAW)
+
+
+def test_strided_in_place(ina):
+    raw = array("i", RAW)
+    ina.batch_shunt_uv(raw, start=1, step=2)
+    assert list(raw) == [RAW[i] if i % 2 == 0 else (RAW[i] >> 3) * 40 for i in range(len(RAW))]
+
+
+def test_bus_mv_in_place_on_16_bit_array(ina):
+    raw = array("h", (8 * 512, 8 * 4095))
+    ina.batch_bus_mv(raw)
+    assert list(raw) == [4096, 32760]
+
+
+def test_16_bit_result_is_refused(ina):
+    with pytest.raises(ValueError):
+        ina.batch_current_ua(array("h", RAW))
+    with pytest.raises(ValueError):
+        ina.batch_shunt_uv(array("h", RAW), array("h", [0] * len(RAW)))
@@ -0,0 +1,31 @@
+import time
+
+from machine import I2C, Pin
+from micropython import run_pending
+
+from i2cbus import I2CBus
+from ina3221 import INA3221
+from ina_alert import INAAlerts
+from sim.inasim import INA3221Sim
+
+
+def test_flags_cleared_by_conversion_ready_poll_are_reported():
+    bus = I2CBus(I2C(2))
+    model = bus.i2c.attach(0x40, INA3221Sim(critical_pin=Pin(34), warning_pin=Pin(35)))
+    ina = INA3221(bus)
+    for ch in (1, 2, 3):
+        ina.enable_channel(ch)
+    seen = []
+    alerts = INAAlerts(ina, Pin(34), Pin(35), handler=lambda a: seen.append((a.critical, a.warning)))
+    alerts.set_current_limits(2, critical=1.0, warning=0.5)
+    model.set_channel(2, bus_voltage=5.0, current=1.5)
+    # one conversion cycle (16 x 1.1 ms per register, 6 registers)
+    time.sleep(0.15)
+    with bus:
+        # the alert fires here; the poll clears the latched flags on the chip
+        # before the deferred decode gets the bus
+        ina.is_ready
+    run_pending()
+    assert seen and seen[0] == (0b010, 0b010)
+    assert alerts.is_critical(2) and alerts.is_warning(2)
+    assert ina.alert_flags == 0
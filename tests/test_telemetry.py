@@ -0,0 +1,22 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from telemetry.decode import unwrap_ticks
+from telemetry.format import TICKS_PERIOD
+
+
+def test_unwrap_ticks_wraps_forward():
+    ts = np.array([TICKS_PERIOD - 20, TICKS_PERIOD - 10, 0, 10], dtype=np.uint32)
+    assert list(unwrap_ticks(ts)) == [0.0, 0.01, 0.02, 0.03]
+
+
+def test_unwrap_ticks_small_step_backwards():
+    # out of order records: a step back is negative, not a jump of 2**30 ms
+    ts = np.array([1000, 1010, 1005, 1020], dtype=np.uint32)
+    assert list(unwrap_ticks(ts)) == [0.0, 0.01, 0.005, 0.02]
+
+
+def test_unwrap_ticks_step_backwards_across_wrap():
+    ts = np.array([5, TICKS_PERIOD - 5, 15], dtype=np.uint32)
+    assert list(unwrap_ticks(ts)) == [0.0, -0.01, 0.01]